@@ -0,0 +1,225 @@
+# annocache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Persistent cache of variant annotations, shared by all jobs (and worker
+# processes) on an annotator instance
+#
+# For every variant annotated, the cache keeps what the stages together
+# added to the record: the ID column, the INFO contributions and the
+# counts each stage took for it (for the count log). A variant seen by an
+# earlier job is then annotated without running the stages or querying
+# the reference database.
+#
+# Entries are keyed by the variant (CHROM, POS, REF, ALT as written, the
+# shape of its INFO and its number of columns) and by a version made of
+# the reference data version, the stages and the annotator code, so a new
+# reference database or a new annotate.py never reads older entries. The
+# least recently used entries are evicted beyond a maximum number.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import time
+import hashlib
+import sqlite3
+
+import annotate
+
+"""Default maximum number of entries
+"""
+MAXENTRIES = 2000000
+
+"""Entries inserted between two checks of the cache size
+"""
+EVICTINTERVAL = 50000
+
+"""A hit refreshes the last use of an entry at most this often (seconds)
+"""
+TOUCHINTERVAL = 3600
+
+# variables per SQL statement, below SQLite's limit
+CHUNK = 500
+
+
+"""Version of the entries written by a set of stages against a given
+   reference database
+"""
+def getVersion(annotators, reference_version=''):
+    digest = hashlib.sha1()
+    digest.update(str(reference_version).encode('utf-8'))
+    for annotator in annotators:
+        digest.update(b'\x00' + annotator.getName().encode('utf-8'))
+    fh = open(annotate.__file__, 'rb')
+    digest.update(fh.read())
+    fh.close()
+    return digest.hexdigest()[:16]
+
+
+"""A cache file, opened by every process that uses it
+"""
+class AnnotationCache(object):
+
+    def __init__(self, path, version, annotators,
+        maxentries=MAXENTRIES):
+        self.path = path
+        self.version = version
+        self.maxentries = maxentries
+        self.hits = 0
+        self.misses = 0
+        self.inserted = 0
+        self.enabled = True
+
+        inds = annotators[0].inds
+        self.inds = (inds[0], inds[1], inds[2], inds[3])
+        # INFO keys the stages read: a record whose own INFO mentions one
+        # may be annotated differently, so it is never cached
+        self.reads = set([])
+        for annotator in annotators:
+            self.reads.update(annotator.infoReads)
+
+        self.conn = None
+        try:
+            self.conn = sqlite3.connect(path, timeout=60,
+                check_same_thread=False)
+            self.conn.execute('pragma journal_mode=wal')
+            self.conn.execute('pragma synchronous=normal')
+            self.conn.execute('create table if not exists entries (' +
+                'key text primary key, value text, used integer)')
+            self.conn.execute('create index if not exists entries_used ' +
+                'on entries (used)')
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.disable(e)
+
+    """Key of a record, or None if its annotation cannot be reused
+    """
+    def getKey(self, fields):
+        if (len(fields) < 8):
+            return None
+        info = fields[7]
+        if (info == '.'):
+            shape = '.'
+        else:
+            for key in self.reads:
+                if key in info:
+                    return None
+            shape = ';' if info.endswith(';') else '+'
+        try:
+            return '\t'.join([self.version] +
+                [fields[i] for i in self.inds] + [shape, str(len(fields))])
+        except IndexError:
+            return None
+
+    """Returns {key: entry} for the keys found in the cache
+    """
+    def lookup(self, keys):
+        found = {}
+        keys = sorted(set([key for key in keys if key is not None]))
+        if (not self.enabled or len(keys) == 0):
+            return found
+
+        now = int(time.time())
+        stale = []
+        try:
+            for i in range(0, len(keys), CHUNK):
+                chunk = keys[i:i + CHUNK]
+                for key, value, used in self.conn.execute(
+                    'select key, value, used from entries where key in (' +
+                    ','.join(['?'] * len(chunk)) + ')', chunk):
+                    found[key] = json.loads(value)
+                    if (used < now - TOUCHINTERVAL):
+                        stale.append((now, key))
+            if (len(stale) > 0):
+                self.conn.executemany('update entries set used = ? ' +
+                    'where key = ?', stale)
+                self.conn.commit()
+        except sqlite3.Error as e:
+            self.disable(e)
+            return {}
+        return found
+
+    """Entry for a record annotated by the stages
+       fields and annotated are the record before and after the stages;
+       counts holds the counts each stage took for it, as (stage, {name:
+       count}). Besides ID and INFO, the stages may only have padded the
+       columns after the first (as GadAllAnnotator does). Returns None if
+       the record cannot be reproduced from an entry
+    """
+    def getEntry(self, fields, annotated, counts):
+        if (len(annotated) != len(fields) or annotated[0] != fields[0]):
+            return None
+        pad = annotated[1][:len(annotated[1]) - len(fields[1])]
+        for c in range(1, len(fields)):
+            if (c != 2 and c != 7 and annotated[c] != pad + fields[c]):
+                return None
+        info = annotated[7]
+        if (fields[7] == '.'):
+            return [annotated[2], 0, info, counts, pad]
+        if not info.startswith(pad + fields[7]):
+            return None
+        return [annotated[2], 1, info[len(pad + fields[7]):], counts, pad]
+
+    """Applies an entry to a record; returns the counts it holds
+    """
+    def apply(self, fields, entry):
+        id, append, info, counts, pad = entry
+        if pad:
+            for c in range(1, len(fields)):
+                fields[c] = pad + fields[c]
+        fields[2] = id
+        if append:
+            fields[7] = fields[7] + info
+        else:
+            fields[7] = info
+        return counts
+
+    def store(self, entries):
+        if (not self.enabled or len(entries) == 0):
+            return
+        now = int(time.time())
+        try:
+            self.conn.executemany('insert or replace into entries ' +
+                '(key, value, used) values (?, ?, ?)',
+                [(key, json.dumps(entry, separators=(',', ':')), now)
+                    for key, entry in entries.items()])
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.disable(e)
+            return
+
+        self.inserted = self.inserted + len(entries)
+        if (self.inserted >= EVICTINTERVAL):
+            self.evict()
+
+    """Removes the least recently used entries beyond maxentries, and a
+       tenth more so that eviction does not run on every insert
+    """
+    def evict(self):
+        self.inserted = 0
+        try:
+            count = self.conn.execute('select count(*) from entries;') \
+                .fetchone()[0]
+            if (count > self.maxentries):
+                self.conn.execute('delete from entries where key in (' +
+                    'select key from entries order by used limit ?)',
+                    (count - self.maxentries + self.maxentries // 10,))
+                self.conn.commit()
+        except sqlite3.Error as e:
+            self.disable(e)
+
+    """A failing cache (full disk, corrupt file) must not fail the job
+    """
+    def disable(self, e):
+        print(f"Annotation cache {self.path} disabled: {e}")
+        self.enabled = False
+
+    def close(self):
+        if (self.enabled and self.inserted > 0):
+            self.evict()
+        if (self.conn is not None):
+            self.conn.close()
+
+### EOF
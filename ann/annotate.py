@@ -10,8 +10,15 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import time
+
+import dbpool
 import file_utils as fu
+import intervals
+import pipeline
+import profiling
 import utils as u
+import vcfio
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
@@ -107,398 +114,744 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
+"""Base class for a single annotation stage
+   A stage annotates one parsed record (list of fields) at a time, so the
+   same stage can run on its own over a file or fused with other stages
+"""
+class Annotator(object):
+    headerPrefixes = ('##', '#CHROM', 'CHROM')
+    # attributes reported by writeLog(), see addCounts()
+    counters = ()
+    # INFO keys the stage reads and adds; a stage depends on the earlier
+    # stages that add a key it reads (see scheduler.py)
+    infoReads = ()
+    infoWrites = ()
+    # query results kept by lookahead(), keyed by SQL
+    recorded = None
+    recording = False
+
+    def __init__(self, cursor, format='vcf', sep='\t'):
+        self.cursor = cursor
+        self.inds = getFormatSpecificIndices(format=format)
+        self.sep = sep
+        self.profile = profiling.StageProfile()
+
+    """Name of the stage in profiles
+    """
+    def getName(self):
+        table = getattr(self, 'table', None)
+        if (table is None):
+            return type(self).__name__
+        return type(self).__name__ + '(' + str(table) + ')'
+
+    def isHeader(self, line):
+        return line.startswith(self.headerPrefixes)
+
+    """Called with a block of records before they are annotated, so a
+       stage can look them all up at once; annotate() must still work for
+       records that were not prefetched
+    """
+    def prefetch(self, records):
+        pass
+
+    def annotate(self, fields):
+        return fields
+
+    """True if annotate() waits on the reference database
+    """
+    def usesDatabase(self):
+        return self.cursor is not None
+
+    """Runs annotate() over copies of a block of records only to run its
+       queries, so they can be made ahead of time and concurrently with
+       other stages. annotate() then takes the results from query();
+       queries it makes that were not seen here still go to the database
+    """
+    def lookahead(self, records):
+        self.prefetch(records)
+        if not self.usesDatabase():
+            return
+
+        counts = self.getCounts()
+        self.recorded = {}
+        self.recording = True
+        start = time.perf_counter()
+        try:
+            for fields in records:
+                try:
+                    self.annotate(fields.copy())
+                except Exception:
+                    # the record is annotated for real later on
+                    pass
+        finally:
+            self.profile.lookahead = self.profile.lookahead + \
+                time.perf_counter() - start
+            self.recording = False
+            for name in counts:
+                setattr(self, name, counts[name])
+
+    """Runs sql and returns all its rows, timing it for the profile
+    """
+    def execute(self, sql):
+        start = time.perf_counter()
+        self.cursor.execute(sql)
+        rows = self.cursor.fetchall()
+        self.profile.addQuery(time.perf_counter() - start, len(rows))
+        return rows
+
+    """Returns all rows of sql
+    """
+    def query(self, sql):
+        if (not self.recording and self.recorded is not None and
+            sql in self.recorded):
+            self.profile.replayed = self.profile.replayed + 1
+            return self.recorded[sql]
+        rows = self.execute(sql)
+        if self.recording:
+            self.recorded[sql] = rows
+        return rows
+
+    """Returns the first row of sql or None
+    """
+    def queryOne(self, sql):
+        rows = self.query(sql)
+        return rows[0] if (len(rows) > 0) else None
+
+    def writeLog(self, fh_log):
+        pass
+
+    def getCounts(self):
+        return dict([(name, getattr(self, name)) for name in self.counters])
+
+    """Adds the counts of a stage that annotated another part of the
+       input; initial holds the counts of a fresh stage, which every part
+       started from
+    """
+    def addCounts(self, counts, initial):
+        for name in self.counters:
+            setattr(self, name,
+                getattr(self, name) + counts[name] - initial[name])
+
+
+"""Runs one annotator over a file and writes its output to another file
+"""
+def runAnnotator(annotator, infile, outfile, logcountfile=None, logmode='a',
+    blocksize=pipeline.BLOCKSIZE):
+    writer = vcfio.Writer(outfile)
+    fh_log = None
+    if (logcountfile is not None):
+        fh_log = open(logcountfile, logmode)
+    reader = vcfio.Reader(infile)
 
-    inds = getFormatSpecificIndices(format=format)
+    for block in reader.blocks(blocksize):
+        writer.writeLines(pipeline.annotateBlock([annotator], block))
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    if (fh_log is not None):
+        annotator.writeLog(fh_log)
+        fh_log.close()
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
+    reader.close()
+    writer.close()
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+"""
+class DbSnpAnnotator(Annotator):
+    headerPrefixes = ('#',)
+    counters = ('var_count', 'linenum')
+    infoWrites = ('DB', 'VC', 'GMAF')
+
+    def __init__(self, cursor, format='vcf', varclass='SNV', sep='\t',
+        snapshot=None):
+        Annotator.__init__(self, cursor, format=format, sep=sep)
+        self.varclass = varclass
+        self.var_count = 0
+        self.linenum = 1
+        # (chr, pos) -> dbSNP rows of the current block
+        self.block = {}
+        self.refcol = None
+        self.index = None
+        if (snapshot is not None):
+            self.index = snapshot.table('dbSNP')
+            self.refcol = self.index.column('REF')
+            self.infocol = self.index.column('INFO')
+
+    def usesDatabase(self):
+        return (self.cursor is not None and self.index is None)
+
+    """The batched prefetch already leaves few queries for annotate()
+    """
+    def lookahead(self, records):
+        self.prefetch(records)
+
+    def getChromPos(self, fields):
+        chr = fields.chrom
+        if chr.startswith("chr"):
+            chr = chr.replace('chr', '')
+        return chr, fields.pos
+
+    """Looks up all positions of the block with one query per chromosome
+    """
+    def prefetch(self, records):
+        if (self.index is not None):
+            return
+
+        positions = {}
+        for fields in records:
+            chr, pos = self.getChromPos(fields)
+            if (pos.isdigit() and '"' not in chr and '\\' not in chr):
+                positions.setdefault(chr, set()).add(int(pos))
+
+        self.block = {}
+        for chr in positions:
+            for pos in positions[chr]:
+                self.block[(chr, pos)] = []
 
+            sql = 'select * from dbSNP where CHR="' + str(chr) + \
+                '" AND POS IN (' + \
+                ','.join([str(x) for x in sorted(positions[chr])]) + \
+                ') AND INFO = "' + self.varclass + '" ;'
+            rows = self.execute(sql)
+            columns = [str(d[0]).upper() for d in self.cursor.description]
+            poscol = columns.index('POS')
+            self.refcol = columns.index('REF')
+            for row in rows:
+                key = (chr, int(row[poscol]))
+                if key in self.block:
+                    self.block[key].append(row)
+
+    def annotate(self, fields):
+        inds = self.inds
+        varclass = self.varclass
+        chr, pos = self.getChromPos(fields)
+        ref = clean_mysql_chars(fields[inds[2]]).strip()
+        compRef = getComplementary(ref)
+
+        # MySQL compares REF case-insensitively
+        refs = (ref.upper(), compRef.upper())
+        key = (chr, int(pos)) if pos.isdigit() else None
+        if (self.index is not None):
+            rows = [row for row in self.index.stab(chr, int(pos))
+                if str(row[self.refcol]).upper() in refs and
+                str(row[self.infocol]).upper() == varclass.upper()]
+        elif key in self.block:
+            rows = [row for row in self.block[key]
+                if str(row[self.refcol]).upper() in refs]
+        else:
             sql = 'select * from dbSNP where CHR="' + str(chr) + \
                 '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
                 '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
                 varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
+            rows = self.query(sql)
+
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        fields[2] = '.'
+        rsids = []
+        mafs = []
+        if (len(rows) > 0):
+            for row in rows:
+                rsids.append(str(row[3]))
+                if (str(row[7]) != '.'):
+                    mafs.append('GMAF=' + str(row[7]))
+
+            maf_str=''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+            self.var_count = self.var_count + 1
+            if (fields.getInfo() == '.'):
+                fields.setInfo('DB' + maf_str)
+            else:
+                fields.appendInfo(';DB;VC=' + varclass + maf_str)
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
+            fields[2] = str(';'.join(rsids))
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+        self.linenum = self.linenum + 1
+        return fields
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+    def writeLog(self, fh_log):
+        ratioInDbSnp = (self.var_count / float(self.linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(self.linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(self.var_count)} ({str(ratioInDbSnp)}%)\n")
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
 
-            linenum = linenum + 1
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t'):
 
-        else:
-            fh_out.write(line + '\n')
+    conn = dbpool.acquire()
+    annotator = DbSnpAnnotator(conn.cursor(), format=format,
+        varclass=varclass, sep=sep)
+    runAnnotator(annotator, vcf, vcf + tmpextout,
+        logcountfile=vcf + '.count.log', logmode='w')
+    dbpool.release(conn)
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+"""Most ranges of starts one prefetch query reads chrom_pos_unequal over;
+   the OR of their conditions must stay under the expression depth SQLite
+   allows (1000), and short enough for the MySQL range optimizer
+"""
+MAXRANGES = 500
 
 
 """NOTE: all isoforms are collapsed in one record
     1. chrom_pos_equal_base
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
+   The first of these with rows for a variant annotates it. All three are
+   looked up for a block of records at once (see prefetch())
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
+class BigRefGeneAnnotator(Annotator):
+    headerPrefixes = ('#',)
+    infoWrites = ('name', 'name2', 'transcriptStrand', 'positionType',
+        'frame', 'mrnaCoord', 'codonCoord', 'spliceDist', 'referenceCodon',
+        'referenceAA', 'variantCodon', 'variantAA', 'changesAA',
+        'functionalClass', 'codingCoordStr', 'proteinCoordStr',
+        'inCodingRegion', 'spliceInfo', 'uorfChange')
+
+    def __init__(self, cursor, format='vcf', sep='\t', snapshot=None):
+        Annotator.__init__(self, cursor, format=format, sep=sep)
+        self.tables = (None, None, None)
+        # (chr, pos) -> rows of the three tables for the current block
+        self.block = {}
+        # longest chrom_pos_unequal row of every chromosome, bounding its
+        # range lookups
+        self.maxspans = None
+        self.refcol = None
+        self.altcol = None
+        if (snapshot is not None):
+            self.tables = (snapshot.table('chrom_pos_equal_base'),
+                snapshot.table('chrom_pos_equal_nobase'),
+                snapshot.table('chrom_pos_unequal'))
+            self.refcol = self.tables[0].column('haplotypeReference')
+            self.altcol = self.tables[0].column('haplotypeAlternate')
+
+    def usesDatabase(self):
+        return (self.cursor is not None and self.tables[0] is None)
+
+    """The batched prefetch already leaves few queries for annotate()
+    """
+    def lookahead(self, records):
+        self.prefetch(records)
+
+    def getChromPos(self, fields):
+        chr = fields.chrom
+        if chr.startswith("chr"):
+            chr = chr.replace('chr', '')
+        return chr, fields.pos
+
+    """Looks up all positions of the block in the three tables with one
+       query per chromosome, and one more for every MAXRANGES ranges past
+       the first. chrom_pos_unequal is read over the ranges of starts that
+       can reach a position of the block, for the rows that end at or after
+       the first position of their range, and the rows read are matched to
+       the positions with an interval index
+    """
+    def prefetch(self, records):
+        if (self.tables[0] is not None):
+            return
+
+        positions = {}
+        for fields in records:
+            chr, pos = self.getChromPos(fields)
+            if (pos.isdigit() and '"' not in chr and '\\' not in chr):
+                positions.setdefault(chr, set()).add(int(pos))
+
+        self.block = {}
+        if (len(positions) > 0 and self.maxspans is None):
+            self.maxspans = {}
+            for row in self.execute('select CHR, max(end - start) from ' +
+                'chrom_pos_unequal group by CHR;'):
+                self.maxspans[str(row[0]).upper()] = max(0, int(row[1] or 0))
+
+        for chr in positions:
+            for pos in positions[chr]:
+                self.block[(chr, pos)] = ([], [], [])
+
+            starts = sorted(positions[chr])
+            inlist = ','.join([str(x) for x in starts])
+            maxspan = self.maxspans.get(str(chr).upper(), 0)
+            # [lowest start, last position, first position] of the ranges
+            ranges = []
+            for pos in starts:
+                if (len(ranges) > 0 and pos - maxspan <= ranges[-1][1]):
+                    ranges[-1][1] = pos
+                else:
+                    ranges.append([pos - maxspan, pos, pos])
+
+            # the ranges never overlap, so no row is read twice
+            unequal = []
+            for i in range(0, len(ranges), MAXRANGES):
+                sql = 'select 2 as tier, t.* from chrom_pos_unequal t ' + \
+                    'where CHR="' + str(chr) + '" AND (' + ' OR '.join([
+                        '(start BETWEEN ' + str(lo) + ' AND ' + str(hi) +
+                        ' AND end >= ' + str(first) + ')'
+                        for lo, hi, first in ranges[i:i + MAXRANGES]]) + ');'
+                if (i == 0):
+                    sql = 'select 0 as tier, t.* from ' + \
+                        'chrom_pos_equal_base t where CHR="' + str(chr) + \
+                        '" AND start IN (' + inlist + ') union all ' + \
+                        'select 1 as tier, t.* from ' + \
+                        'chrom_pos_equal_nobase t where CHR="' + str(chr) + \
+                        '" AND start IN (' + inlist + ') union all ' + sql
+                rows = self.execute(sql)
+                columns = [str(d[0]).lower() for d in self.cursor.description]
+                startcol = columns.index('start') - 1
+                endcol = columns.index('end') - 1
+                self.refcol = columns.index('haplotypereference') - 1
+                self.altcol = columns.index('haplotypealternate') - 1
 
+                for row in rows:
+                    tier = int(row[0])
+                    row = row[1:]
+                    if (tier < 2):
+                        self.block[(chr, int(row[startcol]))][tier].append(row)
+                    else:
+                        unequal.append((chr, row[startcol], row[endcol], row))
+            # rows of a position in the order they were read
+            index = intervals.IntervalIndex(unequal, 0, 1, 2)
+            for pos in starts:
+                self.block[(chr, pos)][2].extend(
+                    [entry[3] for entry in index.stab(chr, pos)])
+
+    """Rows of one of the three tables (tier) for a variant
+    """
+    def lookup(self, tier, chr, pos, ref, alt, compRef, compAlt):
+        key = (chr, int(pos)) if pos.isdigit() else None
+        if (self.tables[tier] is not None):
+            rows = self.tables[tier].stab(chr, int(pos))
+        elif key in self.block:
+            rows = self.block[key][tier]
+        elif (tier == 0):
+            return self.query('select * from chrom_pos_equal_base where ' +
+                'CHR="' + str(chr) + '" AND start = ' + str(pos) +
+                ' AND ((haplotypeReference="' + str(ref) +
+                '" AND haplotypeAlternate ="' + str(alt) +
+                '") OR (haplotypeReference="' + str(compRef) +
+                '" AND haplotypeAlternate ="' + str(compAlt) + '"));')
+        elif (tier == 1):
+            return self.query('select * from chrom_pos_equal_nobase where ' +
+                'CHR="' + str(chr) + '" AND start = ' + str(pos) + ';')
+        else:
+            return self.query('select * from chrom_pos_unequal where ' +
+                'CHR="' + str(chr) + '" AND start <= ' + str(pos) +
+                ' AND ' + str(pos) + ' <= end ;')
+
+        if (tier == 0):
+            # MySQL compares the alleles case-insensitively
+            alleles = ((ref.upper(), alt.upper()),
+                (compRef.upper(), compAlt.upper()))
+            rows = [row for row in rows if
+                (str(row[self.refcol]).upper(),
+                str(row[self.altcol]).upper()) in alleles]
+        return rows
+
+    def annotate(self, fields):
+        inds = self.inds
+        chr, pos = self.getChromPos(fields)
+        ref = clean_mysql_chars(fields[inds[2]]).strip()
+        alt = clean_mysql_chars(fields[inds[3]]).strip()
+
+        compRef = getComplementary(ref)
+        compAlt = getComplementary(alt)
+
+        for tier in range(3):
+            rows = self.lookup(tier, chr, pos, ref, alt, compRef, compAlt)
             if (len(rows) > 0):
-                keep_going = False
                 m = set([])
                 for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+                info = fields.getInfo() + ';' + ';'.join(m)
+                if info.startswith(".;"):
+                    info = info.replace('.;', '', 1)
+                fields.setInfo(info)
+                break
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
+        return fields
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
 
-            if (keep_going):
-                fh_out.write(line + '\n')
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2',
+    sep='\t'):
+    conn = dbpool.acquire()
+    annotator = BigRefGeneAnnotator(conn.cursor(), format=format, sep=sep)
+    runAnnotator(annotator, vcf + tmpextin, vcf + tmpextout)
+    dbpool.release(conn)
 
-            vcf_linenum = vcf_linenum + 1
 
-        else:
-            fh_out.write(line + '\n')
+"""A refGene transcript with its exons parsed into integers
+   Exons are kept sorted by start with the running maximum of their ends,
+   so the exons containing a position are found by bisection
+"""
+class TranscriptModel(object):
+
+    def __init__(self, row):
+        self.strand = str(row[3])
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+
+        exonStarts = row[9].decode("utf-8") if isinstance(row[9], bytes) \
+            else str(row[9])
+        exonEnds = row[10].decode("utf-8") if isinstance(row[10], bytes) \
+            else str(row[10])
+        exonsSt = exonStarts.split(',')
+        exonsEn = exonEnds.split(',')
+        exons = sorted([(int(exonsSt[e]), e, int(exonsEn[e]))
+            for e in range(0, self.exonCount)])
+
+        self.starts = [x[0] for x in exons]
+        self.orders = [x[1] for x in exons]
+        self.ends = [x[2] for x in exons]
+        self.maxends = []
+        maxend = None
+        for end in self.ends:
+            maxend = end if maxend is None else max(maxend, end)
+            self.maxends.append(maxend)
+
+    """Returns the exons (0-based, in refGene order) with
+       exonStart <= pos <= exonEnd
+    """
+    def exonsAt(self, pos):
+        return [self.orders[h] for h in intervals.findOverlaps(self.starts,
+            self.maxends, self.ends, self.orders, pos, pos)]
+
+    """Exon number as reported in INFO: counted from the 5' end
+    """
+    def exonNumber(self, e):
+        if (self.strand == '-'):
+            return self.exonCount - e
+        return e + 1
+
+
+"""Transcript models parsed by this process, keyed by the refGene columns
+   they are built from
+"""
+MAXMODELS = 200000
+_models = {}
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def getTranscriptModel(row):
+    key = tuple(row[3:11])
+    model = _models.get(key)
+    if (model is None):
+        if (len(_models) >= MAXMODELS):
+            _models.clear()
+        model = TranscriptModel(row)
+        _models[key] = model
+    return model
 
 
 """Get information about location in gene structures
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
+class GenesAnnotator(Annotator):
+    headerPrefixes = ('#',)
+    counters = ('interGenic_count', 'cds_count', 'utr3_count', 'utr5_count',
+        'intronic_count', 'non_coding_intronic_count', 'exonic_count',
+        'non_coding_exonic_count', 'promoter_count')
+    # the gene models are chosen by the name and positionType that
+    # getBigRefGene adds
+    infoReads = ('name', 'positionType')
+
+    def __init__(self, cursor, format='vcf', table='refGene',
+        promoter_offset=500, sep='\t', inmemory=False, snapshot=None,
+        sweep=False):
+        Annotator.__init__(self, cursor, format=format, sep=sep)
+        self.table = table
+        self.promoter_offset = promoter_offset
+        self.index = None
+        self.cpgIndex = None
+        if sweep:
+            if (snapshot is not None):
+                source = snapshot.table(table)
+            else:
+                source = intervals.ChromQuery(cursor, table,
+                    startcol='txStart', endcol='txEnd')
+            self.index = intervals.SweepJoin(source,
+                lambda: self.loadIndex(snapshot))
+        elif (snapshot is not None):
+            self.index = snapshot.table(table)
+        if (snapshot is not None):
+            self.cpgIndex = snapshot.table('cpgIslandExt')
+        elif inmemory:
+            self.cpgIndex = intervals.getIndex(cursor, 'cpgIslandExt',
+                columns='chrom, chromStart, chromEnd, name')
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count = 0
+
+    def annotate(self, fields):
+        table = self.table
+        promoter_offset = self.promoter_offset
+
+        chr = fields.chrom
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = fields.pos
+        info_field = clean_mysql_chars(fields.getInfo()).strip()
+
+        sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
+            '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
+            str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
+            str(promoter_offset) +');'
+
+        if (self.index is not None):
+            rows = self.index.overlap(chr, int(pos) - int(promoter_offset),
+                int(pos) + int(promoter_offset))
+        else:
+            rows = self.query(sql)
+        info = []
+
+        if (len(rows) > 0):
+            cnt = 1
+            for row in rows:
+                #count location
+                positionType = str(u.parse_field(info_field,
+                    'positionType', ';', '='))
+
+                if (positionType == 'intron'):
+                    self.intronic_count = self.intronic_count + 1
+                elif (positionType == 'non_coding_intron'):
+                    self.non_coding_intronic_count = self.non_coding_intronic_count + 1
+                elif (positionType == 'CDS'):
+                    self.cds_count = self.cds_count + 1
+                elif (positionType == 'non_coding_exon'):
+                    self.non_coding_exonic_count = self.non_coding_exonic_count + 1
+                elif (positionType == 'utr5'):
+                    self.utr5_count = self.utr5_count + 1
+                elif (positionType == 'utr3'):
+                    self.utr3_count = self.utr3_count + 1
+
+                model = getTranscriptModel(row)
+                txtStart = model.txStart
+                txtEnd = model.txEnd
+                cdsStart = model.cdsStart
+                cdsEnd = model.cdsEnd
+                exonCount = model.exonCount
+                strand = model.strand
+
+                promoter_plus = txtStart - int(promoter_offset)
+                promoter_minus = txtEnd + int(promoter_offset)
+                region = ""
+                pos = int(pos)
+                exons = []
+
+                if (cdsStart == cdsEnd):
+                    for e in model.exonsAt(pos):
+                        exons.append("non_coding_exon=" + "ex" + \
+                            str(model.exonNumber(e)) + '/' + str(exonCount))
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+                elif (u.isBetween(pos, cdsStart, cdsEnd)):
+                    for e in model.exonsAt(pos):
+                        exons.append("exon=" +  "ex" + \
+                            str(model.exonNumber(e)) + '/' + str(exonCount))
+                        self.exonic_count = self.exonic_count + 1
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+
+                elif (u.isBetween(pos, promoter_plus, txtStart) and
+                    (strand == "+")):
+                    region = self.getPromoterRegion(chr, pos)
+
+                elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
+                    region = self.getPromoterRegion(chr, pos)
 
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
+                else:
+                    region = ''
 
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                if (region != ''):
+                    info.append(collapseGeneNames(row=row,
+                        indices=indicesKnownGenes, region=region, cnt=cnt))
 
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
+                cnt = cnt + 1
 
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
+            str_info = ";".join(info)
+            fields.appendInfo(';' + str_info)
 
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
+        else:
+            fields.appendInfo(";positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
 
-                    else:
-                        region = ''
+        return fields
 
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
+    def usesDatabase(self):
+        return (self.cursor is not None and (self.index is None or
+            self.cpgIndex is None))
 
-                    cnt = cnt + 1
+    def loadIndex(self, snapshot=None):
+        if (snapshot is not None):
+            return snapshot.table(self.table)
+        return intervals.getIndex(self.cursor, self.table,
+            startcol='txStart', endcol='txEnd')
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+    def getPromoterRegion(self, chr, pos):
+        if (self.cpgIndex is not None):
+            rows = self.cpgIndex.stab(chr, pos)
+            row = rows[0] if (len(rows) > 0) else None
+        else:
+            sql = 'select chrom, chromStart, chromEnd, name from ' + \
+                'cpgIslandExt where chrom="' + str(chr) + \
+                '" AND (chromStart <= ' + str(pos) + \
+                ' AND ' + str(pos) + ' <= chromEnd);'
+            row = self.queryOne(sql)
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+        if (row is not None):
+            self.promoter_count = self.promoter_count + 1
+            return 'putativePromoterRegion=' + "".join(str(row[3]).split())
+        return ''
 
-            linenum = linenum + 1
+    def writeLog(self, fh_log):
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
 
-        else:
-            fh_out.write(line + '\n')
+        print(f"In interGenic {str(self.interGenic_count)}")
+        fh_log.write(f"In interGenic {str(self.interGenic_count)}\n")
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+        print(f"In CDS {str(self.cds_count)}")
+        fh_log.write(f"In CDS {str(self.cds_count)}\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+        print(f"In \'3 UTR {str(self.utr3_count)}")
+        fh_log.write(f"In \'3 UTR {str(self.utr3_count)}\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+        print(f"In \'5 UTR {str(self.utr5_count)}")
+        fh_log.write(f"In \'5 UTR {str(self.utr5_count)}\n")
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+        print(f"In Intronic {str(self.intronic_count)}")
+        fh_log.write(f"In Intronic {str(self.intronic_count)}\n")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+        print(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}")
+        fh_log.write(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}\n")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+        print(f"In Exonic {str(self.exonic_count)}")
+        fh_log.write(f"In Exonic {str(self.exonic_count)}\n")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+        print(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}")
+        fh_log.write(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+        print(f"In Putative Promoter Region {str(self.promoter_count)}")
+        fh_log.write(f"In Putative Promoter Region {str(self.promoter_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
+    tmpextin='.2', tmpextout='.3', sep='\t', inmemory=False):
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+    conn = dbpool.acquire()
+    annotator = GenesAnnotator(conn.cursor(), format=format, table=table,
+        promoter_offset=promoter_offset, sep=sep, inmemory=inmemory)
+    runAnnotator(annotator, vcf + tmpextin, vcf + tmpextout,
+        logcountfile=vcf + '.count.log')
+    dbpool.release(conn)
 
 
 """Method used in INDELS, where bigRefGeneTable is not applicable
@@ -526,7 +879,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
     inds = getFormatSpecificIndices(format=format)
     fh = open(vcf)
-    conn = u.db_connect()
+    conn = dbpool.acquire()
     cursor = conn.cursor()
     linenum = 1
 
@@ -555,33 +908,27 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
             if (len(rows) > 0):
                 cnt = 1
                 for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
+                    model = getTranscriptModel(row)
+                    txtStart = model.txStart
+                    txtEnd = model.txEnd
+                    cdsStart = model.cdsStart
+                    cdsEnd = model.cdsEnd
+                    exonCount = model.exonCount
                     geneSymbol = str(row[12])
-                    strand = str(row[3])
+                    strand = model.strand
 
                     promoter_plus = txtStart - int(promoter_offset)
                     promoter_minus = txtEnd + int(promoter_offset)
                     region = ""
                     pos = int(pos)
                     exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
 
                     if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
+                        for e in model.exonsAt(pos):
+                            exons.append("non_coding_exon=" + "ex" + \
+                                str(model.exonNumber(e)) + '/' + \
+                                str(exonCount))
+                            non_coding_exonic_count = non_coding_exonic_count + 1
                         if (len(exons) > 0):
                             region='positionType=non_coding_exon;' + ";".join(exons)
                         else:
@@ -590,14 +937,11 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
                         cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
+                        for e in model.exonsAt(pos):
+                            exons.append("exon=" + "ex" + \
+                                str(model.exonNumber(e)) + '/' + \
+                                str(exonCount))
+                            exonic_count=exonic_count+1
                         if (len(exons) > 0):
                             region = 'positionType=CDS;' + ";".join(exons)
                         else:
@@ -610,12 +954,12 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                         region = 'positionType=utr5'
 
                     elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
+                        (cdsStart < cdsEnd) and (strand == "+")):
                         utr3_count = utr3_count + 1
                         region = 'positionType=utr3'
 
                     elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
+                        (cdsStart < cdsEnd) and (strand == "-")):
                         utr5_count = utr5_count + 1
                         region = 'positionType=utr5'
 
@@ -709,421 +1053,364 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     fh_out.close()
     fh_log.close()
     fh.close()
-    conn.close()
+    dbpool.release(conn)
 
 
-"""Overlap with tfbsConsSites
+"""Base class for stages that count overlaps with a reference table
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+class OverlapAnnotator(Annotator):
+    counters = ('var_count', 'line_count')
+    chromcol = 'chrom'
+    startcol = 'chromStart'
+    endcol = 'chromEnd'
+    # 'first' or 'all' for stages that take the first or all overlapping
+    # rows of a variant from the index; a block of variants is then looked
+    # up at once (see prefetch())
+    vectorized = None
+
+    """With inmemory=True the table is loaded once per process into an
+       interval index and the per-variant queries are answered from it;
+       with a snapshot they are answered from the snapshot's table.
+       With sweep=True a position-sorted input is merge-joined against the
+       table; unsorted input falls back to the index. Vectorized stages
+       always use the index (or snapshot) when either is set
+    """
+    def __init__(self, cursor, format='vcf', table=None, sep='\t',
+        inmemory=False, snapshot=None, sweep=False):
+        Annotator.__init__(self, cursor, format=format, sep=sep)
+        self.table = table
+        self.var_count = 0
+        self.line_count = 0
+        self.index = None
+        # (chr, pos) -> rows of the current block, see prefetch()
+        self.block = {}
+        if (self.vectorized and (sweep or inmemory or
+            snapshot is not None)):
+            self.index = self.loadIndex(snapshot)
+        elif sweep:
+            if (snapshot is not None):
+                source = snapshot.table(table)
+            else:
+                source = intervals.ChromQuery(cursor, table,
+                    chromcol=self.chromcol, startcol=self.startcol,
+                    endcol=self.endcol)
+            self.index = intervals.SweepJoin(source,
+                lambda: self.loadIndex(snapshot))
+        elif (snapshot is not None or inmemory):
+            self.index = self.loadIndex(snapshot)
+
+    def usesDatabase(self):
+        return (self.cursor is not None and self.index is None)
+
+    def loadIndex(self, snapshot=None):
+        if (snapshot is not None):
+            return snapshot.table(self.table)
+        return intervals.getIndex(self.cursor, self.table,
+            chromcol=self.chromcol, startcol=self.startcol,
+            endcol=self.endcol)
+
+    def getChromPos(self, fields):
+        chr = fields.chrom
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+        return chr, fields.pos
+
+    """Looks up all positions of the block in the index at once, one
+       chromosome at a time (see intervals.Segments)
+    """
+    def prefetch(self, records):
+        self.block = {}
+        if (self.vectorized is None or self.index is None):
+            return
+
+        positions = {}
+        for fields in records:
+            chr, pos = self.getChromPos(fields)
+            if (pos is not None and pos.isdigit()):
+                positions.setdefault(chr, set()).add(pos)
+
+        first = (self.vectorized == 'first')
+        for chr in positions:
+            keys = list(positions[chr])
+            for pos, found in zip(keys, self.index.stabMany(chr,
+                [int(pos) for pos in keys], first)):
+                self.block[(chr, pos)] = found
+
+    """Rows of a vectorized stage for pos: all overlapping rows, or the
+       first of them (or None) for 'first' stages. Taken from the block if
+       it was prefetched, else queried with getSql()
+    """
+    def lookup(self, chr, pos):
+        key = (chr, pos)
+        if key in self.block:
+            return self.block[key]
+        if (self.vectorized == 'first'):
+            return self.fetchFirstOverlap(self.getSql(chr, pos), chr, pos)
+        return self.fetchOverlaps(self.getSql(chr, pos), chr, pos)
+
+    """Returns all rows overlapping pos, from the index when loaded
+    """
+    def fetchOverlaps(self, sql, chr, pos):
+        if (self.index is not None and pos.isdigit()):
+            return self.index.stab(chr, int(pos))
+        return self.query(sql)
+
+    """Returns the first row overlapping pos or None
+    """
+    def fetchFirstOverlap(self, sql, chr, pos):
+        if (self.index is not None and pos.isdigit()):
+            rows = self.index.stab(chr, int(pos))
+            return rows[0] if (len(rows) > 0) else None
+        return self.queryOne(sql)
+
+    def writeLog(self, fh_log):
+        fh_log.write(f"In {str(self.table)}: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
 
+
+"""Overlap with tfbsConsSites
+"""
+class TfbsConsSitesAnnotator(OverlapAnnotator):
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
-
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
-
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
+    def __init__(self, cursor, format='vcf', table='tfbsConsSites',
+        sep='\t', snapshot=None):
+        # one table per chromosome, see annotate()
+        OverlapAnnotator.__init__(self, cursor, format=format, table=table,
+            sep=sep)
+        self.snapshot = snapshot
+
+    def usesDatabase(self):
+        return (self.cursor is not None and self.snapshot is None)
+
+    def annotate(self, fields):
+        chr = fields.chrom
+        # For some reason this table has no "chr" preceeding number
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = fields.pos
+        chrIndex=chr.replace('chr', '')
+
+        if (chrIndex in self.allowed_chrom):
+            sql = 'select chrom, chromStart, chromEnd, name ' + \
+                'from tfbsConsSites' + chrIndex + \
+                ' where  chromStart <= ' + str(pos) + ' AND ' + \
+                str(pos) + ' <= chromEnd;'
+            if (self.snapshot is not None):
+                rows = self.snapshot.table('tfbsConsSites' + chrIndex).stab(
+                    chr, int(pos))
+            else:
+                rows = self.query(sql)
+            records = []
 
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
+            if (len(rows) > 0):
+                self.line_count = self.line_count + 1
 
-                    fh_out.write('\t'.join(fields) + '\n')
+                for row in rows:
+                    self.var_count = self.var_count + 1
+                    t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                        str(row[1]) + '.' + str(row[2])
+                    t = t.strip()
+                    records.append('tfbsRegion' + '=' + t)
 
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
+                fields.addInfo(';'.join(records))
 
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
+        return fields
 
-        linenum = linenum + 1
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    conn = dbpool.acquire()
+    annotator = TfbsConsSitesAnnotator(conn.cursor(), format=format,
+        table=table, sep=sep)
+    runAnnotator(annotator, vcf + tmpextin, vcf + tmpextout,
+        logcountfile=vcf + '.count.log')
+    dbpool.release(conn)
 
 
 """Overlap with GadAll table
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class GadAllAnnotator(OverlapAnnotator):
+    chromcol = 'chromosome'
+
+    def annotate(self, fields):
+        table = self.table
+        chr = fields.chrom
+        # For some reason this table has no "chr" preceeding number
+        if chr.startswith("chr"):
+            chr = str(chr).replace("chr", "")
+
+        pos = fields.pos
+
+        sql = 'select * from ' + table + ' where chromosome="' + \
+            str(chr) + '" AND (chromStart <= ' + str(pos) + \
+            ' AND ' + str(pos) + ' <= chromEnd);'
+        rows = self.fetchOverlaps(sql, chr, pos)
+        records = []
+
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]) )
+                    records.append(str(table) + '=' + str(row[3]))
+            fields.addInfo(';'.join(records))
+            # annotated records have always been written with '\t ' between
+            # columns; keep the leading spaces so the output does not change
+            fields.pad(' ')
+
+        return fields
+
+
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
+    tmpextout='.1', sep='\t', inmemory=False):
+
+    conn = dbpool.acquire()
+    annotator = GadAllAnnotator(conn.cursor(), format=format, table=table,
+        sep=sep, inmemory=inmemory)
+    runAnnotator(annotator, vcf + tmpextin, vcf + tmpextout,
+        logcountfile=vcf + '.count.log')
+    dbpool.release(conn)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+""" Overlap with gwasCatalog table """
+class GwasCatalogAnnotator(OverlapAnnotator):
+    startcol = 'chromEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def annotate(self, fields):
+        table = self.table
+        chr = fields.chrom
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+        pos = fields.pos
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        sql = 'select * from ' + table + ' where chrom="' + \
+            str(chr) + '" AND chromEnd = ' + str(pos) + ';'
+        rows = self.fetchOverlaps(sql, chr, pos)
+        records = []
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                records.append(str(table) + '=' + str('pubMedID') + \
+                    '=' + str(row[5]) + ',trait=' + str(row[10]))
+            fields.addInfo(';'.join(records))
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        return fields
 
 
-""" Overlap with gwasCatalog table """
 def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    tmpextin='', tmpextout='.1', sep='\t', inmemory=False):
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    conn = dbpool.acquire()
+    annotator = GwasCatalogAnnotator(conn.cursor(), format=format,
+        table=table, sep=sep, inmemory=inmemory)
+    runAnnotator(annotator, vcf + tmpextin, vcf + tmpextout,
+        logcountfile=vcf + '.count.log')
+    dbpool.release(conn)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class HUGOGeneNomenclatureAnnotator(OverlapAnnotator):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def annotate(self, fields):
+        table = self.table
+        chr = fields.chrom
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+        pos = fields.pos
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+        sql = 'select * from ' + table + ' where chrom="' + \
+            str(chr) + '" AND (chromStart <= ' + str(pos) + \
+            ' AND ' + str(pos) + ' <= chromEnd);'
+        rows = self.fetchOverlaps(sql, chr, pos)
+        records = []
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                t = str(str(row[5]) + ',' + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append('HGNC_GeneAnnotation' + '=' + t)
 
+            records_str = ','.join(records).replace(';', ',')
 
-"""Overlap with segdup regions genomicSuperDups
-"""
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
+            fields.addInfo(records_str)
 
-                fh_out.write('\t'.join(fields) + '\n')
+        return fields
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
+    tmpextin='', tmpextout='.1', sep='\t', inmemory=False):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    conn = dbpool.acquire()
+    annotator = HUGOGeneNomenclatureAnnotator(conn.cursor(), format=format,
+        table=table, sep=sep, inmemory=inmemory)
+    runAnnotator(annotator, vcf + tmpextin, vcf + tmpextout,
+        logcountfile=vcf + '.count.log')
+    dbpool.release(conn)
 
 
-"""Searches Genes Databases and returns Genes/Cytobands 
+"""Overlap with segdup regions genomicSuperDups
+"""
+class GenomicSuperDupsAnnotator(OverlapAnnotator):
+    vectorized = 'first'
+
+    def getSql(self, chr, pos):
+        return 'select * from ' + self.table + ' where chrom="'+ str(chr) + \
+            '" AND (chromStart <= ' + str(pos) + \
+            ' AND ' + str(pos) + ' <= chromEnd);'
+
+    def annotate(self, fields):
+        table = self.table
+        chr, pos = self.getChromPos(fields)
+        rows = self.lookup(chr, pos)
+
+        if rows is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            otherChrom = rows[7]
+            otherStart = rows[8]
+            otherEnd = rows[9]
+            fields.appendInfo(';' + str(table) + '=' + \
+                str(isOverlap) + ';' + 'otherChrom=' + \
+                str(otherChrom) + ';otherStart=' + \
+                str(otherStart) + ';otherEnd=' + str(otherEnd))
+
+        return fields
+
+
+def addOverlapWithGenomicSuperDups(vcf, format='vcf',
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t',
+    inmemory=False):
+
+    conn = dbpool.acquire()
+    annotator = GenomicSuperDupsAnnotator(conn.cursor(), format=format,
+        table=table, sep=sep, inmemory=inmemory)
+    runAnnotator(annotator, vcf + tmpextin, vcf + tmpextout,
+        logcountfile=vcf + '.count.log')
+    dbpool.release(conn)
+
+
+"""Searches Genes Databases and returns Genes/Cytobands
    with which SNP or INDEL overlaps
 """
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+class RefGeneAnnotator(OverlapAnnotator):
+    startcol = 'txStart'
+    endcol = 'txEnd'
     colindex = 1
     colindex2 = 12
     name = 'name'
@@ -1131,273 +1418,172 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     startName = 'txStart'
     endName = 'txEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def annotate(self, fields):
+        chr = fields.chrom
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
+        pos = fields.pos
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        sql = 'select * from ' + self.table + ' where chrom="' + \
+            str(chr) + '" AND (' + self.startName + ' <= ' + str(pos) + \
+            ' AND ' + str(pos) + ' <= ' + self.endName +');'
+        overlapsWith = []
+        rows = self.fetchOverlaps(sql, chr, pos)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                overlapsWith.append(self.name2 + '=' + \
+                    str(row[self.colindex2]) + ';' + self.name + '=' + \
+                    str(row[self.colindex]))
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+            genes = ';'.join([str(x) for x in overlapsWith])
+            fields.addInfo(str(genes))
 
+        return fields
 
-"""Method to find overlap with Cytoband table
-"""
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
+    tmpextin='', tmpextout='.1', sep='\t', inmemory=False):
 
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
+    conn = dbpool.acquire()
+    annotator = RefGeneAnnotator(conn.cursor(), format=format, table=table,
+        sep=sep, inmemory=inmemory)
+    runAnnotator(annotator, vcf + tmpextin, vcf + tmpextout,
+        logcountfile=vcf + '.count.log')
+    dbpool.release(conn)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+"""Method to find overlap with Cytoband table
+"""
+class CytobandAnnotator(OverlapAnnotator):
+    vectorized = 'all'
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    def __init__(self, cursor, format='vcf', table='cytoBand', sep='\t',
+        inmemory=False, snapshot=None, sweep=False):
+        self.colindex = 12
+        self.startName = 'txStart'
+        self.endName = 'txEnd'
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.startName = 'chromStart'
+            self.endName = 'chromEnd'
 
+        self.startcol = self.startName
+        self.endcol = self.endName
+        OverlapAnnotator.__init__(self, cursor, format=format, table=table,
+            sep=sep, inmemory=inmemory, snapshot=snapshot, sweep=sweep)
 
-"""Method to find overlap with CNV tables
-"""
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+    def getSql(self, chr, pos):
+        return 'select * from ' + self.table + ' where chrom="' + \
+            str(chr) + '" AND (' + self.startName + ' <= ' + str(pos) + \
+            ' AND ' + str(pos) + ' <= ' + self.endName + ');'
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def annotate(self, fields):
+        table = self.table
+        chr, pos = self.getChromPos(fields)
+        overlapsWith = []
+        rows = self.lookup(chr, pos)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ';'.join([str(x) for x in overlapsWith])
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+            fields.addInfo(str(table) + '=' + str(cytoband))
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
+        return fields
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
+    tmpextin='', tmpextout='.1', sep='\t', inmemory=False):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    conn = dbpool.acquire()
+    annotator = CytobandAnnotator(conn.cursor(), format=format, table=table,
+        sep=sep, inmemory=inmemory)
+    runAnnotator(annotator, vcf + tmpextin, vcf + tmpextout,
+        logcountfile=vcf + '.count.log')
+    dbpool.release(conn)
 
 
-"""Method to find overlap with targetScanS tables
+"""Method to find overlap with CNV tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class CnvDatabaseAnnotator(OverlapAnnotator):
+    vectorized = 'first'
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def getSql(self, chr, pos):
+        return 'select * from ' + self.table + ' where chrom="' + \
+            str(chr) + '" AND (chromStart <= ' + str(pos) + \
+            ' AND ' + str(pos) + ' <= chromEnd);'
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def annotate(self, fields):
+        table = self.table
+        chr, pos = self.getChromPos(fields)
+        rows = self.lookup(chr, pos)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+        if rows is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            fields.addInfo(str(table) + '=' + str(isOverlap))
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
+        return fields
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
+    tmpextin='', tmpextout='.1', sep='\t', inmemory=False):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    conn = dbpool.acquire()
+    annotator = CnvDatabaseAnnotator(conn.cursor(), format=format,
+        table=table, sep=sep, inmemory=inmemory)
+    runAnnotator(annotator, vcf + tmpextin, vcf + tmpextout,
+        logcountfile=vcf + '.count.log')
+    dbpool.release(conn)
+
+
+"""Method to find overlap with targetScanS tables
+"""
+class MiRNAAnnotator(OverlapAnnotator):
+    vectorized = 'first'
+
+    def getSql(self, chr, pos):
+        return 'select * from ' + self.table + ' where chrom="' + \
+            str(chr) + '" AND (chromStart <= ' + str(pos) + \
+            ' AND ' + str(pos) + ' <= chromEnd);'
+
+    def annotate(self, fields):
+        chr, pos = self.getChromPos(fields)
+        rows = self.lookup(chr, pos)
+
+        if rows is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
+                str(rows[2]) + '_' + str(rows[3])
+            t = 'miRNAsites=' + t.strip()
+            fields.addInfo(t)
+
+        return fields
+
+    def writeLog(self, fh_log):
+        fh_log.write(f"In miRNAsites: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
+
+
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
+    tmpextin='', tmpextout='.1', sep='\t', inmemory=False):
+
+    conn = dbpool.acquire()
+    annotator = MiRNAAnnotator(conn.cursor(), format=format, table=table,
+        sep=sep, inmemory=inmemory)
+    runAnnotator(annotator, vcf + tmpextin, vcf + tmpextout,
+        logcountfile=vcf + '.count.log')
+    dbpool.release(conn)
 
 ### EOF
\ No newline at end of file
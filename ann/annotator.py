@@ -2,175 +2,182 @@ from flask import Flask
 from flask import request
 from flask import jsonify
 from uuid import uuid4
-from subprocess import Popen, PIPE
 from boto3.dynamodb.conditions import Key
 import botocore
 import json 
 import os
+import sys
+import time
+import atexit
 import shutil
 import boto3
 from configparser import ConfigParser
 
+import consumer
+import workers
+
 
 def create_job():
     # Get configuration
     config = ConfigParser()
     config.read('ann_config.ini')
+    region = config['aws']['AwsRegionName']
     
-    # Connect to SQS and get the message queue, and connect to s3
+    # Connect to SQS and get the message queue, and connect to s3; clients
+    # are shared by the threads handling the messages (see consumer.py)
     try:
-        sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
+        sqs = boto3.client('sqs', region_name=region)
         queue_url = config['aws']['SQS_REQUESTS_URL']
-        s3 = boto3.resource('s3')
+        s3 = boto3.client('s3', region_name=region)
     except boto3.exceptions.ResourceNotExistsError as e:
         print(e)
 
-    # connect to dynamoDB
+    table_name = config['aws']['DynamoTableName']
+
+    # jobs run in a pool of long-lived workers (see workers.py), admitted
+    # while the instance has memory and disk to spare
+    pool = workers.WorkerPool(config.getint('ann', 'Workers', fallback=2),
+        maxjobs=config.getint('ann', 'WorkerMaxJobs',
+            fallback=workers.MAXJOBS),
+        timeout=config.getint('ann', 'JobTimeout', fallback=0),
+        minmemory=config.getint('ann', 'MinFreeMemory', fallback=0),
+        mindisk=config.getint('ann', 'MinFreeDisk', fallback=0))
+    atexit.register(pool.close)
+    stream_input = config.getboolean('ann', 'StreamInput', fallback=False)
+
+    def reap():
+        # reap the workers; jobs that timed out or died with their worker
+        # will not complete
+        for filename, reason in pool.poll():
+            fail_job(consumer.getResource('dynamodb', region).Table(
+                table_name), filename)
+
+    # messages are only taken when a worker is free to run them
+    jobs = consumer.QueueConsumer(sqs, queue_url,
+        lambda message: handle_job(message, s3,
+            consumer.getResource('dynamodb', region).Table(table_name),
+            pool, stream_input),
+        threads=config.getint('ann', 'ConsumerThreads',
+            fallback=consumer.THREADS),
+        capacity=pool.available, tick=reap)
+    jobs.run()
+
+def handle_job(message, s3, ann_table, pool, stream_input):
+    '''Hands the job of a request message to the worker pool. Returns True
+    when the message is done with and can be deleted'''
+    # retrieve the info about job
+    try:
+        data = consumer.getNotification(message)
+        job_id = data['job_id']
+        user_id = data['user_id']
+        key = data['s3_key_input_file']
+        bucket = data['s3_inputs_bucket']
+        submit_time = data['submit_time']
+        input_file = data['input_file_name']
+    except json.JSONDecodeError:
+        print('Error: Input is not valid json format')
+        return True
+    except KeyError:
+        print("Error: Input doesn't have corresponding key")
+        return True
+
+    # validate the type of the file
+    if not input_file.endswith(('.vcf', '.vcf.gz', '.pileup',
+        '.pileup.gz')):
+        print("The uploaded file should be .vcf, .vcf.gz, .pileup " +
+            "or .pileup.gz")
+        return True
+
+    # claim the job by updating its job_status in dynamoDB, before its
+    # input is touched: a message delivered again for a job that is no
+    # longer PENDING is only deleted
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.update_item
     try:
-        dynamodb = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
-        table_name = config['aws']['DynamoTableName']
-        ann_table = dynamodb.Table(table_name)
-    except boto3.exceptioƒns.ResourceNotExistsError as e:
-        print("ResourceNotExistsError")
+        response = ann_table.update_item(
+            Key={
+                'job_id': job_id
+                },
+            UpdateExpression="set job_status = :r",
+            ExpressionAttributeValues={
+                ':r': "RUNNING",
+                ':p': "PENDING"
+            },
+            ConditionExpression=" job_status = :p",
+            ReturnValues="UPDATED_NEW"
+
+        )
     except botocore.exceptions.ClientError as e:
-        print("ClientError")
-
-    while True:
-        # long polling the messages with wait time seconds set to 20s
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.receive_message
-        try:
-            job_response = sqs.receive_message(
-                QueueUrl=queue_url,
-                AttributeNames=[
-                    'SentTimestamp'
-                ],
-                MaxNumberOfMessages=5,
-                WaitTimeSeconds=20
-            )
-        except botocore.errorfactory.QueueDoesNotExist as e:
-            print(e)
-            continue
-
-        # if no messaged obtained
-        try:
-            messages = job_response['Messages']
-        except KeyError:
-            continue
-
-        if len(messages)==0:
-            continue
-
-        # retrieve the info about job
-        for message in messages:
-            try:
-                content = message['Body']
-                receipt_handle = message['ReceiptHandle']
-                body = json.loads(content)
-                data = json.loads(body['Message'])
-                job_id = data['job_id']
-                user_id = data['user_id']
-                key = data['s3_key_input_file']
-                bucket = data['s3_inputs_bucket']
-                submit_time = data['submit_time']
-                input_file = data['input_file_name']
-            except json.JSONDecodeError:
-                print('Error: Input is not valid json format')
-                delete_message(sqs, queue_url, receipt_handle)
-                continue
-            except KeyError:
-                print("Error: Input doesn't have corresponding key")
-                delete_message(sqs, queue_url, receipt_handle)
-                continue
-
-            
-            # prepare the file directory for the job
-            if not os.path.isdir("./{}/".format(user_id)):
-                os.mkdir("./{}/".format(user_id))
-
-            dst = './{}/{}/'.format(user_id,job_id)
-
-            try:
-                os.mkdir(dst)
-            except FileExistsError as e:
-                delete_message(sqs, queue_url, receipt_handle)
-                print(e)
-
-            try:
-                folder = s3.Bucket(bucket)
-            except botocore.errorfactory.NoSuchBucket as e:
-                print(e.response['Error']['Message'])
-                delete_message(sqs, queue_url, receipt_handle)
-                continue
-
-            # validate the type of the file
-            if not input_file.endswith('.vcf'):
-                print("The uploaded file should be .vcf")
-                delete_message(sqs, queue_url, receipt_handle)
-                continue
-                
-            filename = dst+job_id+"~"+input_file
-
-            # Get the input file S3 object and copy it to a local file
-            # https://boto3.amazonaws.com/v1/documentation/api/1.9.42/guide/s3-example-download-file.html 
-            try:
-                s3.Bucket(bucket).download_file(key, filename)
-            except botocore.exceptions.ClientError as e:
-                print("An error occurred (403) when downloading {}".format(key))
-                delete_message(sqs, queue_url, receipt_handle)
-                continue
-            except FileNotFoundError as e:
-                print(e)
-                delete_message(sqs, queue_url, receipt_handle)
-                continue
-
-            # Launch annotation job as a background process
-            # https://docs.python.org/3/library/subprocess.html#popen-constructor
-            try:           
-                execFile = "./run.py"
-                job = Popen(["python", execFile, filename])
-            except (FileNotFoundError, ValueError, OSError) as e:
-                print(e)
-                delete_message(sqs, queue_url, receipt_handle)
-                continue
-            except:
-                print("Unexpected Error", sys.exc_info()[0])
-                delete_message(sqs, queue_url, receipt_handle)
-                continue
-
-            # update the job_status in dynamoDB    
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.update_item
-            try:
-                response = ann_table.update_item(
-                    Key={
-                        'job_id': job_id
-                        },
-                    UpdateExpression="set job_status = :r",
-                    ExpressionAttributeValues={
-                        ':r': "RUNNING",
-                        ':p': "PENDING"
-                    },
-                    ConditionExpression=" job_status = :p",
-                    ReturnValues="UPDATED_NEW"
-
-                )
-            except (botocore.errorfactory.ConditionalCheckFailedException,botocore.exceptions.ClientError) as e:
-                print(e.response['Error']['Message'])
-                delete_message(sqs, queue_url, receipt_handle)
-                continue
-            except:
-                print('Unexpected Error'+sys.exc_info()[0])
-                delete_message(sqs, queue_url, receipt_handle)
-                continue
-
-            delete_message(sqs, queue_url, receipt_handle)
-
-def delete_message(sqs, queue_url, receipt_handle):
-    # delete the message
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.delete_message
-    dele_rsp = sqs.delete_message(
-        QueueUrl = queue_url,
-        ReceiptHandle = receipt_handle
-    )           
+        print(e.response['Error']['Message'])
+        # the job is not claimed; try again unless it is no longer PENDING
+        return (e.response['Error']['Code'] ==
+            'ConditionalCheckFailedException')
+
+    # prepare the file directory for the job
+    os.makedirs("./{}/".format(user_id), exist_ok=True)
+
+    dst = './{}/{}/'.format(user_id,job_id)
+
+    try:
+        os.mkdir(dst)
+    except FileExistsError as e:
+        print(e)
+
+    filename = dst+job_id+"~"+input_file
+
+    # a streamed input is read from S3 by the job as it is
+    # annotated (see s3stream.py)
+    source = (bucket, key) if stream_input else None
+
+    # Get the input file S3 object and copy it to a local file, and hand
+    # the annotation job to the worker pool; a job that cannot be run is
+    # failed, as it is RUNNING now
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.download_file
+    try:
+        if source is None:
+            s3.download_file(bucket, key, filename)
+        pool.submit(filename, source)
+    except botocore.exceptions.ClientError as e:
+        print("An error occurred ({}) when downloading {}".format(
+            e.response['Error']['Code'], key))
+        fail_job(ann_table, filename)
+    except (ValueError, OSError) as e:
+        print(e)
+        fail_job(ann_table, filename)
+    except:
+        print("Unexpected Error", sys.exc_info()[0])
+        fail_job(ann_table, filename)
+
+    return True
+
+def fail_job(ann_table, filename):
+    # the input file is ./<user_id>/<job_id>/<job_id>~<input_file>
+    try:
+        user_id = filename.split("/")[1]
+        job_id = filename.split("/")[2]
+    except IndexError as e:
+        print(e)
+        return
+
+    # update the job_status to error
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.update_item
+    try:
+        ann_table.update_item(
+            Key={
+                'job_id': job_id
+                },
+            UpdateExpression="set job_status = :e",
+            ExpressionAttributeValues={
+                ':e': "ERROR",
+                ':r': "RUNNING"
+            },
+            ConditionExpression=" job_status = :r",
+            ReturnValues="UPDATED_NEW"
+        )
+    except botocore.exceptions.ClientError as e:
+        print(e.response['Error']['Message'])
+
+    # free the disk the job used
+    shutil.rmtree("./{}/{}".format(user_id, job_id), ignore_errors=True)
 
 def main():
     create_job()
@@ -0,0 +1,620 @@
+# benchmark.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Offline benchmark of the annotation pipeline. Builds a synthetic
+# reference database (SQLite, same tables and columns as the annotator
+# database), generates synthetic VCFs, runs driver.run() under a set of
+# configurations and reports the wall time of every run and every stage
+#
+# The output of every configuration is checked against that of the
+# original chain of stages (driver.run_staged()): the annotated VCF and the
+# count log must be identical. The benchmark exits with status 1 if one
+# is not.
+#
+# No AWS access is needed: the reference database is a local SQLite file,
+# used through the SQLite backend of refdb.py.
+#
+# Usage: python benchmark.py [--records N] [--chroms 1:4,2,X] [--density D]
+#            [--configs fused,inmemory,sweep] [--baseline old.json]
+#            [--nocheck] ...
+#        python benchmark.py --help
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import platform
+import statistics
+
+import annotate as ann
+import bgzf
+import dbpool
+import driver
+import intervals
+import refdb
+import snapshot
+
+CHROMS = snapshot.CHROMS
+BASES = 'ACGT'
+
+"""Reference sites per chromosome for every 200kb of span; dbSNP and the
+   BigRefGene tables are filled from these, so variants drawn from them
+   are known variants
+"""
+SITES = 3000
+SITESPAN = 200000
+
+"""Version of the databases makeReference() builds, in their file names;
+   changed with makeReference(), so that older ones are not reused
+"""
+REFERENCEVERSION = 2
+
+"""Configurations that can be benchmarked: name -> driver.run() options
+   'snapshot' runs from a snapshot of the reference database, exported
+   once into the work directory. 'cached' runs with an annotation cache
+   warmed up by an untimed run over another VCF drawn the same way, as
+   if an earlier job had submitted it
+"""
+CONFIGS = {
+    'staged': {'fused': False},
+    'fused': {'inmemory': False, 'sweep': False},
+    'inmemory': {'sweep': False},
+    'sweep': {},
+    'snapshot': {'snapshot_dir': True},
+    'threads': {'threads': 4},
+    'processes': {'processes': 4},
+    'compressed': {'compress': True},
+    'cached': {'cache_file': True},
+}
+DEFAULT_CONFIGS = 'fused,inmemory,sweep'
+
+BIGREFGENE_COLUMNS = ['haplotypeReference', 'haplotypeAlternate', 'name',
+    'name2', 'transcriptStrand', 'positionType', 'frame', 'mrnaCoord',
+    'codonCoord', 'spliceDist', 'referenceCodon', 'referenceAA',
+    'variantCodon', 'variantAA', 'changesAA', 'functionalClass',
+    'codingCoordStr', 'proteinCoordStr', 'inCodingRegion', 'spliceInfo',
+    'uorfChange']
+
+CNV_TABLES = ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+    'conrad_Cnv']
+
+
+"""Creates the reference tables
+"""
+def createSchema(conn):
+    conn.execute('create table dbSNP (CHR, POS integer, dbSNPID, RSID, '
+        'REF, ALT, QUAL, GMAF, INFO)')
+    for table in ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+        'chrom_pos_unequal']:
+        conn.execute('create table ' + table + ' (id integer, CHR, '
+            'start integer, end integer, ' + ', '.join(BIGREFGENE_COLUMNS) +
+            ')')
+    conn.execute('create table refGene (bin, name, chrom, strand, '
+        'txStart integer, txEnd integer, cdsStart integer, cdsEnd integer, '
+        'exonCount integer, exonStarts blob, exonEnds blob, score, name2, '
+        'cdsStartStat, cdsEndStat, exonFrames)')
+    conn.execute('create table cpgIslandExt (chrom, chromStart integer, '
+        'chromEnd integer, name)')
+    conn.execute('create table cytoBand (chrom, chromStart integer, '
+        'chromEnd integer, name, gieStain)')
+    conn.execute('create table gadAll (chromosome, chromStart integer, '
+        'chromEnd integer, geneSymbol)')
+    conn.execute('create table gwasCatalog (bin, chrom, chromStart integer, '
+        'chromEnd integer, name, pubMedID, author, pubDate, journal, title, '
+        'trait)')
+    conn.execute('create table targetScanS (bin, chrom, chromStart integer, '
+        'chromEnd integer, name, score, strand)')
+    conn.execute('create table hugo (chrom, chromStart integer, '
+        'chromEnd integer, hgncId, status, symbol, description)')
+    for table in CNV_TABLES:
+        conn.execute('create table ' + table + ' (chrom, '
+            'chromStart integer, chromEnd integer, name)')
+    conn.execute('create table genomicSuperDups (bin, chrom, '
+        'chromStart integer, chromEnd integer, name, score, strand, '
+        'otherChrom, otherStart integer, otherEnd integer)')
+    for c in CHROMS:
+        conn.execute('create table tfbsConsSites' + c + ' (chrom, '
+            'chromStart integer, chromEnd integer, name)')
+
+
+"""Builds a synthetic reference database at path; the same seed and span
+   always give the same database. span is the length of every chromosome
+"""
+def makeReference(path, seed=1, span=SITESPAN):
+    rnd = random.Random(seed)
+    scale = max(1, span // SITESPAN)
+
+    def positions(n):
+        return sorted(rnd.randint(1, span) for i in range(n * scale))
+
+    def bigRefGeneRow(table, chrom, start, end, ref, alt):
+        values = [rnd.choice(['', '0', 'x' + str(rnd.randint(1, 5))])
+            for c in BIGREFGENE_COLUMNS[2:]]
+        values[0] = 'NM_' + str(rnd.randint(1, 999))
+        values[3] = rnd.choice(['CDS', 'intron', 'utr3', 'utr5',
+            'non_coding_exon'])
+        conn.execute('insert into ' + table + ' values (' +
+            ', '.join(['?'] * (len(BIGREFGENE_COLUMNS) + 4)) + ')',
+            [0, chrom, start, end, ref, alt] + values)
+
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    createSchema(conn)
+
+    for c in CHROMS:
+        chrom = 'chr' + c
+        sites = positions(SITES)
+        for pos in sites[::3]:
+            for i in range(rnd.choice([1, 1, 2])):
+                conn.execute('insert into dbSNP values (?, ?, ?, ?, ?, ?, ?, '
+                    '?, ?)', (c, pos, 'x', 'rs' + str(rnd.randint(1, 10**7)),
+                    rnd.choice(BASES), rnd.choice(BASES), '.',
+                    rnd.choice(['.', '0.0' + str(rnd.randint(1, 9))]),
+                    rnd.choice(['SNV', 'SNV', 'DIV'])))
+        for pos in sites[1::5]:
+            bigRefGeneRow('chrom_pos_equal_base', c, pos, pos,
+                rnd.choice(BASES), rnd.choice(BASES))
+            if (rnd.random() < 0.3):
+                bigRefGeneRow('chrom_pos_equal_base', c, pos, pos,
+                    rnd.choice(BASES), rnd.choice(BASES))
+        for pos in sites[2::5]:
+            bigRefGeneRow('chrom_pos_equal_nobase', c, pos, pos, '', '')
+        for pos in positions(100):
+            bigRefGeneRow('chrom_pos_unequal', c, pos,
+                pos + rnd.randint(0, 500), '', '')
+
+        for i in range(40 * scale):
+            txstart = rnd.randint(1, span)
+            txend = txstart + rnd.randint(500, 20000)
+            cdsstart = txstart + rnd.randint(0, 300)
+            cdsend = rnd.choice([cdsstart,
+                min(txend, cdsstart + rnd.randint(100, 5000))])
+            n = rnd.randint(1, 12)
+            exons = sorted(rnd.sample(range(txstart, txend), 2 * n))
+            starts = ''.join([str(e) + ',' for e in exons[0::2]])
+            ends = ''.join([str(e) + ',' for e in exons[1::2]])
+            conn.execute('insert into refGene values (?, ?, ?, ?, ?, ?, ?, '
+                '?, ?, ?, ?, ?, ?, ?, ?, ?)', (0, 'NM_' + c + '_' + str(i),
+                chrom, rnd.choice('+-'), txstart, txend, cdsstart, cdsend, n,
+                starts.encode(), ends.encode(), 0, 'GENE' + str(i), 'cmpl',
+                'cmpl', ''))
+
+        for start in positions(80):
+            conn.execute('insert into cpgIslandExt values (?, ?, ?, ?)',
+                (chrom, start, start + rnd.randint(100, 2000),
+                'CpG: ' + str(rnd.randint(1, 99))))
+        start = 0
+        while (start < span):
+            end = start + rnd.randint(5000, 30000)
+            conn.execute('insert into cytoBand values (?, ?, ?, ?, ?)',
+                (chrom, start, end, 'p' + str(start // 1000), 'gneg'))
+            start = end
+        for start in positions(60):
+            conn.execute('insert into gadAll values (?, ?, ?, ?)',
+                (c, start, start + rnd.randint(1, 5000),
+                rnd.choice(['BRCA1', 'TP53', 'EGFR'])))
+        for pos in sites[4::15]:
+            conn.execute('insert into gwasCatalog values (?, ?, ?, ?, ?, ?, '
+                '?, ?, ?, ?, ?)', (0, chrom, pos - 1, pos, 'rs1',
+                str(rnd.randint(1, 99999)), 'a', 'd', 'j', 't',
+                rnd.choice(['Height', 'BMI trait'])))
+        for start in positions(200):
+            conn.execute('insert into targetScanS values (?, ?, ?, ?, ?, ?, '
+                '?)', (0, chrom, start, start + rnd.randint(5, 300),
+                'miR-' + str(rnd.randint(1, 50)), 1, '+'))
+        for start in positions(40):
+            conn.execute('insert into hugo values (?, ?, ?, ?, ?, ?, ?)',
+                (chrom, start, start + rnd.randint(100, 9000), 0, 0,
+                'SYM' + str(rnd.randint(1, 9)), 'desc; with semi'))
+        for table in CNV_TABLES:
+            for start in positions(30):
+                conn.execute('insert into ' + table + ' values (?, ?, ?, ?)',
+                    (chrom, start, start + rnd.randint(100, 8000), 'cnv'))
+        for start in positions(30):
+            conn.execute('insert into genomicSuperDups values (?, ?, ?, ?, '
+                '?, ?, ?, ?, ?, ?)', (0, chrom, start,
+                start + rnd.randint(1000, 9000), 'sd', 0, '+',
+                'chr' + rnd.choice(CHROMS), rnd.randint(1, span),
+                rnd.randint(1, span)))
+        for start in positions(300):
+            conn.execute('insert into tfbsConsSites' + c + ' values (?, ?, '
+                '?, ?)', (chrom, start, start + rnd.randint(5, 40),
+                'V$TF' + str(rnd.randint(1, 9))))
+
+    conn.commit()
+    sortTables(conn)
+    refdb.createIndexes(conn)
+    conn.close()
+
+
+"""Stores the rows of every reference table in the order of the index
+   refdb.createIndexes() creates on it, as the UCSC tables are stored by
+   position. Overlap stages take the first row overlapping a position;
+   SQLite returns the rows of a lookup through the index in index order,
+   the in-memory indexes return them in table order, and the two only
+   agree where they are the same
+"""
+def sortTables(conn):
+    existing = set([row[0].lower() for row in conn.execute(
+        "select name from sqlite_master where type = 'table'")])
+    for table, (columns, chromcol, startcol, endcol) in \
+        snapshot.TABLES.items():
+        if (table.lower() not in existing):
+            continue
+        keys = refdb.getIndexKeys(chromcol, startcol, endcol)
+        rows = conn.execute('select * from ' + table + ' order by ' +
+            ', '.join(keys + ['rowid'])).fetchall()
+        if (len(rows) == 0):
+            continue
+        conn.execute('delete from ' + table)
+        conn.executemany('insert into ' + table + ' values (' +
+            ', '.join(['?'] * len(rows[0])) + ')', rows)
+    conn.commit()
+
+
+"""Returns {chromosome: sorted (position, ref, alt)} of the known variants
+   of the reference database (dbSNP and BigRefGene); ref and alt are None
+   where the database has no alleles
+"""
+def getKnownSites(dbpath):
+    conn = sqlite3.connect(dbpath)
+    sites = {}
+    for sql in ['select CHR, POS, REF, ALT from dbSNP',
+        'select CHR, start, haplotypeReference, haplotypeAlternate from ' +
+            'chrom_pos_equal_base',
+        'select CHR, start, null, null from chrom_pos_equal_nobase']:
+        for chrom, pos, ref, alt in conn.execute(sql):
+            sites.setdefault(chrom, set()).add((pos, ref, alt))
+    conn.close()
+    return dict([(c, sorted(s, key=lambda v: (v[0], str(v[1]), str(v[2]))))
+        for c, s in sites.items()])
+
+
+"""Parses a chromosome mix: a comma separated list of chromosomes, each
+   with an optional relative weight (1:4,2,X:0.5). Returns [(chrom, weight)]
+"""
+def parseChroms(spec):
+    if (spec is None or spec == 'all'):
+        return [(c, 1.0) for c in CHROMS]
+    mix = []
+    for item in spec.split(','):
+        chrom, sep, weight = item.strip().partition(':')
+        chrom = chrom[3:] if chrom.startswith('chr') else chrom
+        if chrom not in CHROMS:
+            raise ValueError(f"Unknown chromosome {chrom} in {spec}")
+        mix.append((chrom, float(weight) if sep else 1.0))
+    return mix
+
+
+"""Writes a synthetic VCF of records variants to path
+   chroms is a chromosome mix (see parseChroms()). density is the number of
+   variants per kb of every chromosome, so it sets how much of the
+   chromosome the variants spread over. A fraction known of the variants
+   are known variants of the reference database, and a fraction prefixed
+   of the records names the chromosome 'chrN' rather than 'N'. Records are
+   sorted by position unless shuffle is set
+"""
+def makeVcf(path, dbpath, records, chroms=None, density=10.0, known=0.6,
+    prefixed=0.0, shuffle=False, seed=1, span=SITESPAN):
+    rnd = random.Random(seed)
+    mix = parseChroms(chroms)
+    sites = getKnownSites(dbpath)
+
+    names = [c for c, w in mix]
+    picks = rnd.choices(names, weights=[w for c, w in mix], k=records)
+    variants = []
+    for chrom in names:
+        n = picks.count(chrom)
+        if (n == 0):
+            continue
+        window = max(1, min(span, int(n * 1000 / density)))
+        pool = [v for v in sites.get(chrom, []) if (v[0] <= window)]
+        for i in range(n):
+            if (len(pool) > 0 and rnd.random() < known):
+                pos, ref, alt = rnd.choice(pool)
+            else:
+                pos, ref, alt = (rnd.randint(1, window), None, None)
+            variants.append((CHROMS.index(chrom), pos, chrom,
+                ref or rnd.choice(BASES), alt or rnd.choice(BASES)))
+    if shuffle:
+        rnd.shuffle(variants)
+    else:
+        variants.sort()
+
+    fh = open(path, 'w')
+    fh.write('##fileformat=VCFv4.1\n##source=benchmark.py\n')
+    fh.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n')
+    for order, pos, chrom, ref, alt in variants:
+        if (rnd.random() < prefixed):
+            chrom = 'chr' + chrom
+        fh.write('\t'.join([chrom, str(pos), rnd.choice(['.', 'rs5']),
+            ref, alt, '50', 'PASS', rnd.choice(['.', 'DP=10', 'AF=0.5;DP=3']),
+            'GT', '0/1']) + '\n')
+    fh.close()
+
+
+"""Points the reference database of this process (and of its worker
+   processes) at the SQLite database dbpath
+"""
+def useReference(dbpath):
+    refdb.configure(dbpath)
+    dbpool.closeAll()
+
+
+"""Drops what a process keeps between jobs, so that every run starts as a
+   fresh run.py process does
+"""
+def resetCaches():
+    ann._models.clear()
+    intervals._indexes.clear()
+    dbpool.closeAll()
+
+
+"""SHA-256 digests of the output of a run that every configuration must
+   reproduce: the annotated VCF, decompressed, and the count log
+"""
+def getOutputDigests(infile, compress=None):
+    annotfile, logfile = driver.getOutputFiles(infile, compress)
+    digests = {}
+    for name, path in [('annot', annotfile), ('log', logfile)]:
+        digest = hashlib.sha256()
+        fh = bgzf.openVcf(path)
+        for line in fh:
+            digest.update(line.encode('utf-8'))
+        fh.close()
+        digests[name] = digest.hexdigest()
+    return digests
+
+
+"""Runs driver.run() over a fresh copy of vcf in rundir, with its output
+   silenced. Returns the wall time, the profile and the output digests
+   (see getOutputDigests()) of the run
+"""
+def runOnce(vcf, rundir, options):
+    if os.path.exists(rundir):
+        shutil.rmtree(rundir)
+    os.makedirs(rundir)
+    infile = os.path.join(rundir, os.path.basename(vcf))
+    shutil.copy(vcf, infile)
+
+    resetCaches()
+    devnull = open(os.devnull, 'w')
+    stdout = sys.stdout
+    sys.stdout = devnull
+    try:
+        start = time.perf_counter()
+        driver.run(infile, 'vcf', **options)
+        wall = time.perf_counter() - start
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+
+    profile = {}
+    if os.path.exists(driver.getProfileFile(infile)):
+        profile = json.load(open(driver.getProfileFile(infile)))
+    return wall, profile, getOutputDigests(infile, options.get('compress'))
+
+
+"""Runs one configuration over vcf repeat times, each in a fresh copy under
+   workdir, after a run over warmup if given. Returns the result of the
+   configuration for the report
+"""
+def runConfig(name, options, vcf, workdir, repeat=1, warmup=None):
+    rundir = os.path.join(workdir, name)
+    if (warmup is not None):
+        runOnce(warmup, rundir, options)
+
+    walls = []
+    best = None
+    digests = []
+    for i in range(repeat):
+        wall, profile, output = runOnce(vcf, rundir, options)
+        walls.append(wall)
+        if (output not in digests):
+            digests.append(output)
+        if (best is None or wall < best[0]):
+            best = (wall, profile)
+
+    result = {
+        'config': name,
+        'options': dict([(k, (True if k.endswith(('_dir', '_file')) else v))
+            for k, v in options.items()]),
+        'wall_seconds': [round(w, 6) for w in walls],
+        'best_seconds': round(best[0], 6),
+        'median_seconds': round(statistics.median(walls), 6),
+        'stages': best[1].get('stages', []),
+        'outputs': digests,
+    }
+    if ('cache' in best[1]):
+        result['cache'] = best[1]['cache']
+    return result
+
+
+"""Prints a report as a table of configurations and of the stages of
+   every configuration; with a baseline report, also the speedup of
+   every configuration and stage found in both
+"""
+def printReport(report, baseline=None):
+    records = report['dataset']['records']
+    old = {}
+    if baseline:
+        old = dict([(r['config'], r) for r in baseline['runs']])
+
+    print(f"{records} records, {report['dataset']['chroms']} "
+        f"(density {report['dataset']['density']}/kb, "
+        f"known {report['dataset']['known']}, "
+        f"{'unsorted' if report['dataset']['shuffle'] else 'sorted'})")
+    for run in report['runs']:
+        line = f"{run['config']:<12} {run['best_seconds']:>9.3f}s " + \
+            f"{records / run['best_seconds']:>10.1f} variants/s"
+        if run['config'] in old:
+            line = line + '  ' + \
+                speedup(old[run['config']]['best_seconds'], run['best_seconds'])
+        if ('cache' in run):
+            line = line + f"  cache hit rate {run['cache']['hit_rate']}"
+        print(line)
+
+    for run in report['runs']:
+        if (len(run['stages']) == 0):
+            continue
+        print(f"\n{run['config']:<48} {'wall':>9} {'queries':>9}")
+        before = {}
+        if run['config'] in old:
+            before = dict([(s['stage'], s) for s in old[run['config']]['stages']])
+        for stage in run['stages']:
+            line = f"  {stage['stage']:<46} {stage['wall_seconds']:>8.3f}s" + \
+                f" {stage['queries']:>9}"
+            if stage['stage'] in before:
+                line = line + '  ' + \
+                    speedup(before[stage['stage']]['wall_seconds'],
+                        stage['wall_seconds'])
+            print(line)
+
+
+"""Names of the configurations of report whose output (of any of their
+   runs) differs from reference, the output digests of the original chain
+   of stages
+"""
+def checkOutputs(report, reference):
+    mismatches = []
+    for run in report['runs']:
+        if (run['outputs'] != [reference]):
+            mismatches.append(run['config'])
+    return mismatches
+
+
+def speedup(before, after):
+    if (after <= 0):
+        return ''
+    return f"x{before / after:.2f} vs baseline"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of "
+        "the annotation pipeline against a synthetic reference database")
+    parser.add_argument('--workdir', default='benchmark',
+        help="directory for the reference database, inputs and outputs")
+    parser.add_argument('--records', type=int, default=20000,
+        help="variants in the synthetic VCF")
+    parser.add_argument('--chroms', default='all',
+        help="chromosome mix, e.g. 1:4,2,X:0.5 (default all, equally)")
+    parser.add_argument('--density', type=float, default=10.0,
+        help="variants per kb of every chromosome")
+    parser.add_argument('--known', type=float, default=0.6,
+        help="fraction of variants at known (dbSNP) sites")
+    parser.add_argument('--prefixed', type=float, default=0.0,
+        help="fraction of records naming chromosomes chrN")
+    parser.add_argument('--unsorted', action='store_true',
+        help="shuffle the records instead of sorting them by position")
+    parser.add_argument('--span', type=int, default=SITESPAN,
+        help="length of every chromosome of the reference database")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--configs', default=DEFAULT_CONFIGS,
+        help="comma separated, from: " + ', '.join(CONFIGS))
+    parser.add_argument('--repeat', type=int, default=1,
+        help="runs of every configuration; the best is reported")
+    parser.add_argument('--output', default=None,
+        help="JSON report (default <workdir>/report.json)")
+    parser.add_argument('--baseline', default=None,
+        help="earlier JSON report to compare with")
+    parser.add_argument('--nocheck', action='store_true',
+        help="do not check the output of the configurations against that "
+            "of the original chain of stages")
+    args = parser.parse_args(argv)
+
+    configs = args.configs.split(',')
+    for name in configs:
+        if name not in CONFIGS:
+            parser.error(f"unknown configuration {name}")
+
+    os.makedirs(args.workdir, exist_ok=True)
+    dbpath = os.path.join(args.workdir,
+        f"reference-{args.seed}-{args.span}-{REFERENCEVERSION}.db")
+    if not os.path.exists(dbpath):
+        print(f"Building reference database {dbpath} . . .")
+        makeReference(dbpath, args.seed, args.span)
+    useReference(dbpath)
+
+    vcf = os.path.join(args.workdir, 'input.vcf')
+    makeVcf(vcf, dbpath, args.records, args.chroms, args.density, args.known,
+        args.prefixed, args.unsorted, args.seed, args.span)
+
+    snapdir = os.path.join(args.workdir,
+        f"snapshot-{args.seed}-{args.span}-{REFERENCEVERSION}")
+    if ('snapshot' in configs and not os.path.exists(snapdir)):
+        print(f"Exporting snapshot {snapdir} . . .")
+        conn = refdb.connect()
+        snapshot.exportSnapshot(conn.cursor(), snapdir)
+        conn.close()
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'dataset': {'records': args.records, 'chroms': args.chroms,
+            'density': args.density, 'known': args.known,
+            'prefixed': args.prefixed, 'shuffle': args.unsorted,
+            'span': args.span, 'seed': args.seed},
+        'runs': [],
+    }
+    if not args.nocheck:
+        print("Running the original chain of stages for reference . . .")
+        wall, profile, reference = runOnce(vcf,
+            os.path.join(args.workdir, 'reference'), CONFIGS['staged'])
+        report['reference_outputs'] = reference
+    for name in configs:
+        print(f"Running {name} . . .")
+        options = dict(CONFIGS[name])
+        warmup = None
+        if ('snapshot_dir' in options):
+            options['snapshot_dir'] = snapdir
+        if ('cache_file' in options):
+            options['cache_file'] = os.path.join(args.workdir, 'cache.db')
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(options['cache_file'] + suffix):
+                    os.remove(options['cache_file'] + suffix)
+            warmup = os.path.join(args.workdir, 'warmup.vcf')
+            makeVcf(warmup, dbpath, args.records, args.chroms, args.density,
+                args.known, args.prefixed, args.unsorted, args.seed + 1,
+                args.span)
+        report['runs'].append(runConfig(name, options, vcf, args.workdir,
+            args.repeat, warmup))
+    resetCaches()
+
+    output = args.output or os.path.join(args.workdir, 'report.json')
+    fh = open(output, 'w')
+    json.dump(report, fh, indent=1)
+    fh.close()
+
+    baseline = json.load(open(args.baseline)) if args.baseline else None
+    print()
+    printReport(report, baseline)
+    print(f"\nReport written to {output}")
+
+    if not args.nocheck:
+        mismatches = checkOutputs(report, reference)
+        if (len(mismatches) > 0):
+            print("Output differs from the original chain of stages: " +
+                ', '.join(mismatches))
+            return 1
+        print("Output of every configuration identical to the original "
+            "chain of stages")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+### EOF
@@ -0,0 +1,112 @@
+# bgzf.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Reading and writing of gzip and BGZF (blocked gzip, as made by bgzip)
+# compressed VCF files
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import gzip
+import zlib
+import struct
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+"""Uncompressed bytes per BGZF block; keeps every compressed block below
+   the 64KB that its size field can describe
+"""
+BLOCKSIZE = 0xff00
+
+# gzip member header with the 'BC' extra subfield holding the block size
+HEADER = struct.Struct('<4BI2BH2BHH')
+FOOTER = struct.Struct('<II')
+EOF_BLOCK = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+"""Writes text to a BGZF file. The output is a series of gzip members that
+   any gzip reader decompresses as one stream, and that bgzip/tabix can
+   seek into. path may also be a binary file object, closed with the writer
+"""
+class BgzfWriter(object):
+
+    def __init__(self, path, level=6, encoding='utf-8'):
+        self.fh = open(path, 'wb') if isinstance(path, str) else path
+        self.level = level
+        self.encoding = encoding
+        self.buffer = bytearray()
+
+    def write(self, text):
+        self.buffer.extend(text.encode(self.encoding))
+        while (len(self.buffer) >= BLOCKSIZE):
+            self.writeBlock(bytes(self.buffer[:BLOCKSIZE]))
+            del self.buffer[:BLOCKSIZE]
+
+    def writeBlock(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        payload = compressor.compress(data) + compressor.flush()
+        bsize = HEADER.size + len(payload) + FOOTER.size
+        self.fh.write(HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+            ord('B'), ord('C'), 2, bsize - 1))
+        self.fh.write(payload)
+        self.fh.write(FOOTER.pack(zlib.crc32(data) & 0xffffffff,
+            len(data) & 0xffffffff))
+
+    def close(self):
+        if (len(self.buffer) > 0):
+            self.writeBlock(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.fh.write(EOF_BLOCK)
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+"""True if path starts with the gzip magic number
+"""
+def isCompressed(path):
+    fh = open(path, 'rb')
+    magic = fh.read(2)
+    fh.close()
+    return (magic == GZIP_MAGIC)
+
+
+"""Opens a binary file object (e.g. an s3stream.S3Reader) as text; gzip
+   and BGZF content is recognised and decompressed as it is read
+"""
+def openStream(fileobj):
+    fh = io.BufferedReader(fileobj, BLOCKSIZE)
+    if (fh.peek(2)[:2] == GZIP_MAGIC):
+        return gzip.open(fh, 'rt')
+    return io.TextIOWrapper(fh)
+
+
+"""Opens a VCF as text. For reading, gzip and BGZF input is recognised by
+   its content and decompressed as it is read; for writing, a path ending
+   in .gz is written as BGZF. path may also be a binary file object with
+   the name of the file it stands for (see openStream())
+"""
+def openVcf(path, mode='r'):
+    if not isinstance(path, str):
+        if mode.startswith('r'):
+            return openStream(path)
+        if path.name.endswith('.gz'):
+            return BgzfWriter(path)
+        return io.TextIOWrapper(io.BufferedWriter(path, BLOCKSIZE))
+    if mode.startswith('r'):
+        if isCompressed(path):
+            return gzip.open(path, 'rt')
+        return open(path)
+    if path.endswith('.gz'):
+        return BgzfWriter(path)
+    return open(path, mode)
+
+### EOF
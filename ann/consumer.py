@@ -0,0 +1 @@
+../util/consumer.py
\ No newline at end of file
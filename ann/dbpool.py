@@ -0,0 +1,99 @@
+# dbpool.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Pool of connections to the reference database, shared by all annotation
+# stages and all jobs run in the same process
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import queue
+import threading
+
+import refdb
+
+"""Number of idle connections kept open; connections released beyond this
+   are closed
+"""
+POOLSIZE = 4
+
+_idle = queue.LifoQueue()
+_lock = threading.Lock()
+
+"""Returns True if conn still answers a query
+"""
+def isHealthy(conn):
+    try:
+        cursor = conn.cursor()
+        cursor.execute('select 1;')
+        cursor.fetchall()
+        cursor.close()
+        return True
+    except Exception:
+        return False
+
+
+"""Returns a connection from the pool, or a new one from the configured
+   backend (see refdb.py) if none is idle
+   Idle connections are health-checked before being handed out; dead ones
+   (timed out, RDS failover) are closed and replaced
+"""
+def acquire():
+    while True:
+        try:
+            conn = _idle.get_nowait()
+        except queue.Empty:
+            return refdb.connect()
+        if isHealthy(conn):
+            return conn
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+"""Returns a connection to the pool. The open transaction is rolled back
+   so the next user does not read through a stale snapshot
+"""
+def release(conn):
+    try:
+        conn.rollback()
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return
+
+    with _lock:
+        if (_idle.qsize() < POOLSIZE):
+            _idle.put(conn)
+            return
+    conn.close()
+
+
+"""Drops the idle connections inherited from a parent process without
+   closing them, since closing would end the parent's sessions. Called
+   first thing in forked workers
+"""
+def forget():
+    global _idle
+    _idle = queue.LifoQueue()
+
+
+"""Closes all idle connections
+"""
+def closeAll():
+    while True:
+        try:
+            conn = _idle.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+### EOF
@@ -12,10 +12,201 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import time
 import file_utils as fu
 import annotate as ann
+import annocache
+import bgzf
+import dbpool
+import parallel
+import pileup2vcf
+import pipeline
+import profiling
+import scheduler
+import snapshot
+import tabix
 
-def run(infile, format):
+"""Builds the annotators in the order of the original chain, paired with
+   the message printed when each stage is done
+"""
+def getStages(cursor, inmemory=True, snapshot=None, sweep=True):
+    overlap = {'inmemory': inmemory, 'snapshot': snapshot, 'sweep': sweep}
+    return [
+        (ann.DbSnpAnnotator(cursor, format='vcf', snapshot=snapshot),
+            "dbSNP - done."),
+        (ann.BigRefGeneAnnotator(cursor, format='vcf', snapshot=snapshot),
+            "BigRefGene - done."),
+        (ann.GenesAnnotator(cursor, format='vcf', table='refGene',
+            promoter_offset=500, **overlap), "BigRefGene - done."),
+        (ann.CytobandAnnotator(cursor, format='vcf', table='cytoBand',
+            **overlap), "Cytoband - done."),
+        (ann.GadAllAnnotator(cursor, format='vcf', table='gadAll',
+            **overlap), "gadAll - done."),
+        (ann.GwasCatalogAnnotator(cursor, format='vcf', table='gwasCatalog',
+            **overlap), "GwasCatalog - done."),
+        (ann.MiRNAAnnotator(cursor, format='vcf', table='targetScanS',
+            **overlap), "miRNA - done."),
+        (ann.HUGOGeneNomenclatureAnnotator(cursor, format='vcf',
+            table='hugo', **overlap),
+            "HUGO Gene Nomenclature Committee - done."),
+        (ann.CnvDatabaseAnnotator(cursor, format='vcf', table='dgv_Cnv',
+            **overlap), "dgv_Cnv - done."),
+        (ann.CnvDatabaseAnnotator(cursor, format='vcf',
+            table='abParts_IG_T_CelReceptors', **overlap),
+            "abParts_IG_T_CelReceptors - done."),
+        (ann.CnvDatabaseAnnotator(cursor, format='vcf',
+            table='mcCarroll_Cnv', **overlap), "mcCarroll_Cnv - done."),
+        (ann.CnvDatabaseAnnotator(cursor, format='vcf', table='conrad_Cnv',
+            **overlap), "conrad_Cnv - done."),
+        (ann.GenomicSuperDupsAnnotator(cursor, format='vcf',
+            table='genomicSuperDups', **overlap),
+            "genomicSuperDups - done."),
+        (ann.TfbsConsSitesAnnotator(cursor, table='tfbsConsSites',
+            snapshot=snapshot), "addOverlapWithTfbsConsSites - done."),
+    ]
+
+
+"""Names of the annotated VCF and the count log written for infile
+   infile may be a .vcf or a gzip/BGZF compressed .vcf.gz; the annotated
+   VCF is BGZF compressed (.annot.vcf.gz) if compress is set, and by
+   default if infile is compressed. A .pileup is named as its VCF would be
+"""
+def getOutputFiles(infile, compress=None):
+    base = infile[:-3] if infile.endswith('.gz') else infile
+    if base.endswith('.pileup'):
+        base = base[:-len('.pileup')] + '.vcf'
+    if (compress is None):
+        compress = bgzf.isCompressed(infile)
+    annotfile = (base + '.annot').replace('.vcf.annot', '.annot.vcf')
+    if compress:
+        annotfile = annotfile + '.gz'
+    return annotfile, base + '.count.log'
+
+
+"""Name of the per-stage profile written for infile, next to its count log
+"""
+def getProfileFile(infile):
+    annotfile, logfile = getOutputFiles(infile, False)
+    return logfile[:-len('.count.log')] + '.profile.json'
+
+
+"""Runs all annotators over infile and writes infile's .annot.vcf
+   By default every record is annotated in a single pass (fused); set
+   fused=False to run the original one-file-per-stage chain.
+   With inmemory=True the small overlap tables are loaded into interval
+   indexes instead of being queried per variant. With snapshot_dir set,
+   all lookups are answered from a reference snapshot (see snapshot.py)
+   and the reference database is not used. With sweep=True (the default)
+   position-sorted input is merge-joined against the overlap tables; the
+   stages switch to the indexes by themselves if the input is unsorted.
+   With processes > 1 the input is sharded by chromosome and annotated
+   in a pool of processes (see parallel.py). With threads > 1 the stages
+   that query the database each get a connection and do their queries
+   concurrently (see scheduler.py). See getOutputFiles() for compress;
+   a compressed result of a sorted input also gets a tabix index (.tbi).
+   With profile=True a per-stage profile is written to the input's
+   .profile.json (see profiling.py).
+   With cache_file set, variants annotated by earlier runs are taken from
+   that annotation cache (see annocache.py) instead of the reference
+   database; reference_version must change whenever the reference data
+   does, and cache_size bounds the number of cached variants.
+   With format='pileup' infile is a variant pileup (.pileup or .pileup.gz),
+   converted to VCF as it is read (see pileup2vcf.py).
+   With instream set, the content of infile is read from that binary file
+   object instead (e.g. an s3stream.S3Reader), and with outstream set the
+   annotated VCF is written to it (e.g. an s3stream.S3Writer) and indexed
+   as it is written; infile then only names the other files of the run,
+   and compress must be given. Both need fused=True
+"""
+def run(infile, format, fused=True, inmemory=True, snapshot_dir=None,
+    sweep=True, processes=1, threads=1, compress=None, profile=True,
+    cache_file=None, reference_version='',
+    cache_size=annocache.MAXENTRIES, instream=None, outstream=None):
+    if not fused:
+        if (format == 'pileup'):
+            # the chained stages read a .vcf file
+            vcf = getOutputFiles(infile, False)[1][:-len('.count.log')]
+            pileup2vcf.filter_pileup(infile, vcf)
+            return run_staged(vcf, 'vcf')
+        return run_staged(infile, format)
+
+    print("Running . . .")
+    start = time.perf_counter()
+
+    cache = None
+    if cache_file:
+        annotators = [annotator for annotator, done in
+            getStages(None, inmemory=False, sweep=False)]
+        cache = annocache.AnnotationCache(cache_file,
+            annocache.getVersion(annotators, reference_version), annotators,
+            cache_size)
+
+    finalout, logfile = getOutputFiles(infile, compress)
+    source = infile if (instream is None) else instream
+    target = finalout
+    if (outstream is not None):
+        target = outstream
+        if finalout.endswith('.gz'):
+            target = tabix.IndexingWriter(outstream, finalout + '.tbi')
+    # connections taken from the pool, released even if the job fails:
+    # a worker runs many jobs (see workers.py)
+    conns = []
+    try:
+        if (processes > 1):
+            stages = parallel.runParallel(getStages, source, target, processes,
+                inmemory=inmemory, snapshot_dir=snapshot_dir, cache=cache,
+                format=format)
+        else:
+            cursor = None
+            snap = None
+            if snapshot_dir:
+                snap = snapshot.getSnapshot(snapshot_dir)
+            else:
+                conns.append(dbpool.acquire())
+                cursor = conns[0].cursor()
+            stages = getStages(cursor, inmemory=inmemory, snapshot=snap,
+                sweep=sweep)
+            annotators = [annotator for annotator, done in stages]
+            if (threads > 1):
+                for annotator in annotators:
+                    if annotator.usesDatabase():
+                        conns.append(dbpool.acquire())
+                        annotator.cursor = conns[-1].cursor()
+                scheduler.runScheduled(annotators, source, target, threads,
+                    cache=cache, format=format)
+            else:
+                pipeline.runPipeline(annotators, source, target, cache=cache,
+                    format=format)
+
+        if (finalout.endswith('.gz') and outstream is None):
+            tabix.buildIndex(finalout)
+
+        # Write the count log in the same order the chained stages do
+        fh_log = open(logfile, 'w')
+        for annotator, done in stages:
+            annotator.writeLog(fh_log)
+            print(done)
+        fh_log.close()
+
+        if profile:
+            options = {'inmemory': inmemory, 'snapshot': bool(snapshot_dir),
+                'sweep': sweep, 'processes': processes, 'threads': threads,
+                'cache': bool(cache_file)}
+            profiling.writeReport(getProfileFile(infile), infile,
+                [(annotator.getName(), annotator.profile)
+                    for annotator, done in stages],
+                time.perf_counter() - start, options, cache)
+    finally:
+        if (cache is not None):
+            cache.close()
+        for conn in conns:
+            dbpool.release(conn)
+
+
+"""Original AnnTools chain; each stage writes its own temporary file
+   Takes an uncompressed .vcf only
+"""
+def run_staged(infile, format):
 
     print("Running . . .")
 
@@ -0,0 +1,317 @@
+# intervals.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# In-memory interval index for the small reference tables, so overlap
+# stages can answer "chromStart <= pos AND pos <= chromEnd" without a
+# query per variant, a merge join for position-sorted input, and
+# elementary segments that answer a whole block of positions at once
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import bisect
+import heapq
+
+# NumPy is optional: without it Segments bisects one position at a time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""Per-chromosome intervals sorted by start
+   Stabbing queries return the matching rows in table order, i.e. the order
+   the rows would come back from the equivalent SQL query
+"""
+class IntervalIndex(object):
+
+    def __init__(self, rows, chromcol, startcol, endcol):
+        entries = {}
+        for order, row in enumerate(rows):
+            # NULL bounds never satisfy the SQL comparison
+            if (row[startcol] is None or row[endcol] is None):
+                continue
+            entries.setdefault(str(row[chromcol]), []).append(
+                (int(row[startcol]), order, int(row[endcol]), row))
+
+        self.chroms = {}
+        for chrom in entries:
+            entries[chrom].sort(key=lambda e: (e[0], e[1]))
+            starts = [e[0] for e in entries[chrom]]
+            orders = [e[1] for e in entries[chrom]]
+            ends = [e[2] for e in entries[chrom]]
+            rows = [e[3] for e in entries[chrom]]
+
+            # maxends[i] is the largest end of intervals 0..i, which lets the
+            # backwards scan in findOverlaps() stop early
+            maxends = []
+            maxend = None
+            for end in ends:
+                maxend = end if maxend is None else max(maxend, end)
+                maxends.append(maxend)
+
+            self.chroms[chrom] = (starts, maxends, ends, orders, rows)
+        self.segments = {}
+
+    def __len__(self):
+        return sum([len(c[0]) for c in self.chroms.values()])
+
+    """Returns the rows with start <= hi and end >= lo
+    """
+    def overlap(self, chrom, lo, hi):
+        if chrom not in self.chroms:
+            return []
+        starts, maxends, ends, orders, rows = self.chroms[chrom]
+        return [rows[h] for h in
+            findOverlaps(starts, maxends, ends, orders, lo, hi)]
+
+    """Returns the rows with start <= pos <= end
+    """
+    def stab(self, chrom, pos):
+        return self.overlap(chrom, pos, pos)
+
+    """Answers stab() for a list of positions at once; with first=True
+       only the first row in table order (or None) of every position
+    """
+    def stabMany(self, chrom, positions, first=False):
+        if chrom not in self.chroms:
+            return [None if first else [] for pos in positions]
+        starts, maxends, ends, orders, rows = self.chroms[chrom]
+        if chrom not in self.segments:
+            self.segments[chrom] = Segments(starts, maxends, ends, orders)
+        return self.segments[chrom].stabMany(positions, rows.__getitem__,
+            first)
+
+
+"""Finds the intervals with start <= hi and end >= lo in arrays sorted by
+   start, where maxends[i] is the largest end of intervals 0..i.
+   Returns their positions in table order
+"""
+def findOverlaps(starts, maxends, ends, orders, lo, hi):
+    hits = []
+    i = bisect.bisect_right(starts, hi) - 1
+    while (i >= 0 and maxends[i] >= lo):
+        if (ends[i] >= lo):
+            hits.append(i)
+        i = i - 1
+
+    hits.sort(key=lambda h: orders[h])
+    return hits
+
+
+"""Elementary segments of the intervals of one chromosome
+   Between two consecutive interval bounds every position is covered by
+   the same intervals, so the segments are computed once with a sweep and
+   a position is answered by finding its segment: one numpy.searchsorted
+   for a whole block of positions. Every segment keeps its first interval
+   in table order, and all of its intervals unless the intervals nest
+   deeper than MAXDEPTH, where stabbing falls back to findOverlaps()
+"""
+class Segments(object):
+    MAXDEPTH = 16
+
+    def __init__(self, starts, maxends, ends, orders):
+        self.starts = starts
+        self.maxends = maxends
+        self.ends = ends
+        self.orders = orders
+        n = len(starts)
+
+        # an interval covers start .. end, i.e. the segments from its start
+        # up to the one that begins at end + 1
+        byend = sorted(range(n), key=lambda i: ends[i])
+        bounds = sorted(set(starts) | set([end + 1 for end in ends]))
+        removed = bytearray(n)
+        heap = []
+        active = {}
+        firsts = []
+        hits = []
+        i = 0
+        j = 0
+        for bound in bounds:
+            while (j < n and ends[byend[j]] + 1 <= bound):
+                removed[byend[j]] = 1
+                if (active is not None):
+                    active.pop(byend[j], None)
+                j = j + 1
+            while (i < n and starts[i] <= bound):
+                if (ends[i] >= starts[i]):
+                    heapq.heappush(heap, (orders[i], i))
+                    if (active is not None):
+                        active[i] = orders[i]
+                i = i + 1
+            while (len(heap) > 0 and removed[heap[0][1]]):
+                heapq.heappop(heap)
+            firsts.append(heap[0][1] if (len(heap) > 0) else -1)
+            if (active is not None):
+                if (len(active) > self.MAXDEPTH):
+                    active = None
+                    hits = None
+                else:
+                    hits.append(tuple(sorted(active, key=active.get)))
+
+        self.bounds = bounds
+        self.firsts = firsts
+        self.hits = hits
+        if (numpy is not None):
+            self.boundarray = numpy.array(bounds, dtype=numpy.int64)
+            # shifted by one, so that positions before the first bound
+            # (segment -1) find no interval
+            self.firstarray = numpy.array([-1] + firsts, dtype=numpy.int64)
+
+    """Segment of every position, or -1 before the first bound
+    """
+    def locate(self, positions):
+        if (numpy is not None):
+            return (numpy.searchsorted(self.boundarray,
+                numpy.array(positions, dtype=numpy.int64), 'right') - 1) \
+                .tolist()
+        bounds = self.bounds
+        return [bisect.bisect_right(bounds, pos) - 1 for pos in positions]
+
+    """Interval (position in the arrays) that comes first in table order
+       among those containing each position, or -1
+    """
+    def first(self, positions):
+        if (numpy is not None):
+            return self.firstarray[numpy.searchsorted(self.boundarray,
+                numpy.array(positions, dtype=numpy.int64), 'right')].tolist()
+        firsts = self.firsts
+        return [firsts[k] if (k >= 0) else -1
+            for k in self.locate(positions)]
+
+    """Intervals containing each position, in table order
+    """
+    def all(self, positions):
+        if (self.hits is None):
+            return [findOverlaps(self.starts, self.maxends, self.ends,
+                self.orders, pos, pos) for pos in positions]
+        hits = self.hits
+        return [hits[k] if (k >= 0) else () for k in self.locate(positions)]
+
+    """stab() of every position as rows, given row(i) for interval i
+    """
+    def stabMany(self, positions, row, first=False):
+        if first:
+            return [row(h) if (h >= 0) else None
+                for h in self.first(positions)]
+        return [[row(h) for h in found] for found in self.all(positions)]
+
+
+"""Indexes loaded by this process, keyed by table and columns
+"""
+_indexes = {}
+
+"""Loads a table once per process and returns its interval index
+"""
+def getIndex(cursor, table, chromcol='chrom', startcol='chromStart',
+    endcol='chromEnd', columns='*'):
+
+    key = (table, chromcol, startcol, endcol, columns)
+    if key not in _indexes:
+        cursor.execute('select ' + columns + ' from ' + table + ';')
+        names = [str(d[0]).lower() for d in cursor.description]
+        _indexes[key] = IntervalIndex(cursor.fetchall(),
+            names.index(chromcol.lower()), names.index(startcol.lower()),
+            names.index(endcol.lower()))
+
+    return _indexes[key]
+
+
+"""Reads a table one chromosome at a time for SweepJoin
+   Rows come back sorted by start, tagged with their position in the table
+"""
+class ChromQuery(object):
+
+    def __init__(self, cursor, table, chromcol='chrom', startcol='chromStart',
+        endcol='chromEnd', columns='*'):
+        self.cursor = cursor
+        self.table = table
+        self.chromcol = chromcol
+        self.startcol = startcol
+        self.endcol = endcol
+        self.columns = columns
+
+    """Returns (start, order, end, row) for every row of chrom
+    """
+    def sweep(self, chrom):
+        self.cursor.execute('select ' + self.columns + ' from ' + self.table +
+            ' where ' + self.chromcol + '="' + str(chrom) + '";')
+        names = [str(d[0]).lower() for d in self.cursor.description]
+        startind = names.index(self.startcol.lower())
+        endind = names.index(self.endcol.lower())
+
+        entries = []
+        for order, row in enumerate(self.cursor.fetchall()):
+            if (row[startind] is None or row[endind] is None):
+                continue
+            entries.append((int(row[startind]), order, int(row[endind]), row))
+        entries.sort(key=lambda e: (e[0], e[1]))
+        return entries
+
+    def row(self, chrom, key):
+        return key
+
+
+"""Merge join of position-sorted variants against a table sorted by start
+   Walks the table alongside the variants, keeping only the intervals that
+   are still open in a heap keyed by end, so a sorted input costs O(N + M).
+   source provides sweep(chrom) and row(chrom, key) (ChromQuery or a
+   snapshot table). As soon as the queries go backwards, or return to a
+   chromosome already passed, the join hands over to the index returned by
+   fallback() for the rest of the input
+"""
+class SweepJoin(object):
+
+    def __init__(self, source, fallback):
+        self.source = source
+        self.fallback = fallback
+        self.index = None
+        self.seen = set()
+        self.chrom = None
+        self.last = None
+        self.entries = iter([])
+        self.pending = None
+        self.active = []
+
+    def startChrom(self, chrom):
+        self.seen.add(chrom)
+        self.chrom = chrom
+        self.last = None
+        self.entries = iter(self.source.sweep(chrom))
+        self.pending = next(self.entries, None)
+        self.active = []
+
+    """Returns the rows with start <= hi and end >= lo, in table order
+    """
+    def overlap(self, chrom, lo, hi):
+        if (self.index is None and chrom != self.chrom):
+            if chrom in self.seen:
+                self.index = self.fallback()
+            else:
+                self.startChrom(chrom)
+        elif (self.index is None and self.last is not None and
+            (lo < self.last[0] or hi < self.last[1])):
+            self.index = self.fallback()
+        if (self.index is not None):
+            return self.index.overlap(chrom, lo, hi)
+        self.last = (lo, hi)
+
+        while (self.pending is not None and self.pending[0] <= hi):
+            start, order, end, key = self.pending
+            if (end >= lo):
+                heapq.heappush(self.active, (end, order, key))
+            self.pending = next(self.entries, None)
+        while (len(self.active) > 0 and self.active[0][0] < lo):
+            heapq.heappop(self.active)
+
+        hits = sorted(self.active, key=lambda a: a[1])
+        return [self.source.row(chrom, a[2]) for a in hits]
+
+    """Returns the rows with start <= pos <= end
+    """
+    def stab(self, chrom, pos):
+        return self.overlap(chrom, pos, pos)
+
+### EOF
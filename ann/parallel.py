@@ -0,0 +1,150 @@
+# parallel.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Chromosome-sharded AnnTools pipeline: the input is cut into shards that
+# are annotated in a pool of worker processes and written back in order
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import collections
+import multiprocessing
+
+import annocache
+import dbpool
+import pipeline
+import refdb
+import snapshot
+import vcfio
+
+"""Largest number of lines in a shard. A shard also ends where the
+   chromosome changes once it holds a quarter of that, so on sorted input
+   a shard is one piece of one chromosome, while unsorted input is not cut
+   into tiny shards. fh yields stripped lines, as a vcfio.Reader does
+"""
+SHARDSIZE = 4 * pipeline.BLOCKSIZE
+
+def readShards(fh, shardsize=SHARDSIZE):
+    shard = []
+    chrom = None
+    for line in fh:
+        if not line.startswith('#'):
+            c = line.split('\t', 1)[0]
+            if (len(shard) >= shardsize or (len(shard) >= shardsize // 4 and
+                chrom is not None and c != chrom)):
+                yield shard
+                shard = []
+            chrom = c
+        shard.append(line)
+    if (len(shard) > 0):
+        yield shard
+
+
+"""State of a worker process, set up once by initWorker()
+"""
+_worker = {}
+
+def initWorker(makeStages, inmemory, snapshot_dir, backend, cache):
+    # connections inherited from the parent must not be used here
+    dbpool.forget()
+    refdb.setBackend(backend)
+    _worker['makeStages'] = makeStages
+    _worker['inmemory'] = inmemory
+    # (path, version, maxentries) of the annotation cache, opened with the
+    # first shard
+    _worker['cacheargs'] = cache
+    _worker['cache'] = None
+    _worker['snapshot'] = None
+    _worker['cursor'] = None
+    if snapshot_dir:
+        _worker['snapshot'] = snapshot.getSnapshot(snapshot_dir)
+    else:
+        _worker['cursor'] = dbpool.acquire().cursor()
+
+
+"""Annotates one shard with a fresh set of stages
+   Returns the output lines, the counts and profile of every stage and
+   the (hits, misses) of the annotation cache. The merge join is not used,
+   since a worker sees pieces of many chromosomes
+"""
+def annotateShard(lines):
+    stages = _worker['makeStages'](_worker['cursor'],
+        inmemory=_worker['inmemory'], snapshot=_worker['snapshot'],
+        sweep=False)
+    annotators = [annotator for annotator, done in stages]
+
+    cache = _worker['cache']
+    if (cache is None and _worker['cacheargs'] is not None):
+        path, version, maxentries = _worker['cacheargs']
+        cache = annocache.AnnotationCache(path, version, annotators,
+            maxentries)
+        _worker['cache'] = cache
+    hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+
+    out = []
+    for i in range(0, len(lines), pipeline.BLOCKSIZE):
+        out.extend(pipeline.annotateBlock(annotators,
+            lines[i:i + pipeline.BLOCKSIZE], cache=cache))
+    if (cache is not None):
+        hits, misses = (cache.hits - hits, cache.misses - misses)
+    return out, [annotator.getCounts() for annotator in annotators], \
+        [annotator.profile for annotator in annotators], (hits, misses)
+
+
+"""Annotates infile into outfile with a pool of processes
+   makeStages(cursor, inmemory=, snapshot=, sweep=) builds the stages, as
+   driver.getStages() does. Returns a set of stages holding the counts and
+   profiles of the whole input, for writing the count log. The workers
+   share the file of cache, and its hits and misses are added to it
+"""
+def runParallel(makeStages, infile, outfile, processes, inmemory=True,
+    snapshot_dir=None, shardsize=SHARDSIZE, cache=None, format='vcf'):
+
+    # Stages in the parent only collect counts, so they need no database
+    snap = snapshot.getSnapshot(snapshot_dir) if snapshot_dir else None
+    stages = makeStages(None, inmemory=False, snapshot=snap, sweep=False)
+    annotators = [annotator for annotator, done in stages]
+    initial = [annotator.getCounts() for annotator in annotators]
+
+    cacheargs = None
+    if (cache is not None):
+        cacheargs = (cache.path, cache.version, cache.maxentries)
+    pool = multiprocessing.Pool(processes, initializer=initWorker,
+        initargs=(makeStages, inmemory, snapshot_dir, refdb.getBackend(),
+            cacheargs))
+    fh = vcfio.Reader(infile, format)
+    fh_out = vcfio.Writer(outfile)
+
+    # Reorder buffer: shards are submitted in input order and written in
+    # that order as they complete, with a bounded number in flight
+    inflight = collections.deque()
+
+    def writeOldest():
+        out, counts, profiles, (hits, misses) = inflight.popleft().get()
+        fh_out.writeLines(out)
+        if (cache is not None):
+            cache.hits = cache.hits + hits
+            cache.misses = cache.misses + misses
+        for annotator, c, i, p in zip(annotators, counts, initial, profiles):
+            annotator.addCounts(c, i)
+            annotator.profile.merge(p)
+
+    try:
+        for shard in readShards(fh, shardsize):
+            inflight.append(pool.apply_async(annotateShard, (shard,)))
+            if (len(inflight) >= 2 * processes):
+                writeOldest()
+        while (len(inflight) > 0):
+            writeOldest()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        fh.close()
+        fh_out.close()
+
+    return stages
+
+### EOF
@@ -12,28 +12,24 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import datetime
+import gzip
 import file_utils as fu
+import bgzf
 
 HETERO = {'M':'AC', 'R':'AG', 'W':'AT', 'S':'CG', 'Y':'CT', 'K':'GT'}
 ACCEPTED_CHR = ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13", 
                 "14", "15", "16", "17", "18", "19", "20","21","22", "X", "Y", "MT"]
+ACCEPTED = frozenset(ACCEPTED_CHR)
 #http://www.broadinstitute.org/gsa/wiki/index.php/Understanding_the_Unified_Genotyper's_VCF_files
 
-def count_alt(depth, bases):
-    bases = bases.upper()
-    lst = list(bases)
-    ast = 0
-    match_sum = 0
-
-    for l in lst:
-        l = str(l)
-
-        if ((str(l) == '.') or (str(l) == ',')):
-            match_sum = match_sum + 1
-        elif (l == '*'):
-            ast = ast + 1
+"""Bytes of pileup read and converted at a time
+"""
+CHUNKSIZE = 4 * 1024 * 1024
 
-    return (int(depth) - (match_sum + ast))
+def count_alt(depth, bases):
+    # reads matching the reference (. and ,) and deletions (*)
+    return (int(depth) - (bases.count('.') + bases.count(',') +
+        bases.count('*')))
 
 
 def vcfheader(pileup):
@@ -92,29 +88,103 @@ def varpileup_line2vcf_line(pileupfields):
         consqual + ':' + depth + ':' + alt_count
 
 
+"""Converts a chunk of variant pileup lines to VCF lines (without line
+   ends), keeping only variants (ALT != REF) on chromosomes 1 - 22, X, Y
+   and MT. Same output as varpileup_line2vcf_line() on each line, with the
+   per-line work done by str methods and dict lookups
+"""
+def pileup_lines2vcf_lines(lines, chr_col=0, ref_col=2, alt_col=3,
+    sep='\t'):
+    out = []
+    append = out.append
+    hetero = HETERO
+    accepted = ACCEPTED
+    last = max(chr_col, ref_col, alt_col, 8)
+    for line in lines:
+        fields = line.strip().split(sep)
+        if (len(fields) <= last):
+            continue
+        ref = fields[ref_col]
+        alt = fields[alt_col]
+        if ((alt == ref) or (fields[chr_col].strip() not in accepted)):
+            continue
+
+        chr, pos, ref, alt, consqual, snpqual, mapqual, depth, bases = \
+            fields[0:9]
+        GT = '1/1'
+        if alt in hetero:
+            GT = '0/1'
+            alt_x = hetero[alt]
+            alt = alt_x[1] if (ref == alt_x[0]) else alt_x[0]
+        append(chr + '\t' + pos + '\t.\t' + ref + '\t' + alt + '\t' +
+            mapqual + '\tPASS\t.\tGT:GQ:DP:AD\t' + GT + ':' + consqual +
+            ':' + depth + ':' + str(count_alt(depth, bases)))
+    return out
+
+
+def _uncompressed(pileup):
+    return pileup[:-3] if pileup.endswith('.gz') else pileup
+
+
+"""Opens a variant pileup, gzip compressed or not, as text. pileup may
+   also be a binary file object, see bgzf.openStream()
+"""
+def openPileup(pileup):
+    if not isinstance(pileup, str):
+        return bgzf.openStream(pileup)
+    if bgzf.isCompressed(pileup):
+        return gzip.open(pileup, 'rt')
+    return open(pileup)
+
+
+"""Streams a (possibly gzip compressed) variant pileup as VCF lines, a
+   chunk at a time: iterating over it gives the VCF header then the
+   converted records, like iterating over an open .vcf file. Used by
+   driver.run(format='pileup') so that pileups are annotated without
+   writing an intermediate VCF
+"""
+class PileupReader(object):
+
+    def __init__(self, pileup, chunksize=CHUNKSIZE):
+        self.pileup = pileup if isinstance(pileup, str) else pileup.name
+        self.chunksize = chunksize
+        self.fh = openPileup(pileup)
+
+    def __iter__(self):
+        for line in vcfheader(_uncompressed(self.pileup)).split('\n'):
+            yield line + '\n'
+        while True:
+            lines = self.fh.readlines(self.chunksize)
+            if (len(lines) == 0):
+                break
+            for line in pileup_lines2vcf_lines(lines):
+                yield line + '\n'
+
+    def close(self):
+        self.fh.close()
+
+
 def filter_pileup(pileup, outfile=None, chr_col=0, 
     ref_col=2, alt_col=3, sep='\t'):
     
-    fh = open(pileup, "r")
+    fh = openPileup(pileup)
     if (outfile is None):
         outfile = pileup + '.vcf'
 
     fu.delete(outfile)
     fh_out = open(outfile, "w")
-    fh_out.write(vcfheader(pileup) + '\n')
-
-
-    for line in fh:
-        line = line.strip()
-        fields = line.split(sep)
+    fh_out.write(vcfheader(_uncompressed(pileup)) + '\n')
 
-        chr = str(fields[chr_col])
-        ref = str(fields[ref_col])
-        alt = str(fields[alt_col])
+    while True:
+        lines = fh.readlines(CHUNKSIZE)
+        if (len(lines) == 0):
+            break
+        out = pileup_lines2vcf_lines(lines, chr_col, ref_col, alt_col, sep)
+        if (len(out) > 0):
+            fh_out.write('\n'.join(out) + '\n')
 
-        if ((alt != ref) and \
-            (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
-            fh_out.write(varpileup_line2vcf_line(fields[0:9]) + '\n' )
+    fh.close()
+    fh_out.close()
 
 
 """Removes lines where ALT==REF and chromosomes other than 1 - 22, X, Y and MT
@@ -141,8 +211,7 @@ def filter_vcf(pileup, outfile=None,  chr_col=0, ref_col=3,
                 ref = str(fields[ref_col])
                 alt = str(fields[alt_col])
 
-                if ((alt != ref) and \
-                    (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
+                if ((alt != ref) and (chr.strip() in ACCEPTED)):
                     fh_out.write(str(line) + '\n')
 
 ### EOF
\ No newline at end of file
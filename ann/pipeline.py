@@ -0,0 +1,153 @@
+# pipeline.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Fused AnnTools pipeline: each record is parsed once, passed through
+# every annotator in memory and written once
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import time
+import operator
+
+import vcfio
+
+
+"""Applies the line.strip() that each chained stage does on its input
+   Only needed when a stage left whitespace at either end of the record
+"""
+def restrip(fields, sep='\t'):
+    if fields.isPadded():
+        return vcfio.parse(fields.toLine().strip(), sep)
+    return fields
+
+
+"""Runs a line through the annotators exactly as the chained stages would,
+   re-stripping and re-splitting between stages. Used for the rare lines
+   that some stages treat as headers and others as records
+"""
+def annotateLine(annotators, line):
+    for annotator in annotators:
+        line = line.strip()
+        if not annotator.isHeader(line):
+            line = annotator.annotate(vcfio.parse(line,
+                annotator.sep)).toLine()
+    return line
+
+
+"""The input is read in blocks of lines so stages can prefetch a block of
+   records with one query instead of one query per record
+"""
+BLOCKSIZE = 5000
+
+
+"""Annotates a block of stripped lines with every annotator in turn and
+   returns the output lines. Each record is parsed once into a
+   vcfio.Record and written once. Records are annotated stage by stage, which
+   gives each stage the chance to prefetch the whole block. If given,
+   prepare(n, records) is called before stage n instead of its prefetch.
+   The time each stage spends on the block goes to its profile.
+   With a cache (see annocache.py), records found in it are annotated from
+   it and only the others go through the stages, which are then cached
+"""
+def annotateBlock(annotators, lines, prepare=None, cache=None):
+    sep = annotators[0].sep
+    out = list(lines)
+    indices = []
+    records = []
+
+    for i, line in enumerate(lines):
+        if line.startswith('##'):
+            continue
+        elif line.startswith(('#', 'CHROM')):
+            out[i] = annotateLine(annotators, line)
+        else:
+            fields = vcfio.parse(line, sep)
+            if (cache is not None):
+                key = cache.getKey(fields)
+                indices.append((i, key, fields.copy()))
+            else:
+                indices.append(i)
+            records.append(fields)
+
+    if (cache is not None):
+        found = cache.lookup([key for i, key, fields in indices])
+        missed = []
+        for j, (i, key, fields) in enumerate(indices):
+            if key in found:
+                counts = cache.apply(records[j], found[key])
+                for n, c in counts:
+                    for name in c:
+                        setattr(annotators[n], name,
+                            getattr(annotators[n], name) + c[name])
+                out[i] = records[j].toLine()
+            else:
+                missed.append((i, key, fields, []))
+        cache.hits = cache.hits + len(indices) - len(missed)
+        cache.misses = cache.misses + len(missed)
+        indices = missed
+        records = [fields.copy() for i, key, fields, counts in missed]
+
+    last = len(annotators) - 1
+    for n, annotator in enumerate(annotators):
+        if (prepare is not None):
+            prepare(n, records)
+        start = time.perf_counter()
+        if (prepare is None):
+            annotator.prefetch(records)
+        # counts taken per record, for the cache
+        counting = None
+        if (cache is not None and len(annotator.counters) > 0):
+            names = annotator.counters
+            # one name more, so that a tuple comes back even for one counter
+            counting = operator.attrgetter(*(names + names[:1]))
+        for j in range(len(records)):
+            if counting:
+                before = counting(annotator)
+            fields = annotator.annotate(records[j])
+            if counting:
+                after = counting(annotator)
+                if (after != before):
+                    indices[j][3].append((n, dict([(name, a - b)
+                        for name, a, b in zip(names, after, before)
+                        if (a != b)])))
+            if (n < last):
+                fields = restrip(fields, annotator.sep)
+            records[j] = fields
+        annotator.profile.addBlock(len(records), time.perf_counter() - start)
+
+    if (cache is not None):
+        entries = {}
+        for (i, key, fields, counts), annotated in zip(indices, records):
+            out[i] = annotated.toLine()
+            if (key is not None):
+                entry = cache.getEntry(fields, annotated, counts)
+                if (entry is not None):
+                    entries[key] = entry
+        cache.store(entries)
+        return out
+
+    for i, fields in zip(indices, records):
+        out[i] = fields.toLine()
+    return out
+
+
+"""Single pass over infile; output is identical to running the annotators
+   one after the other through intermediate files. Compressed input is
+   read as it is decompressed; an outfile ending in .gz is written as BGZF.
+   See vcfio.Reader for format
+"""
+def runPipeline(annotators, infile, outfile, blocksize=BLOCKSIZE,
+    prepare=None, cache=None, format='vcf'):
+    reader = vcfio.Reader(infile, format)
+    writer = vcfio.Writer(outfile)
+
+    for block in reader.blocks(blocksize):
+        writer.writeLines(annotateBlock(annotators, block, prepare, cache))
+
+    reader.close()
+    writer.close()
+
+### EOF
@@ -0,0 +1,112 @@
+# profiling.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Per-stage profile of an annotation run: wall time, records, SQL queries,
+# rows fetched and query latencies, written as a JSON report
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import array
+
+"""Profile of one stage; every annotator has one (Annotator.profile)
+"""
+class StageProfile(object):
+
+    def __init__(self):
+        self.wall = 0.0
+        self.lookahead = 0.0
+        self.lines = 0
+        self.queries = 0
+        self.replayed = 0
+        self.rows = 0
+        self.latencies = array.array('d')
+
+    def addBlock(self, lines, seconds):
+        self.lines = self.lines + lines
+        self.wall = self.wall + seconds
+
+    def addQuery(self, seconds, rows):
+        self.queries = self.queries + 1
+        self.rows = self.rows + rows
+        self.latencies.append(seconds)
+
+    """Adds the profile of the same stage run over another part of the input
+    """
+    def merge(self, other):
+        self.wall = self.wall + other.wall
+        self.lookahead = self.lookahead + other.lookahead
+        self.lines = self.lines + other.lines
+        self.queries = self.queries + other.queries
+        self.replayed = self.replayed + other.replayed
+        self.rows = self.rows + other.rows
+        self.latencies.extend(other.latencies)
+
+    def report(self, name):
+        latencies = sorted(self.latencies)
+        return {
+            'stage': name,
+            'wall_seconds': round(self.wall, 6),
+            'lookahead_seconds': round(self.lookahead, 6),
+            'lines': self.lines,
+            'variants_per_second': rate(self.lines, self.wall),
+            'queries': self.queries,
+            'queries_replayed': self.replayed,
+            'rows_fetched': self.rows,
+            'query_seconds': round(sum(latencies), 6),
+            'query_latency_ms': {
+                'p50': percentile(latencies, 0.50),
+                'p90': percentile(latencies, 0.90),
+                'p99': percentile(latencies, 0.99),
+                'max': percentile(latencies, 1.0),
+            },
+        }
+
+
+def rate(count, seconds):
+    if (seconds <= 0):
+        return None
+    return round(count / seconds, 1)
+
+
+"""q-th quantile of sorted values, in milliseconds (nearest rank)
+"""
+def percentile(values, q):
+    if (len(values) == 0):
+        return None
+    return round(values[int(round(q * (len(values) - 1)))] * 1000, 3)
+
+
+"""Writes the JSON report of a run over infile; stages is a list of
+   (name, StageProfile). Records answered from the annotation cache (see
+   annocache.py) did not go through the stages; cache is its
+   AnnotationCache, if one was used
+"""
+def writeReport(path, infile, stages, seconds, options=None, cache=None):
+    records = max([p.lines for name, p in stages]) if (len(stages) > 0) \
+        else 0
+    if (cache is not None):
+        records = records + cache.hits
+    report = {
+        'input': infile,
+        'records': records,
+        'wall_seconds': round(seconds, 6),
+        'variants_per_second': rate(records, seconds),
+        'options': options or {},
+        'stages': [p.report(name) for name, p in stages],
+    }
+    if (cache is not None):
+        looked = cache.hits + cache.misses
+        report['cache'] = {
+            'hits': cache.hits,
+            'misses': cache.misses,
+            'hit_rate': round(cache.hits / looked, 4) if looked else None,
+        }
+    fh = open(path, 'w')
+    json.dump(report, fh, indent=1)
+    fh.close()
+
+### EOF
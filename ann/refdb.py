@@ -0,0 +1,185 @@
+# refdb.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Backends of the annotator reference database. Connections are made by
+# the configured backend (see configure()): the MySQL database on RDS by
+# default, or a local read-only SQLite copy of it, e.g. on instance
+# storage, which takes the network out of every query
+#
+# The annotators issue the same SQL to both; the SQLite backend accepts
+# the MySQL-flavoured string literals ("...") they use.
+#
+# Usage: python refdb.py <sqlite_file>   (copies the reference DB into it)
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import re
+import sys
+import time
+import sqlite3
+
+import utils as u
+import snapshot
+
+"""The reference database on RDS, reached with the credentials from AWS
+   Secrets Manager (see utils.db_connect())
+"""
+class MySQLBackend(object):
+
+    def connect(self):
+        return u.db_connect()
+
+    def __repr__(self):
+        return 'MySQLBackend()'
+
+
+_literal = re.compile(r'"([^"]*)"')
+
+def _quote(match):
+    return "'" + match.group(1).replace("'", "''") + "'"
+
+"""Rewrites the double-quoted string literals of MySQL as standard SQL
+   ones, which SQLite does not have to guess are not identifiers
+"""
+def toSQLite(sql):
+    if '"' not in sql:
+        return sql
+    return _literal.sub(_quote, sql)
+
+
+class SQLiteCursor(sqlite3.Cursor):
+
+    def execute(self, sql, parameters=()):
+        return super(SQLiteCursor, self).execute(toSQLite(sql), parameters)
+
+
+class SQLiteConnection(sqlite3.Connection):
+
+    def cursor(self, factory=SQLiteCursor):
+        return super(SQLiteConnection, self).cursor(factory)
+
+
+"""A SQLite copy of the reference database made with exportDatabase(),
+   opened read-only. Connections may be used from any thread, as the
+   connection pool and the stage scheduler do
+"""
+class SQLiteBackend(object):
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def connect(self):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"No reference database at {self.path}")
+        return sqlite3.connect('file:' + self.path + '?mode=ro', uri=True,
+            check_same_thread=False, factory=SQLiteConnection)
+
+    def __repr__(self):
+        return f"SQLiteBackend({self.path!r})"
+
+
+_backend = MySQLBackend()
+
+"""Selects the backend of this process: the SQLite file at path, or the
+   MySQL database if path is empty
+"""
+def configure(path=None):
+    setBackend(SQLiteBackend(path) if path else MySQLBackend())
+
+
+def setBackend(backend):
+    global _backend
+    _backend = backend
+
+
+def getBackend():
+    return _backend
+
+
+"""Opens a connection with the configured backend
+   Prefer dbpool.acquire(), which reuses connections
+"""
+def connect():
+    return _backend.connect()
+
+
+"""Creates a composite (chrom, start, end) index on every reference table,
+   the columns the annotators look rows up by (see snapshot.TABLES)
+"""
+def createIndexes(conn, tables=snapshot.TABLES):
+    existing = set([row[0].lower() for row in conn.execute(
+        "select name from sqlite_master where type = 'table'")])
+    for table, (columns, chromcol, startcol, endcol) in tables.items():
+        if (table.lower() not in existing):
+            continue
+        conn.execute('create index if not exists ' + table + '_pos on ' +
+            table + ' (' + ', '.join(getIndexKeys(chromcol, startcol,
+                endcol)) + ')')
+    conn.commit()
+
+
+"""Columns of the index createIndexes() creates on a table
+"""
+def getIndexKeys(chromcol, startcol, endcol):
+    keys = [startcol] if (startcol == endcol) else [startcol, endcol]
+    if chromcol:
+        keys.insert(0, chromcol)
+    return keys
+
+
+"""SQLite stores ints, floats, strings and bytes; anything else (Decimal,
+   dates) is stored as its string, which is how the annotators use it
+"""
+def _plain(value):
+    if (value is None or type(value) in (int, float, str, bytes)):
+        return value
+    return str(value)
+
+
+"""Copies the reference tables from cursor into a new SQLite file at
+   path and indexes them. The file is written next to path and renamed
+   into place when complete, so readers never see a partial copy
+"""
+def exportDatabase(cursor, path, tables=snapshot.TABLES):
+    tmppath = path + '.tmp'
+    if os.path.exists(tmppath):
+        os.remove(tmppath)
+    conn = sqlite3.connect(tmppath)
+
+    for table in tables:
+        start = time.time()
+        cursor.execute('select * from ' + table + ';')
+        columns = [str(d[0]) for d in cursor.description]
+        conn.execute('create table ' + table + ' (' + ', '.join(columns) +
+            ')')
+        insert = 'insert into ' + table + ' values (' + \
+            ', '.join(['?'] * len(columns)) + ')'
+        n = 0
+        while True:
+            rows = cursor.fetchmany(10000)
+            if (len(rows) == 0):
+                break
+            conn.executemany(insert,
+                [tuple([_plain(v) for v in row]) for row in rows])
+            n = n + len(rows)
+        conn.commit()
+        print(f"{table}: {n} rows ({time.time() - start:.1f}s)")
+
+    createIndexes(conn, tables)
+    conn.close()
+    os.replace(tmppath, path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        conn = MySQLBackend().connect()
+        exportDatabase(conn.cursor(), sys.argv[1])
+        conn.close()
+    else:
+        print("A SQLite file must be provided as input to this program.")
+
+### EOF
@@ -0,0 +1,146 @@
+# reuse.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Content-addressed reuse of annotation results
+#
+# Every completed job records where its results are in an index object in
+# the results bucket, keyed by the SHA-256 of its input file and by a
+# version of the annotation (reference data version, annotator code and
+# output format). A job whose input has the same digest and version copies
+# those results to its own keys instead of being annotated.
+#
+# An input streamed from S3 instead of downloaded is known by its ETag.
+#
+# Results of free users are moved to Glacier by the archive daemon, so an
+# entry is only used while all of its objects are still in the bucket.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import time
+import hashlib
+import botocore
+
+import annotate
+
+# bytes read at a time when hashing an input file
+READSIZE = 1024 * 1024
+
+
+"""SHA-256 of the content of a file, as a hex string
+"""
+def hashFile(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        while True:
+            data = fh.read(READSIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+"""Version of the results of a job: results are only reused between jobs
+   run against the same reference data, by the same annotator code, with
+   the same output format
+"""
+def getVersion(reference_version, compressed):
+    digest = hashlib.sha1()
+    digest.update(str(reference_version).encode('utf-8'))
+    digest.update(b'\x00gz' if compressed else b'\x00vcf')
+    fh = open(annotate.__file__, 'rb')
+    digest.update(fh.read())
+    fh.close()
+    return digest.hexdigest()[:16]
+
+
+"""Stands for the digest of an input that is streamed from S3 rather than
+   downloaded (see s3stream.py): its ETag, which is the MD5 of the content
+   of an object uploaded in one part. ETags of objects uploaded in parts
+   only match for the same content uploaded in the same parts
+"""
+def getObjectDigest(s3, bucket, key):
+    etag = s3.head_object(Bucket=bucket, Key=key)['ETag'].strip('"')
+    return 'etag-' + etag
+
+
+def getIndexKey(prefix, version, digest):
+    return '{}content/{}/{}.json'.format(prefix, version, digest)
+
+
+def _exists(s3, bucket, key):
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return True
+
+
+"""Returns the index entry of the results of an input with this digest,
+   or None if there is none or its results are no longer in the bucket
+"""
+def findResult(s3, bucket, index_key):
+    try:
+        response = s3.get_object(Bucket=bucket, Key=index_key)
+        entry = json.loads(response['Body'].read())
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            print(e)
+        return None
+    except (ValueError, KeyError) as e:
+        print(f"Invalid result index {index_key}: {e}")
+        return None
+
+    try:
+        keys = [entry['s3_key_result_file'], entry['s3_key_log_file']]
+        if entry.get('indexed'):
+            keys.append(entry['s3_key_result_file'] + '.tbi')
+        for key in keys:
+            if not _exists(s3, bucket, key):
+                return None
+    except KeyError as e:
+        print(f"Invalid result index {index_key}: {e}")
+        return None
+    except botocore.exceptions.ClientError as e:
+        print(e)
+        return None
+    return entry
+
+
+"""Copies the results of entry to annot_key and log_key (server side, so
+   nothing goes through the instance). The log keeps its gzip encoding
+"""
+def copyResult(s3, bucket, entry, annot_key, log_key):
+    copies = [(entry['s3_key_result_file'], annot_key),
+        (entry['s3_key_log_file'], log_key)]
+    if entry.get('indexed'):
+        copies.append((entry['s3_key_result_file'] + '.tbi',
+            annot_key + '.tbi'))
+    for source, key in copies:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.copy
+        s3.copy({'Bucket': bucket, 'Key': source}, bucket, key)
+
+
+"""Records the results of a completed job in the index
+"""
+def recordResult(s3, bucket, index_key, job_id, annot_key, log_key,
+    indexed):
+    entry = {
+        'job_id': job_id,
+        's3_key_result_file': annot_key,
+        's3_key_log_file': log_key,
+        'indexed': indexed,
+        'created': int(time.time()),
+    }
+    try:
+        s3.put_object(Bucket=bucket, Key=index_key, Body=json.dumps(entry),
+            ContentType='application/json')
+    except botocore.exceptions.ClientError as e:
+        print(e)
+
+### EOF
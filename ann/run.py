@@ -10,8 +10,14 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import time
+import gzip
 import driver
+import refdb
+import reuse
+import s3stream
+import concurrent.futures
 from boto3.dynamodb.conditions import Key
+from boto3.s3.transfer import TransferConfig
 import boto3
 import json
 import time
@@ -37,42 +43,168 @@ class Timer(object):
         if self.verbose:
             print(f"Approximate runtime: {self.secs:.2f} seconds")
 
-def upload_result(file_name):
+def get_result_keys(file_name, compress=None):
     '''
-    upload the result files to S3 storage
+    S3 keys of the annotated file and the count log of a job
+    returns (annot_key, log_key, job_id, user_id), or None if the file name
+    is not ./<user_id>/<job_id>/<file>
     '''
-    # obtain the config
     config = ConfigParser()
     config.read('ann_config.ini')
 
     # retrieve info from filename
-    s3 = boto3.resource('s3')
-    bucket = config['aws']['AWS_S3_RESULTS_BUCKET']
     try:
         user_id = file_name.split("/")[1]
-        prefix = file_name[2:len(file_name)-4]
         job_id = file_name.split("/")[2]
-        suffix = prefix.split("/")[2]
 
     except IndexError as e:
-      print("File name not valid\n"+e)
+      print("File name not valid\n"+str(e))
       return
-    
 
-    #upload the final output to s3
     s3_prefix = config['aws']['AWS_S3_KEY_PREFIX']
-    annot_file = '{}.annot.vcf'.format(prefix)
-    log_file = '{}.vcf.count.log'.format(prefix)
-    annot_key = '{}{}/{}.annot.vcf'.format(s3_prefix,user_id,suffix)
-    log_key = '{}{}/{}.vcf.count.log'.format(s3_prefix,user_id,suffix)
-    
+    annot_file, log_file = driver.getOutputFiles(file_name, compress)
+    annot_key = '{}{}/{}'.format(s3_prefix,user_id,
+        os.path.basename(annot_file))
+    log_key = '{}{}/{}'.format(s3_prefix,user_id,os.path.basename(log_file))
+    return annot_key, log_key, job_id, user_id
+
+def reuse_result(file_name, compress, index_key):
+    '''
+    copy the results of an earlier job on the same input, if there is one
+    (see reuse.py); returns the keys as upload_result does, or None
+    '''
+    config = ConfigParser()
+    config.read('ann_config.ini')
+    s3 = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
+    bucket = config['aws']['AWS_S3_RESULTS_BUCKET']
+
+    keys = get_result_keys(file_name, compress)
+    if keys is None:
+        return
+    annot_key, log_key, job_id, user_id = keys
+
+    entry = reuse.findResult(s3, bucket, index_key)
+    if entry is None:
+        return
     try:
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.upload_file
-        s3.meta.client.upload_file(annot_file, bucket, annot_key)
-        s3.meta.client.upload_file(log_file, bucket, log_key)
-    except (FileNotFoundError, boto3.exceptions.S3UploadFailedError) as e:
+        reuse.copyResult(s3, bucket, entry, annot_key, log_key)
+    except (botocore.exceptions.ClientError,
+        boto3.exceptions.S3UploadFailedError) as e:
         print(e)
         return
+    print("Reused the results of job {}".format(entry['job_id']))
+
+    # delete the input file in instance
+    try:
+        shutil.rmtree("./{}/{}".format(user_id,job_id))
+    except FileNotFoundError as e:
+        print(e)
+    return log_key, annot_key, job_id, user_id
+
+def get_transfer_config(config):
+    '''
+    multipart settings of the result uploads: parts of UploadPartSize MB,
+    UploadThreads parts of a file at a time
+    '''
+    part_size = config.getint('ann', 'UploadPartSize',
+        fallback=s3stream.PARTSIZE // (1024 * 1024)) * 1024 * 1024
+    return TransferConfig(multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=config.getint('ann', 'UploadThreads',
+            fallback=s3stream.THREADS))
+
+def upload_annotated(s3_client, annot_file, bucket, annot_key, transfer):
+    '''
+    upload the annotated file; an uncompressed one is stored gzip-encoded
+    like the count log, compressed as it is uploaded
+    '''
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.upload_fileobj
+    if annot_file.endswith('.gz'):
+        s3_client.upload_file(annot_file, bucket, annot_key, Config=transfer)
+        return
+    with open(annot_file, 'rb') as fh:
+        s3_client.upload_fileobj(s3stream.GzipReader(fh), bucket, annot_key,
+            ExtraArgs={'ContentType': 'text/plain',
+                'ContentEncoding': 'gzip'}, Config=transfer)
+
+def open_streams(file_name, compress, source):
+    '''
+    streams of a job whose input is read from S3 as it is annotated: the
+    input object source = (bucket, key), and the multipart upload of the
+    annotated file (see s3stream.py)
+    '''
+    config = ConfigParser()
+    config.read('ann_config.ini')
+    s3 = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
+    bucket = config['aws']['AWS_S3_RESULTS_BUCKET']
+
+    annot_file = driver.getOutputFiles(file_name, compress)[0]
+    annot_key = get_result_keys(file_name, compress)[0]
+    transfer = get_transfer_config(config)
+    instream = s3stream.S3Reader(s3, source[0], source[1], name=file_name)
+    try:
+        outstream = s3stream.S3Writer(s3, bucket, annot_key,
+            name=annot_file, partsize=transfer.multipart_chunksize,
+            threads=transfer.max_concurrency)
+    except botocore.exceptions.ClientError:
+        instream.close()
+        raise
+    return instream, outstream
+
+def upload_result(file_name, compress=None, streamed=False):
+    '''
+    upload the result files to S3 storage, all at once
+    the count log is stored gzip-encoded, which S3 serves transparently;
+    a streamed annotated file is uploaded already
+    '''
+    # obtain the config
+    config = ConfigParser()
+    config.read('ann_config.ini')
+
+    s3 = boto3.resource('s3')
+    bucket = config['aws']['AWS_S3_RESULTS_BUCKET']
+    keys = get_result_keys(file_name, compress)
+    if keys is None:
+        return
+    annot_key, log_key, job_id, user_id = keys
+    s3_prefix = config['aws']['AWS_S3_KEY_PREFIX']
+    annot_file, log_file = driver.getOutputFiles(file_name, compress)
+
+    client = s3.meta.client
+    transfer = get_transfer_config(config)
+
+    def upload_log():
+        with open(log_file, 'rb') as fh_log:
+            client.put_object(Bucket=bucket, Key=log_key,
+                Body=gzip.compress(fh_log.read()),
+                ContentType='text/plain', ContentEncoding='gzip')
+
+    uploads = [upload_log]
+    if not streamed:
+        uploads.append(lambda: upload_annotated(client, annot_file, bucket,
+            annot_key, transfer))
+    # positional index for ranged reads of the result, see tabix.py
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.upload_file
+    if os.path.exists(annot_file + '.tbi'):
+        uploads.append(lambda: client.upload_file(annot_file + '.tbi', bucket,
+            annot_key + '.tbi'))
+    # per-stage profile of the run, see profiling.py
+    profile_file = driver.getProfileFile(file_name)
+    if os.path.exists(profile_file):
+        uploads.append(lambda: client.upload_file(profile_file, bucket,
+            '{}{}/{}'.format(s3_prefix,user_id,
+            os.path.basename(profile_file))))
+
+    #upload the final output to s3
+    with concurrent.futures.ThreadPoolExecutor(len(uploads)) as executor:
+        futures = [executor.submit(upload) for upload in uploads]
+        try:
+            for future in futures:
+                future.result()
+        except (FileNotFoundError, boto3.exceptions.S3UploadFailedError,
+            botocore.exceptions.ClientError) as e:
+            print(e)
+            return
 
     # delete the output file in instance
     # https://docs.python.org/3/library/shutil.html#shutil.rmtree
@@ -82,134 +214,234 @@ def upload_result(file_name):
         print(e)
     return log_key, annot_key, job_id,user_id
 
-if __name__ == '__main__':
-    # Call the AnnTools pipeline
-    if len(sys.argv) > 1:
-        file_name = sys.argv[1]
-        job_complete = True
+def run_job(file_name, source=None):
+    '''
+    annotate ./<user_id>/<job_id>/<file>, upload the results and update the
+    job; run once per process by the script, or by every job of a worker
+    of annotator.py (see workers.py). Returns 1 if the notifications of a
+    completed job could not be published
+    with source = (bucket, key) the input is read from that S3 object as it
+    is annotated and the annotated file uploaded as it is written, so
+    neither is stored in the job's directory (see s3stream.py)
+    '''
+    job_complete = True
+    config = ConfigParser()
+    config.read('ann_config.ini')
+    snapshot_dir = config.get('ann', 'SnapshotDir', fallback='') or None
+    refdb.configure(config.get('ann', 'ReferenceDb', fallback=''))
+    cache_file = config.get('ann', 'AnnotationCache', fallback='') or None
+    cache_size = config.getint('ann', 'AnnotationCacheSize',
+        fallback=2000000)
+    reference_version = config.get('ann', 'ReferenceVersion',
+        fallback='')
+    processes = config.getint('ann', 'Processes', fallback=1)
+    threads = config.getint('ann', 'Threads', fallback=1)
+    compress = None
+    if config.get('ann', 'CompressOutput', fallback=''):
+        compress = config.getboolean('ann', 'CompressOutput')
+    elif source is not None:
+        # a streamed input is not there to be looked at
+        compress = file_name.endswith('.gz')
+    # variant pileups are converted to VCF as they are annotated
+    format = 'vcf'
+    if file_name.endswith(('.pileup', '.pileup.gz')):
+        format = 'pileup'
+    reuse_results = config.getboolean('ann', 'ReuseResults',
+        fallback=False)
+
+    # an input annotated before is not annotated again: the results of
+    # that job are copied (see reuse.py)
+    reused = None
+    index_key = None
+    if reuse_results:
+        annot_file = driver.getOutputFiles(file_name, compress)[0]
+        try:
+            if source is not None:
+                digest = reuse.getObjectDigest(boto3.client('s3',
+                    region_name=config['aws']['AwsRegionName']),
+                    source[0], source[1])
+            else:
+                digest = reuse.hashFile(file_name)
+            index_key = reuse.getIndexKey(
+                config['aws']['AWS_S3_KEY_PREFIX'],
+                reuse.getVersion(reference_version,
+                    annot_file.endswith('.gz')), digest)
+            reused = reuse_result(file_name, compress, index_key)
+        except (FileNotFoundError, OSError,
+            botocore.exceptions.ClientError) as e:
+            print(e)
+
+    if reused is not None:
+        log_key, annot_key, job_id,user_id = reused
+        complete_time = int(time.time())
+    else:
         with Timer():
+            instream = None
+            outstream = None
             try:
-                driver.run(sys.argv[1], 'vcf')
+                if source is not None:
+                    instream, outstream = open_streams(file_name, compress,
+                        source)
+                driver.run(file_name, format, snapshot_dir=snapshot_dir,
+                    processes=processes, threads=threads,
+                    compress=compress, cache_file=cache_file,
+                    reference_version=reference_version,
+                    cache_size=cache_size, instream=instream,
+                    outstream=outstream)
+                if outstream is not None:
+                    outstream.complete()
             except :
                 job_complete = False
+                # no partial result is left in the bucket
+                if outstream is not None:
+                    try:
+                        outstream.abort()
+                    except botocore.exceptions.ClientError as e:
+                        print(e)
+            if instream is not None:
+                instream.close()
             complete_time = int(time.time())
 
+        indexed = os.path.exists(
+            driver.getOutputFiles(file_name, compress)[0] + '.tbi')
+
         # upload the log and count file to gas-results
-        log_key, annot_key, job_id,user_id = upload_result(file_name)
+        uploaded = upload_result(file_name, compress, source is not None)
+        if uploaded is None:
+            # a job that left no results fails
+            keys = get_result_keys(file_name, compress)
+            if keys is None:
+                return
+            job_complete = False
+            annot_key, log_key, job_id, user_id = keys
+        else:
+            log_key, annot_key, job_id,user_id = uploaded
 
-        # obtain the config
-        config = ConfigParser()
-        config.read('ann_config.ini')
+        # later jobs on the same input reuse these results
+        if job_complete and index_key is not None:
+            reuse.recordResult(boto3.client('s3',
+                region_name=config['aws']['AwsRegionName']),
+                config['aws']['AWS_S3_RESULTS_BUCKET'], index_key,
+                job_id, annot_key, log_key, indexed)
+
+    # obtain the config
+    config = ConfigParser()
+    config.read('ann_config.ini')
 
-        # update the job_status and add more info in dynamoDB
+    # update the job_status and add more info in dynamoDB
+    try:
+        dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+        table_name = config['aws']['DynamoTableName']
+        ann_table = dynamodb.Table(table_name)
+    except boto3.exceptions.ResourceNotExistsError as e:
+        print("ResourceNotExistsError")
+    except botocore.exceptions.ClientError as e:
+        print("ClientError")
+    
+    if job_complete :
+        # update the status to complete and add log and result files' key
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.update_item
         try:
-            dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-            table_name = config['aws']['DynamoTableName']
-            ann_table = dynamodb.Table(table_name)
-        except boto3.exceptions.ResourceNotExistsError as e:
-            print("ResourceNotExistsError")
-        except botocore.exceptions.ClientError as e:
-            print("ClientError")
-        
-        if job_complete :
-            # update the status to complete and add log and result files' key
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.update_item
-            try:
-                response = ann_table.update_item(
-                    Key={
-                        'job_id': job_id
-                        },
-                    UpdateExpression="set job_status = :r , \
-                    s3_results_bucket=:b, s3_key_log_file=:l, \
-                    s3_key_result_file=:a, complete_time=:t" ,
-                    ExpressionAttributeValues={
-                        ':r': "COMPLETED",
-                        ':a': annot_key,
-                        ':l': log_key,
-                        ':b': "gas-results",
-                        ':t': complete_time
+            response = ann_table.update_item(
+                Key={
+                    'job_id': job_id
                     },
-                    ReturnValues="UPDATED_NEW"
+                UpdateExpression="set job_status = :r , \
+                s3_results_bucket=:b, s3_key_log_file=:l, \
+                s3_key_result_file=:a, complete_time=:t" ,
+                ExpressionAttributeValues={
+                    ':r': "COMPLETED",
+                    ':a': annot_key,
+                    ':l': log_key,
+                    ':b': "gas-results",
+                    ':t': complete_time
+                },
+                ReturnValues="UPDATED_NEW"
 
-                )
-            except botocore.errorfactory.ConditionalCheckFailedException as e:
-                print("Doesn't meet the ConditionExpressions") 
-            except botocore.exceptions.ClientError as e:
-                print(e.response['Error']['Message'])
-            except:
-                print("Unexpected error")
+            )
+        except botocore.errorfactory.ConditionalCheckFailedException as e:
+            print("Doesn't meet the ConditionExpressions") 
+        except botocore.exceptions.ClientError as e:
+            print(e.response['Error']['Message'])
+        except:
+            print("Unexpected error")
 
-            # connect to the sns and topic
-            try:
-                sns = boto3.resource('sns', region_name='us-east-1')
-                topic_result_name = config['aws']['SNS_RESULT_TOPIC']
-                topic_archive_name = config['aws']['SNS_ARCHIVE_TOPIC']
-                topic_result = sns.Topic(topic_result_name)
-                topic_archive = sns.Topic(topic_archive_name)
-            except (botocore.errorfactory.NotFoundException, botocore.errorfactory.InvalidParameterException, \
-                boto3.exceptions.ResourceNotExistsError) as e:
-                print(e)
-                exit(1)
-
-            ep_time = int(time.time())
-
-            # construct the notification
-            result_notification = { 
-                "job_id": job_id,
-                "user_id": user_id,
-                "s3_results_bucket": config['aws']['AWS_S3_RESULTS_BUCKET'],
-                "s3_key_log_file": log_key,
-                "s3_key_annot_file": annot_key,
-                "completed_time":ep_time,
-            }
-
-            archive_notification = {
-                "job_id": job_id,
-                "user_id": user_id,
-                "s3_results_bucket": config['aws']['AWS_S3_RESULTS_BUCKET'],
-                "s3_key_log_file": log_key,
-                "s3_key_annot_file": annot_key,
-                "completed_time":ep_time,
-            }
-
-            # publish a notification message to job_result and result_archive SNS when job is complete
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns.html#SNS.Topic.publish
-            try:
-                result_response = topic_result.publish(
-                    Message= json.dumps(result_notification),
-                    MessageStructure='String',
-                )
-                archive_response = topic_archive.publish(
-                    Message= json.dumps(archive_notification),
-                    MessageStructure='String',
-                )
-            except (botocore.exceptions.ParamValidationError,botocore.exceptions.ClientError) as e:
-                print(e)
-                exit(1)
-
-        else :
-            # update the status to error
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.update_item
-            try:
-                response = ann_table.update_item(
-                    Key={
-                        'job_id': job_id
-                        },
-                    UpdateExpression="set job_status = :r" ,
-                    ExpressionAttributeValues={
-                        ':r': "ERROR"
+        # connect to the sns and topic
+        try:
+            sns = boto3.resource('sns', region_name='us-east-1')
+            topic_result_name = config['aws']['SNS_RESULT_TOPIC']
+            topic_archive_name = config['aws']['SNS_ARCHIVE_TOPIC']
+            topic_result = sns.Topic(topic_result_name)
+            topic_archive = sns.Topic(topic_archive_name)
+        except (botocore.errorfactory.NotFoundException, botocore.errorfactory.InvalidParameterException, \
+            boto3.exceptions.ResourceNotExistsError) as e:
+            print(e)
+            return 1
+
+        ep_time = int(time.time())
+
+        # construct the notification
+        result_notification = { 
+            "job_id": job_id,
+            "user_id": user_id,
+            "s3_results_bucket": config['aws']['AWS_S3_RESULTS_BUCKET'],
+            "s3_key_log_file": log_key,
+            "s3_key_annot_file": annot_key,
+            "completed_time":ep_time,
+        }
+
+        archive_notification = {
+            "job_id": job_id,
+            "user_id": user_id,
+            "s3_results_bucket": config['aws']['AWS_S3_RESULTS_BUCKET'],
+            "s3_key_log_file": log_key,
+            "s3_key_annot_file": annot_key,
+            "completed_time":ep_time,
+        }
+
+        # publish a notification message to job_result and result_archive SNS when job is complete
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns.html#SNS.Topic.publish
+        try:
+            result_response = topic_result.publish(
+                Message= json.dumps(result_notification),
+                MessageStructure='String',
+            )
+            archive_response = topic_archive.publish(
+                Message= json.dumps(archive_notification),
+                MessageStructure='String',
+            )
+        except (botocore.exceptions.ParamValidationError,botocore.exceptions.ClientError) as e:
+            print(e)
+            return 1
+
+    else :
+        # update the status to error
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.update_item
+        try:
+            response = ann_table.update_item(
+                Key={
+                    'job_id': job_id
                     },
-                    ReturnValues="UPDATED_NEW"
+                UpdateExpression="set job_status = :r" ,
+                ExpressionAttributeValues={
+                    ':r': "ERROR"
+                },
+                ReturnValues="UPDATED_NEW"
 
-                )
-            except botocore.errorfactory.ConditionalCheckFailedException as e:
-                print("Doesn't meet the ConditionExpressions")
-            except botocore.exceptions.ClientError as e:
-                print(e.response['Error']['Message'])
-            except:
-                print("Unexpected error")
+            )
+        except botocore.errorfactory.ConditionalCheckFailedException as e:
+            print("Doesn't meet the ConditionExpressions")
+        except botocore.exceptions.ClientError as e:
+            print(e.response['Error']['Message'])
+        except:
+            print("Unexpected error")
 
+if __name__ == '__main__':
+    # Call the AnnTools pipeline
+    if len(sys.argv) > 1:
+        sys.exit(run_job(sys.argv[1]))
     else:
-        print("A valid .vcf file must be provided as input to this program.")
+        print("A valid .vcf or .pileup file must be provided as input to " +
+            "this program.")
 
 ### EOF
\ No newline at end of file
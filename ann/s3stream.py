@@ -0,0 +1,229 @@
+# s3stream.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Binary file objects over S3 objects, so that a job can be annotated
+# without its input or result being stored on the instance first
+#
+# S3Reader reads an object with ranged GETs, fetching the next chunks in
+# a background thread while the pipeline works on the current one.
+# S3Writer sends what is written to it as the parts of a multipart upload
+# as the output is produced, several parts at a time. GzipReader compresses
+# a file as it is read, for uploading it gzip-encoded.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import zlib
+import queue
+import threading
+import collections
+import concurrent.futures
+
+"""Bytes fetched by one ranged GET
+"""
+CHUNKSIZE = 8 * 1024 * 1024
+
+"""Chunks fetched ahead of the one being read
+"""
+READAHEAD = 4
+
+"""Bytes per part of a multipart upload; S3 takes parts of 5 MB and more,
+   but the last one
+"""
+PARTSIZE = 16 * 1024 * 1024
+
+"""Parts of a multipart upload sent at a time
+"""
+THREADS = 8
+
+"""zlib level of GzipReader: uploads are faster than the higher levels
+   compress, and VCF text compresses well at level 1 already
+"""
+GZIPLEVEL = 1
+
+# bytes of the uncompressed file GzipReader reads at a time
+READSIZE = 1024 * 1024
+
+# seconds between two checks that a reader was not closed, while waiting
+WAIT = 1
+
+
+"""Reads bucket/key as a binary file, chunksize bytes per ranged GET with
+   up to readahead chunks fetched ahead. name is what the readers of the
+   stream (see bgzf.openStream) take for its file name; by default the key
+"""
+class S3Reader(io.RawIOBase):
+
+    def __init__(self, s3, bucket, key, name=None, chunksize=CHUNKSIZE,
+        readahead=READAHEAD):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.name = key if (name is None) else name
+        self.chunksize = chunksize
+        self.size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.chunks = queue.Queue(readahead)
+        self.chunk = b''
+        self.offset = 0
+        self.stopped = threading.Event()
+        self.fetcher = threading.Thread(target=self.fetch, daemon=True)
+        self.fetcher.start()
+
+    """Fetches the chunks in order; ends the queue with b'' or with the
+       exception that stopped it
+    """
+    def fetch(self):
+        try:
+            for start in range(0, self.size, self.chunksize):
+                end = min(start + self.chunksize, self.size) - 1
+                # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.get_object
+                response = self.s3.get_object(Bucket=self.bucket,
+                    Key=self.key, Range=f"bytes={start}-{end}")
+                if not self.put(response['Body'].read()):
+                    return
+            self.put(b'')
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=WAIT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if (self.chunk is None):
+            return 0
+        if (self.offset == len(self.chunk)):
+            item = self.chunks.get()
+            if isinstance(item, Exception):
+                raise item
+            if (len(item) == 0):
+                self.chunk = None
+                return 0
+            self.chunk = item
+            self.offset = 0
+        n = min(len(b), len(self.chunk) - self.offset)
+        b[:n] = self.chunk[self.offset:self.offset + n]
+        self.offset = self.offset + n
+        return n
+
+    def close(self):
+        self.stopped.set()
+        io.RawIOBase.close(self)
+
+
+"""Writes bucket/key as a multipart upload, partsize bytes per part and up
+   to threads parts at a time. The object only appears once complete() is
+   called after close(); abort() drops what was uploaded. name is the file
+   name the writers of the stream (see bgzf.openVcf) go by; by default the
+   key
+"""
+class S3Writer(io.RawIOBase):
+
+    def __init__(self, s3, bucket, key, name=None, partsize=PARTSIZE,
+        threads=THREADS, contenttype='text/plain'):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.name = key if (name is None) else name
+        self.partsize = partsize
+        self.threads = threads
+        self.buffer = bytearray()
+        self.parts = []
+        # uploads of the parts after self.parts, in order
+        self.pending = collections.deque()
+        self.numbers = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.create_multipart_upload
+        self.uploadid = s3.create_multipart_upload(Bucket=bucket, Key=key,
+            ContentType=contenttype)['UploadId']
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer.extend(b)
+        while (len(self.buffer) >= self.partsize):
+            self.submitPart(bytes(self.buffer[:self.partsize]))
+            del self.buffer[:self.partsize]
+        return len(b)
+
+    """Starts the upload of the next part; waits for the oldest ones while
+       threads parts are being uploaded, which bounds the memory they hold
+    """
+    def submitPart(self, data):
+        self.numbers = self.numbers + 1
+        self.pending.append(self.executor.submit(self.uploadPart,
+            self.numbers, data))
+        while (len(self.pending) > self.threads):
+            self.parts.append(self.pending.popleft().result())
+
+    def uploadPart(self, number, data):
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.upload_part
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key,
+            UploadId=self.uploadid, PartNumber=number, Body=data)
+        return {'ETag': response['ETag'], 'PartNumber': number}
+
+    """Uploads the rest as the last part, and waits for all parts
+    """
+    def close(self):
+        if self.closed:
+            return
+        if (len(self.buffer) > 0 or self.numbers == 0):
+            self.submitPart(bytes(self.buffer))
+            self.buffer = bytearray()
+        while (len(self.pending) > 0):
+            self.parts.append(self.pending.popleft().result())
+        self.executor.shutdown()
+        io.RawIOBase.close(self)
+
+    def complete(self):
+        self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+            UploadId=self.uploadid, MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+            UploadId=self.uploadid)
+
+
+"""Reads fileobj gzip compressed, compressing it as it is read, so that a
+   file is uploaded gzip-encoded without a compressed copy being written
+"""
+class GzipReader(io.RawIOBase):
+
+    def __init__(self, fileobj, level=GZIPLEVEL, readsize=READSIZE):
+        self.fileobj = fileobj
+        self.readsize = readsize
+        # wbits 31: a gzip header and trailer around the deflate stream
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        self.buffer = bytearray()
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while (len(self.buffer) < len(b) and not self.eof):
+            data = self.fileobj.read(self.readsize)
+            if (len(data) > 0):
+                self.buffer.extend(self.compressor.compress(data))
+            else:
+                self.buffer.extend(self.compressor.flush())
+                self.eof = True
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        del self.buffer[:n]
+        return n
+
+### EOF
@@ -0,0 +1,76 @@
+# scheduler.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Stage-parallel AnnTools pipeline: the database work of independent
+# stages is done concurrently, one connection per stage, while records are
+# still annotated stage by stage in the canonical order
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import concurrent.futures
+
+import pipeline
+
+"""For each stage, the earlier stages it depends on: those adding an INFO
+   key it reads
+"""
+def dependencies(annotators):
+    deps = []
+    for j, annotator in enumerate(annotators):
+        reads = set(annotator.infoReads)
+        deps.append(set([i for i in range(j)
+            if (len(reads & set(annotators[i].infoWrites)) > 0)]))
+    return deps
+
+
+"""Runs the lookahead of stages in waves. Before stage n of a block, every
+   stage not yet looked ahead whose dependencies have all annotated the
+   block (i.e. come before n) does its lookahead, concurrently, over the
+   records as they are at that point. Stage n then annotates the block and
+   the next stages follow in order, so the INFO contributions are merged
+   exactly as in the serial pipeline
+"""
+class Scheduler(object):
+
+    def __init__(self, annotators, threads):
+        self.annotators = annotators
+        self.deps = dependencies(annotators)
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.done = set()
+
+    def prepare(self, n, records):
+        if (n == 0):
+            self.done = set()
+        if n in self.done:
+            return
+
+        before = set(range(n))
+        wave = [m for m in range(n, len(self.annotators))
+            if (m not in self.done and self.deps[m] <= before)]
+        futures = [self.executor.submit(self.annotators[m].lookahead,
+            records) for m in wave]
+        for future in futures:
+            future.result()
+        self.done.update(wave)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+"""Same as pipeline.runPipeline, with the lookahead of the stages spread
+   over a pool of threads
+"""
+def runScheduled(annotators, infile, outfile, threads,
+    blocksize=pipeline.BLOCKSIZE, cache=None, format='vcf'):
+    scheduler = Scheduler(annotators, threads)
+    try:
+        pipeline.runPipeline(annotators, infile, outfile,
+            blocksize=blocksize, prepare=scheduler.prepare, cache=cache,
+            format=format)
+    finally:
+        scheduler.close()
+
+### EOF
@@ -0,0 +1,327 @@
+# snapshot.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Columnar, memory-mapped snapshot of the annotator reference database
+#
+# A snapshot directory holds one sub-directory per table. Each table has a
+# meta.json (columns, key columns, chromosome -> file) and one file per
+# chromosome laid out as:
+#
+#   magic 'GASSNAP1' | uint32 n | uint32 0
+#   starts[n] | ends[n] | maxends[n] | orders[n]    uint32, sorted by start
+#   offsets[n + 1]                                  uint64, into the pool
+#   row pool                                        marshal'ed row tuples
+#
+# All integers are little-endian. Files are opened with mmap, so workers
+# share the pages through the OS cache and start without loading anything.
+#
+# Usage: python snapshot.py <snapshot_dir>   (exports from the reference DB)
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import mmap
+import time
+import array
+import struct
+import marshal
+
+import intervals
+
+MAGIC = b'GASSNAP1'
+HEADER = struct.Struct('<8sII')
+
+CHROMS = ['1','2','3','4','5','6','7','8','9','10','11','12','13','14','15',
+    '16','17','18','19','20','21','22','X','Y']
+
+"""Tables exported to a snapshot and how they are keyed:
+   (columns, chromosome column, start column, end column)
+   A chromosome column of None keeps all rows in one bucket
+"""
+TABLES = {
+    'dbSNP': ('*', 'CHR', 'POS', 'POS'),
+    'chrom_pos_equal_base': ('*', 'CHR', 'start', 'start'),
+    'chrom_pos_equal_nobase': ('*', 'CHR', 'start', 'start'),
+    'chrom_pos_unequal': ('*', 'CHR', 'start', 'end'),
+    'refGene': ('*', 'chrom', 'txStart', 'txEnd'),
+    'cpgIslandExt': ('chrom, chromStart, chromEnd, name', 'chrom',
+        'chromStart', 'chromEnd'),
+    'cytoBand': ('*', 'chrom', 'chromStart', 'chromEnd'),
+    'gadAll': ('*', 'chromosome', 'chromStart', 'chromEnd'),
+    'gwasCatalog': ('*', 'chrom', 'chromEnd', 'chromEnd'),
+    'targetScanS': ('*', 'chrom', 'chromStart', 'chromEnd'),
+    'hugo': ('*', 'chrom', 'chromStart', 'chromEnd'),
+    'dgv_Cnv': ('*', 'chrom', 'chromStart', 'chromEnd'),
+    'abParts_IG_T_CelReceptors': ('*', 'chrom', 'chromStart', 'chromEnd'),
+    'mcCarroll_Cnv': ('*', 'chrom', 'chromStart', 'chromEnd'),
+    'conrad_Cnv': ('*', 'chrom', 'chromStart', 'chromEnd'),
+    'genomicSuperDups': ('*', 'chrom', 'chromStart', 'chromEnd'),
+}
+for c in CHROMS:
+    TABLES['tfbsConsSites' + c] = ('chrom, chromStart, chromEnd, name', None,
+        'chromStart', 'chromEnd')
+
+
+"""marshal only handles builtin types; anything else (Decimal, dates) is
+   stored as its string, which is how the annotators use it
+"""
+def _plain(value):
+    if (value is None or type(value) in (int, float, str, bytes)):
+        return value
+    return str(value)
+
+
+"""Writes one chromosome of a table
+"""
+def writeChrom(path, entries):
+    entries.sort(key=lambda e: (e[0], e[1]))
+    maxends = []
+    maxend = 0
+    for e in entries:
+        maxend = max(maxend, e[2])
+        maxends.append(maxend)
+
+    pool = []
+    offsets = array.array('Q', [0])
+    for e in entries:
+        payload = marshal.dumps(tuple([_plain(v) for v in e[3]]))
+        pool.append(payload)
+        offsets.append(offsets[-1] + len(payload))
+
+    columns = [
+        array.array('I', [e[0] for e in entries]),
+        array.array('I', [e[2] for e in entries]),
+        array.array('I', maxends),
+        array.array('I', [e[1] for e in entries]),
+        offsets,
+    ]
+    fh = open(path, 'wb')
+    fh.write(HEADER.pack(MAGIC, len(entries), 0))
+    for column in columns:
+        if (sys.byteorder != 'little'):
+            column.byteswap()
+        column.tofile(fh)
+    fh.write(b''.join(pool))
+    fh.close()
+
+
+"""Exports one table, one chromosome at a time to bound memory
+"""
+def exportTable(cursor, outdir, table, columns, chromcol, startcol, endcol):
+    tabledir = os.path.join(outdir, table)
+    if not os.path.isdir(tabledir):
+        os.makedirs(tabledir)
+
+    if (chromcol is None):
+        chroms = [None]
+    else:
+        cursor.execute('select distinct ' + chromcol + ' from ' + table + ';')
+        chroms = sorted([str(row[0]) for row in cursor.fetchall()])
+
+    names = None
+    files = {}
+    count = 0
+    for chrom in chroms:
+        sql = 'select ' + columns + ' from ' + table
+        if (chrom is not None):
+            sql = sql + ' where ' + chromcol + '="' + chrom + '"'
+        cursor.execute(sql + ';')
+        names = [str(d[0]) for d in cursor.description]
+        lower = [n.lower() for n in names]
+        startind = lower.index(startcol.lower())
+        endind = lower.index(endcol.lower())
+
+        entries = []
+        for order, row in enumerate(cursor.fetchall()):
+            if (row[startind] is None or row[endind] is None):
+                continue
+            entries.append((int(row[startind]), order, int(row[endind]), row))
+
+        filename = str(len(files)) + '.snap'
+        writeChrom(os.path.join(tabledir, filename), entries)
+        files['' if chrom is None else chrom] = filename
+        count = count + len(entries)
+
+    meta = {'table': table, 'columns': names, 'chromcol': chromcol,
+        'startcol': startcol, 'endcol': endcol, 'rows': count,
+        'chroms': files}
+    json.dump(meta, open(os.path.join(tabledir, 'meta.json'), 'w'), indent=1)
+    return count
+
+
+"""Exports every table in TABLES from the reference database
+"""
+def exportSnapshot(cursor, outdir, tables=TABLES):
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    for table in sorted(tables):
+        columns, chromcol, startcol, endcol = tables[table]
+        count = exportTable(cursor, outdir, table, columns, chromcol,
+            startcol, endcol)
+        print(f"{table}: {str(count)} rows")
+
+    info = {'created': int(time.time()), 'tables': sorted(tables)}
+    json.dump(info, open(os.path.join(outdir, 'snapshot.json'), 'w'),
+        indent=1)
+
+
+"""One chromosome of a snapshot table, mapped read-only
+"""
+class SnapshotChrom(object):
+
+    def __init__(self, path):
+        fh = open(path, 'rb')
+        self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        fh.close()
+
+        magic, n, reserved = HEADER.unpack_from(self.mm, 0)
+        if (magic != MAGIC):
+            raise ValueError(f"Not a reference snapshot file: {path}")
+        if (sys.byteorder != 'little'):
+            raise ValueError("Reference snapshots are little-endian only")
+
+        self.n = n
+        view = memoryview(self.mm)
+        offset = HEADER.size
+        self.starts = view[offset:offset + 4 * n].cast('I')
+        offset = offset + 4 * n
+        self.ends = view[offset:offset + 4 * n].cast('I')
+        offset = offset + 4 * n
+        self.maxends = view[offset:offset + 4 * n].cast('I')
+        offset = offset + 4 * n
+        self.orders = view[offset:offset + 4 * n].cast('I')
+        offset = offset + 4 * n
+        self.offsets = view[offset:offset + 8 * (n + 1)].cast('Q')
+        self.pool = offset + 8 * (n + 1)
+        self.segments = None
+
+    def row(self, i):
+        return marshal.loads(self.mm[self.pool + self.offsets[i]:
+            self.pool + self.offsets[i + 1]])
+
+    """Returns (start, order, end, i) for every row, sorted by start
+    """
+    def sweep(self):
+        for i in range(self.n):
+            yield (self.starts[i], self.orders[i], self.ends[i], i)
+
+    def overlap(self, lo, hi):
+        if (self.n == 0):
+            return []
+        return [self.row(h) for h in intervals.findOverlaps(self.starts,
+            self.maxends, self.ends, self.orders, lo, hi)]
+
+    def stabMany(self, positions, first=False):
+        if (self.segments is None):
+            self.segments = intervals.Segments(self.starts, self.maxends,
+                self.ends, self.orders)
+        return self.segments.stabMany(positions, self.row, first)
+
+
+"""Snapshot of one table; answers the same lookups as IntervalIndex
+"""
+class SnapshotTable(object):
+
+    def __init__(self, tabledir):
+        self.tabledir = tabledir
+        meta = json.load(open(os.path.join(tabledir, 'meta.json')))
+        self.table = meta['table']
+        self.columns = meta['columns']
+        self.chromcol = meta['chromcol']
+        self.files = meta['chroms']
+        self.chroms = {}
+
+    """Index of a column by name, compared case-insensitively like MySQL
+    """
+    def column(self, name):
+        return [c.lower() for c in self.columns].index(name.lower())
+
+    def getChrom(self, chrom):
+        if (self.chromcol is None):
+            chrom = ''
+        if chrom not in self.chroms:
+            if chrom in self.files:
+                self.chroms[chrom] = SnapshotChrom(
+                    os.path.join(self.tabledir, self.files[chrom]))
+            else:
+                self.chroms[chrom] = None
+        return self.chroms[chrom]
+
+    """Returns the rows with start <= hi and end >= lo
+    """
+    def overlap(self, chrom, lo, hi):
+        snapchrom = self.getChrom(chrom)
+        if (snapchrom is None):
+            return []
+        return snapchrom.overlap(lo, hi)
+
+    """Returns the rows with start <= pos <= end
+    """
+    def stab(self, chrom, pos):
+        return self.overlap(chrom, pos, pos)
+
+    """Answers stab() for a list of positions at once, see
+       intervals.IntervalIndex.stabMany()
+    """
+    def stabMany(self, chrom, positions, first=False):
+        snapchrom = self.getChrom(chrom)
+        if (snapchrom is None):
+            return [None if first else [] for pos in positions]
+        return snapchrom.stabMany(positions, first)
+
+    """Sweep source for intervals.SweepJoin
+    """
+    def sweep(self, chrom):
+        snapchrom = self.getChrom(chrom)
+        if (snapchrom is None):
+            return []
+        return snapchrom.sweep()
+
+    def row(self, chrom, key):
+        return self.getChrom(chrom).row(key)
+
+
+"""A snapshot directory; tables are opened on first use
+"""
+class Snapshot(object):
+
+    def __init__(self, snapdir):
+        self.snapdir = snapdir
+        self.info = json.load(open(os.path.join(snapdir, 'snapshot.json')))
+        self.tables = {}
+
+    def table(self, name):
+        if name not in self.tables:
+            self.tables[name] = SnapshotTable(os.path.join(self.snapdir, name))
+        return self.tables[name]
+
+
+"""Snapshots opened by this process, keyed by directory
+"""
+_snapshots = {}
+
+"""Opens a snapshot once per process, so that a process running many jobs
+   (see workers.py) keeps its tables mapped
+"""
+def getSnapshot(snapdir):
+    if snapdir not in _snapshots:
+        _snapshots[snapdir] = Snapshot(snapdir)
+    return _snapshots[snapdir]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        import refdb
+        conn = refdb.connect()
+        exportSnapshot(conn.cursor(), sys.argv[1])
+        conn.close()
+    else:
+        print("A snapshot directory must be provided as input to this program.")
+
+### EOF
@@ -0,0 +1,389 @@
+# tabix.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tabix (.tbi) positional index for BGZF-compressed VCF results, and a
+# reader that fetches only the compressed blocks covering a region
+#
+# The index follows the tabix format (binning scheme plus a linear index
+# of 16kb windows), so results can also be read with tabix/htslib
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import zlib
+import struct
+
+import bgzf
+
+TBI_MAGIC = b'TBI\x01'
+# format, col_seq, col_beg, col_end, meta, skip
+TBI_VCF = (2, 1, 2, 0, ord('#'), 0)
+
+LINEAR_SHIFT = 14
+MAX_BLOCK = 0x10000
+
+
+"""Bin of the region [beg, end), zero-based
+"""
+def reg2bin(beg, end):
+    end = end - 1
+    if ((beg >> 14) == (end >> 14)):
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if ((beg >> 17) == (end >> 17)):
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if ((beg >> 20) == (end >> 20)):
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if ((beg >> 23) == (end >> 23)):
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if ((beg >> 26) == (end >> 26)):
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+"""All bins that may hold records overlapping [beg, end)
+"""
+def reg2bins(beg, end):
+    end = end - 1
+    bins = [0]
+    for offset, shift in ((1, 26), (9, 23), (73, 20), (585, 17),
+        (4681, 14)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+"""Decompresses the BGZF blocks in data, which starts at compressed offset
+   base of the file. Yields (offset, uncompressed data, next offset);
+   stops at a block cut short by the end of data
+"""
+def readBlocks(data, base=0):
+    offset = 0
+    while (offset + bgzf.HEADER.size <= len(data)):
+        fields = bgzf.HEADER.unpack_from(data, offset)
+        if (fields[0] != 0x1f or fields[1] != 0x8b or fields[8] != ord('B')
+            or fields[9] != ord('C')):
+            raise ValueError(f"Not a BGZF block at offset {base + offset}")
+        bsize = fields[11] + 1
+        if (offset + bsize > len(data)):
+            return
+        payload = data[offset + bgzf.HEADER.size:
+            offset + bsize - bgzf.FOOTER.size]
+        yield (base + offset, zlib.decompress(payload, -15),
+            base + offset + bsize)
+        offset = offset + bsize
+
+
+"""Zero-based [beg, end) of a VCF record: POS and the length of REF, or
+   END from INFO when given
+"""
+def getRegion(fields):
+    beg = int(fields[1]) - 1
+    end = beg + max(1, len(fields[3].strip()))
+    if (len(fields) > 7):
+        for item in fields[7].strip().split(';'):
+            if item.startswith('END='):
+                try:
+                    end = max(end, int(item[4:]))
+                except ValueError:
+                    pass
+    return beg, end
+
+
+"""Bytes of a file read at a time when indexing it
+"""
+READSIZE = 1024 * 1024
+
+
+"""Builds the .tbi index of a BGZF-compressed VCF sorted by position from
+   its bytes, given to write() in order in pieces of any size: read back
+   from a file by buildIndex(), or as they are written by IndexingWriter
+"""
+class IndexBuilder(object):
+
+    def __init__(self, path):
+        self.path = path
+        # compressed bytes not yet making a whole block, from self.offset
+        self.data = bytearray()
+        self.offset = 0
+        # the line cut by the end of the last block, from virtual offset
+        # self.start
+        self.pending = b''
+        self.start = None
+        self.nextoffset = 0
+        self.names = []
+        self.refs = {}
+        self.last = None
+        self.indexable = True
+
+    def write(self, data):
+        self.data.extend(data)
+        used = 0
+        for offset, block, nextoffset in readBlocks(self.data, self.offset):
+            self.addBlock(offset, block, nextoffset)
+            used = nextoffset - self.offset
+        if (used > 0):
+            del self.data[:used]
+            self.offset = self.offset + used
+
+    """Passes the lines of a block to addLine(), with the virtual offsets
+       of the start of the line and of the next line
+    """
+    def addBlock(self, offset, block, nextoffset):
+        self.nextoffset = nextoffset
+        pos = 0
+        while True:
+            nl = block.find(b'\n', pos)
+            if (self.start is None and pos < len(block)):
+                self.start = (offset << 16) | pos
+            if (nl < 0):
+                self.pending = self.pending + block[pos:]
+                break
+            if (nl + 1 == len(block)):
+                end = nextoffset << 16
+            else:
+                end = (offset << 16) | (nl + 1)
+            self.addLine(self.pending + block[pos:nl], self.start, end)
+            self.pending = b''
+            self.start = None
+            pos = nl + 1
+
+    def addLine(self, line, start, end):
+        if (not self.indexable or len(line) == 0 or line.startswith(b'#')):
+            return
+        fields = line.decode('utf-8').split('\t')
+        chrom = fields[0]
+        try:
+            beg, stop = getRegion(fields)
+        except (ValueError, IndexError):
+            print(f"{self.path} has a record without a position; " +
+                "no index written")
+            self.indexable = False
+            return
+
+        if (chrom not in self.refs):
+            self.names.append(chrom)
+            self.refs[chrom] = ({}, [])
+        elif (chrom != self.names[-1] or beg < self.last):
+            print(f"{self.path} is not sorted by position; no index written")
+            self.indexable = False
+            return
+        self.last = beg
+
+        bins, linear = self.refs[chrom]
+        chunks = bins.setdefault(reg2bin(beg, stop), [])
+        if (len(chunks) > 0 and chunks[-1][1] == start):
+            chunks[-1][1] = end
+        else:
+            chunks.append([start, end])
+
+        for w in range(beg >> LINEAR_SHIFT, ((stop - 1) >> LINEAR_SHIFT) + 1):
+            while (len(linear) <= w):
+                linear.append(0)
+            if (linear[w] == 0):
+                linear[w] = start
+
+    """Writes the index once all bytes were given. Returns indexpath, or
+       None if the file is not sorted (tabix can only index sorted files)
+    """
+    def writeIndex(self, indexpath):
+        if (len(self.pending) > 0):
+            self.addLine(self.pending, self.start, self.nextoffset << 16)
+            self.pending = b''
+        if not self.indexable:
+            return None
+
+        names = self.names
+        out = [TBI_MAGIC, struct.pack('<7i', len(names), *TBI_VCF)]
+        nm = b''.join([name.encode('utf-8') + b'\x00' for name in names])
+        out.append(struct.pack('<i', len(nm)) + nm)
+        for name in names:
+            bins, linear = self.refs[name]
+            out.append(struct.pack('<i', len(bins)))
+            for b in sorted(bins):
+                out.append(struct.pack('<Ii', b, len(bins[b])))
+                for chunk in bins[b]:
+                    out.append(struct.pack('<QQ', chunk[0], chunk[1]))
+            # empty windows take the offset of the window before them
+            for w in range(1, len(linear)):
+                if (linear[w] == 0):
+                    linear[w] = linear[w - 1]
+            out.append(struct.pack('<i', len(linear)))
+            out.append(struct.pack(f'<{len(linear)}Q', *linear))
+
+        fh_out = bgzf.BgzfWriter(indexpath)
+        data = b''.join(out)
+        for i in range(0, len(data), bgzf.BLOCKSIZE):
+            fh_out.writeBlock(data[i:i + bgzf.BLOCKSIZE])
+        fh_out.close()
+        return indexpath
+
+
+"""Builds the .tbi index of a BGZF-compressed VCF sorted by position
+   Returns the index path, or None if the file is not sorted (tabix can
+   only index sorted files)
+"""
+def buildIndex(path, indexpath=None):
+    if (indexpath is None):
+        indexpath = path + '.tbi'
+
+    builder = IndexBuilder(path)
+    fh = open(path, 'rb')
+    while True:
+        data = fh.read(READSIZE)
+        if not data:
+            break
+        builder.write(data)
+    fh.close()
+    return builder.writeIndex(indexpath)
+
+
+"""Binary file object for BGZF output (see bgzf.BgzfWriter) that passes
+   what is written to fileobj and indexes it on the way, so the result
+   does not have to be read back. The index is written to indexpath when
+   the writer is closed, if the output is sorted
+"""
+class IndexingWriter(object):
+
+    def __init__(self, fileobj, indexpath):
+        self.fileobj = fileobj
+        self.name = fileobj.name
+        self.indexpath = indexpath
+        self.builder = IndexBuilder(fileobj.name)
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.builder.write(data)
+        return len(data)
+
+    def close(self):
+        self.fileobj.close()
+        return self.builder.writeIndex(self.indexpath)
+
+
+"""Parses a .tbi index into {chrom: (bins, linear)}
+"""
+def parseIndex(data):
+    data = b''.join([block for offset, block, n in readBlocks(data)])
+    if (data[:4] != TBI_MAGIC):
+        raise ValueError("Not a tabix index")
+    n_ref = struct.unpack_from('<i', data, 4)[0]
+    l_nm = struct.unpack_from('<i', data, 32)[0]
+    names = data[36:36 + l_nm].split(b'\x00')[:n_ref]
+    offset = 36 + l_nm
+
+    refs = {}
+    for name in names:
+        n_bin = struct.unpack_from('<i', data, offset)[0]
+        offset = offset + 4
+        bins = {}
+        for i in range(n_bin):
+            b, n_chunk = struct.unpack_from('<Ii', data, offset)
+            offset = offset + 8
+            chunks = struct.unpack_from(f'<{2 * n_chunk}Q', data, offset)
+            offset = offset + 16 * n_chunk
+            bins[b] = list(zip(chunks[0::2], chunks[1::2]))
+        n_intv = struct.unpack_from('<i', data, offset)[0]
+        offset = offset + 4
+        linear = struct.unpack_from(f'<{n_intv}Q', data, offset)
+        offset = offset + 8 * n_intv
+        refs[name.decode('utf-8')] = (bins, linear)
+    return refs
+
+
+"""Reads the records of a region from an indexed BGZF VCF without reading
+   the whole file. fetch(start, end) returns bytes [start, end) of the
+   compressed file, e.g. fileRange() or s3Range()
+"""
+class TabixReader(object):
+
+    def __init__(self, index, fetch):
+        self.refs = parseIndex(index)
+        self.fetch = fetch
+
+    """Virtual offset chunks to read for [beg, end) of chrom, merged
+    """
+    def getChunks(self, chrom, beg, end):
+        if chrom not in self.refs:
+            return []
+        bins, linear = self.refs[chrom]
+        w = beg >> LINEAR_SHIFT
+        minoffset = linear[w] if (w < len(linear)) else \
+            (linear[-1] if (len(linear) > 0) else 0)
+
+        chunks = []
+        for b in reg2bins(beg, end):
+            for chunk in bins.get(b, []):
+                if (chunk[1] > minoffset):
+                    chunks.append(chunk)
+        chunks.sort()
+
+        merged = []
+        for chunk in chunks:
+            # chunks touching the same compressed block are read together
+            if (len(merged) > 0 and (chunk[0] >> 16) <= (merged[-1][1] >> 16)):
+                merged[-1][1] = max(merged[-1][1], chunk[1])
+            else:
+                merged.append([chunk[0], chunk[1]])
+        return merged
+
+    """Returns the lines of the records overlapping chrom:start-end
+       (one-based, inclusive), in file order
+    """
+    def query(self, chrom, start, end):
+        beg = start - 1
+        lines = []
+        for cbeg, cend in self.getChunks(chrom, beg, end):
+            first = cbeg >> 16
+            last = cend >> 16
+            data = self.fetch(first, last + MAX_BLOCK)
+
+            text = []
+            for offset, block, n in readBlocks(data, first):
+                lo = (cbeg & 0xffff) if (offset == first) else 0
+                if (offset == last):
+                    text.append(block[lo:cend & 0xffff])
+                    break
+                text.append(block[lo:])
+
+            for line in b''.join(text).split(b'\n'):
+                if (len(line) == 0 or line.startswith(b'#')):
+                    continue
+                fields = line.decode('utf-8').split('\t')
+                if (fields[0] != chrom):
+                    continue
+                rbeg, rend = getRegion(fields)
+                if (rbeg < end and rend > beg):
+                    lines.append('\t'.join(fields))
+        return lines
+
+    """Same as query() with a region written as chrom:start-end
+    """
+    def fetchRegion(self, region):
+        chrom, span = region.rsplit(':', 1)
+        start, end = span.replace(',', '').split('-')
+        return self.query(chrom, int(start), int(end))
+
+
+"""Range reader for a local file
+"""
+def fileRange(path):
+    def fetch(start, end):
+        fh = open(path, 'rb')
+        fh.seek(start)
+        data = fh.read(end - start)
+        fh.close()
+        return data
+    return fetch
+
+
+"""Range reader for an S3 object; one ranged GET per call
+"""
+def s3Range(s3, bucket, key):
+    def fetch(start, end):
+        response = s3.get_object(Bucket=bucket, Key=key,
+            Range=f"bytes={start}-{end - 1}")
+        return response['Body'].read()
+    return fetch
+
+### EOF
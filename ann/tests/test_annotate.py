@@ -0,0 +1,156 @@
+# test_annotate.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the annotation stages in annotate.py, on a small SQLite
+# reference database
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import random
+import sqlite3
+
+import pytest
+
+# the annotator modules import one another by module name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# utils.py, imported by annotate.py, needs the AWS and MySQL clients
+pytest.importorskip('pymysql')
+pytest.importorskip('boto3')
+
+import annotate as ann
+import dbpool
+import refdb
+
+
+"""A reference database with one coding transcript on each strand of chr1:
+   exons 1000-1300 and 1700-2000, CDS 1100-1900
+"""
+@pytest.fixture
+def reference(tmp_path, monkeypatch):
+    path = str(tmp_path / 'reference.db')
+    conn = sqlite3.connect(path)
+    conn.execute('create table refGene (bin, name, chrom, strand, '
+        'txStart integer, txEnd integer, cdsStart integer, cdsEnd integer, '
+        'exonCount integer, exonStarts blob, exonEnds blob, score, name2, '
+        'cdsStartStat, cdsEndStat, exonFrames)')
+    conn.execute('create table cpgIslandExt (chrom, chromStart integer, '
+        'chromEnd integer, name)')
+    for name, strand in [('NM_1', '+'), ('NM_2', '-')]:
+        conn.execute('insert into refGene values (?, ?, ?, ?, ?, ?, ?, ?, '
+            '?, ?, ?, ?, ?, ?, ?, ?)', (0, name, 'chr1', strand, 1000, 2000,
+            1100, 1900, 2, b'1000,1700,', b'1300,2000,', 0, 'GENE' + name[3:],
+            'cmpl', 'cmpl', ''))
+    conn.commit()
+    conn.close()
+    ann._models.clear()
+    # the stage reads the reference through connections of the pool
+    monkeypatch.setattr(dbpool, 'acquire', lambda: sqlite3.connect(path))
+    monkeypatch.setattr(dbpool, 'release', lambda conn: conn.close())
+    yield path
+    ann._models.clear()
+
+
+"""Locates a variant at pos of chr1; returns the INFO the stage writes
+"""
+def locate(tmp_path, pos):
+    basefile = str(tmp_path / 'input.vcf')
+    fh = open(basefile + '.2', 'w')
+    fh.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+    fh.write(f"1\t{pos}\t.\tA\tG\t.\t.\tname=.\n")
+    fh.close()
+    ann.getExonsEtAl(basefile)
+    lines = open(basefile + '.3').read().splitlines()
+    return lines[1].split('\t')[7]
+
+
+def test_utr_by_strand(reference, tmp_path):
+    # the 5' UTR of the + strand transcript is the 3' UTR of the - one,
+    # and the other way round
+    info = locate(tmp_path, 1050)
+    assert 'positionType=utr5' in info and 'positionType=utr3' in info
+    info = locate(tmp_path, 1950)
+    assert 'positionType=utr3' in info and 'positionType=utr5' in info
+
+
+def test_cds(reference, tmp_path):
+    assert 'positionType=CDS;exon=ex1/2' in locate(tmp_path, 1200)
+    assert 'positionType=CDS;intron' in locate(tmp_path, 1500)
+
+
+"""A reference database of the three BigRefGene tables with rows at
+   positions 1kb apart on chr1 and chr2; the chrom_pos_unequal rows span
+   300 bases, so that positions 1kb apart never share a range of starts
+"""
+@pytest.fixture
+def bigrefgene(tmp_path):
+    path = str(tmp_path / 'bigrefgene.db')
+    conn = sqlite3.connect(path)
+    columns = ', '.join(['haplotypeReference', 'haplotypeAlternate', 'name',
+        'name2', 'transcriptStrand', 'positionType'])
+    for table in ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+        'chrom_pos_unequal']:
+        conn.execute('create table ' + table + ' (id integer, CHR, '
+            'start integer, end integer, ' + columns + ')')
+    rnd = random.Random(1)
+    for chrom in ['1', '2']:
+        for i in range(1, 3001):
+            pos = i * 1000
+            name = 'NM_' + chrom + '_' + str(i)
+            kind = rnd.randint(0, 3)
+            if (kind == 0):
+                conn.execute('insert into chrom_pos_equal_base values '
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (0, chrom, pos, pos,
+                    'A', 'G', name, 'GENE', '+', 'CDS'))
+            elif (kind == 1):
+                conn.execute('insert into chrom_pos_equal_nobase values '
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (0, chrom, pos, pos,
+                    '', '', name, 'GENE', '-', 'intron'))
+            start = pos - rnd.randint(0, 300)
+            conn.execute('insert into chrom_pos_unequal values '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (0, chrom, start,
+                start + 300, '', '', name, 'GENE', '+', 'utr3'))
+    conn.commit()
+    refdb.createIndexes(conn)
+    conn.close()
+    refdb.configure(path)
+    dbpool.closeAll()
+    yield path
+    dbpool.closeAll()
+    refdb.configure()
+
+
+"""Annotates variants at every 1kb of chr1 and chr2, and 150 bases past
+   every other 1kb of chr1, with getBigRefGene; returns the lines written
+"""
+def annotateBigRefGene(tmp_path):
+    basefile = str(tmp_path / 'input.vcf')
+    fh = open(basefile + '.1', 'w')
+    fh.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+    for chrom in ['1', '2']:
+        for i in range(1, 3001):
+            fh.write(f"{chrom}\t{i * 1000}\t.\tA\tG\t.\t.\t.\n")
+            if (chrom == '1' and i % 2 == 0):
+                fh.write(f"{chrom}\t{i * 1000 + 150}\t.\tT\tC\t.\t.\t.\n")
+    fh.close()
+    ann.getBigRefGene(basefile)
+    return open(basefile + '.2').read().splitlines()
+
+
+def test_bigrefgene_prefetch(bigrefgene, tmp_path, monkeypatch):
+    # the positions of chr1 fall in 3000 ranges of starts, more than the
+    # expression depth SQLite allows in one query; the lookups of every
+    # record on its own are the reference
+    lines = annotateBigRefGene(tmp_path)
+    monkeypatch.setattr(ann.BigRefGeneAnnotator, 'prefetch',
+        lambda self, records: None)
+    assert lines == annotateBigRefGene(tmp_path)
+    assert 'positionType=utr3' in lines[-1]
+
+### EOF
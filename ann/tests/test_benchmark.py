@@ -0,0 +1,33 @@
+# test_benchmark.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Runs the offline benchmark (benchmark.py) on a small synthetic SQLite
+# reference database: every configuration of driver.run() must write the
+# same output as the original chain of stages
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+
+import pytest
+
+# the annotator modules import one another by module name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# utils.py, imported by refdb.py, needs the AWS and MySQL clients
+pytest.importorskip('pymysql')
+pytest.importorskip('boto3')
+
+import benchmark
+
+
+def test_configurations_match_staged(tmp_path):
+    assert benchmark.main(['--workdir', str(tmp_path), '--records', '1000',
+        '--span', '20000', '--configs', ','.join(benchmark.CONFIGS)]) == 0
+
+### EOF
@@ -13,25 +13,56 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
+"""Reference database credentials, cached so that connections do not
+   each call Secrets Manager. The secret is re-read after
+   CREDENTIALS_TTL seconds, or on a failed login in case it was rotated
+"""
+CREDENTIALS_TTL = 900
+
+_credentials = None
+_credentials_time = 0
+
+def get_db_credentials(refresh=False):
+    global _credentials, _credentials_time
+
+    if (refresh or _credentials is None or \
+        time.time() - _credentials_time > CREDENTIALS_TTL):
+        AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+            ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+        # Get RDS secret from AWS Secrets Manager
+        asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+        try:
+            asm_response = asm.get_secret_value(
+                SecretId='rds/anntools_database')
+            _credentials = json.loads(asm_response['SecretString'])
+            _credentials_time = time.time()
+        except ClientError as e:
+            print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+            raise e
+
+    return _credentials
+
+
 """Get connection to reference database
+   Prefer dbpool.acquire(), which reuses connections
 """
 def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
-
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
     try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
+        return _connect(get_db_credentials())
+    except pymysql.err.OperationalError as e:
+        # 1045: access denied, the secret may have been rotated
+        if (e.args[0] != 1045):
+            raise e
+        return _connect(get_db_credentials(refresh=True))
+
 
+def _connect(rds_secret):
     # Extract database connection parameters
     rds_host = rds_secret['host']
     mysql_port = rds_secret['port']
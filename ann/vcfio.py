@@ -0,0 +1,180 @@
+# vcfio.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# VCF records, reader and writer shared by the AnnTools stages
+#
+# A record is parsed once when read and handed from stage to stage. Its
+# CHROM and POS are stripped once, and the INFO the stages add is kept as
+# a list of tokens joined only when the record is written (or a stage
+# reads the whole INFO), instead of the INFO string being copied by every
+# stage that adds to it.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import bgzf
+import pileup2vcf
+
+INFO = 7
+
+
+"""A parsed VCF record: the list of its columns, as the stages have
+   always used it, plus the stripped CHROM and POS (chrom, pos). Stages
+   read INFO with getInfo() and add to it with addInfo() or appendInfo();
+   self[7] only holds the INFO from before the pending tokens
+"""
+class Record(list):
+    __slots__ = ('chrom', 'pos', 'info')
+
+    def __init__(self, fields):
+        list.__init__(self, fields)
+        self.chrom = self[0].strip()
+        self.pos = self[1].strip() if (len(self) > 1) else None
+        # [INFO, token, ...] once a token is pending, else None
+        self.info = None
+
+    def copy(self):
+        record = Record.__new__(Record)
+        list.__init__(record, self)
+        record.chrom = self.chrom
+        record.pos = self.pos
+        record.info = None if (self.info is None) else list(self.info)
+        return record
+
+    """The whole INFO column
+    """
+    def getInfo(self):
+        if (self.info is not None):
+            self[INFO] = ''.join(self.info)
+            self.info = None
+        return self[INFO]
+
+    def setInfo(self, value):
+        self[INFO] = value
+        self.info = None
+
+    """Appends text to INFO as it is
+    """
+    def appendInfo(self, text):
+        if (len(text) == 0):
+            return
+        if (self.info is None):
+            self.info = [self[INFO], text]
+        else:
+            self.info.append(text)
+
+    """Appends text to INFO after a ';', unless INFO already ends with one
+    """
+    def addInfo(self, text):
+        last = self[INFO] if (self.info is None) else self.info[-1]
+        if last.endswith(';'):
+            self.appendInfo(text)
+        else:
+            self.appendInfo(';' + text)
+
+    """Prefixes every column after the first with pad
+    """
+    def pad(self, pad):
+        for c in range(1, len(self)):
+            self[c] = pad + self[c]
+        if (self.info is not None):
+            self.info[0] = pad + self.info[0]
+
+    """True if the record as a line would start or end with whitespace
+    """
+    def isPadded(self):
+        last = self[-1]
+        if (self.info is not None and len(self) == INFO + 1):
+            last = self.info[-1]
+        return (self[0][:1].isspace() or last[-1:].isspace())
+
+    def toLine(self, sep='\t'):
+        if (self.info is not None):
+            self.getInfo()
+        return sep.join(self)
+
+
+def parse(line, sep='\t'):
+    return Record(line.split(sep))
+
+
+"""Reads the lines of a .vcf or .vcf.gz, or with format='pileup' of a
+   variant pileup converted on the fly (see pileup2vcf.PileupReader).
+   Lines are stripped. path may also be a binary file object, see
+   bgzf.openVcf()
+"""
+class Reader(object):
+
+    def __init__(self, path, format='vcf'):
+        self.path = path
+        if (format == 'pileup'):
+            self.fh = pileup2vcf.PileupReader(path)
+        else:
+            self.fh = bgzf.openVcf(path)
+
+    def __iter__(self):
+        for line in self.fh:
+            yield line.strip()
+
+    """Yields the lines in lists of blocksize lines
+    """
+    def blocks(self, blocksize):
+        block = []
+        for line in self.fh:
+            block.append(line.strip())
+            if (len(block) >= blocksize):
+                yield block
+                block = []
+        if (len(block) > 0):
+            yield block
+
+    def close(self):
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+"""Writes lines to a .vcf, or BGZF compressed if path ends in .gz, a
+   buffer of lines at a time. path may also be a binary file object, see
+   bgzf.openVcf()
+"""
+class Writer(object):
+    BUFFERLINES = 5000
+
+    def __init__(self, path, mode='w'):
+        self.path = path
+        self.fh = bgzf.openVcf(path, mode)
+        self.buffer = []
+
+    def write(self, line):
+        self.buffer.append(line)
+        if (len(self.buffer) >= self.BUFFERLINES):
+            self.flush()
+
+    def writeLines(self, lines):
+        self.buffer.extend(lines)
+        if (len(self.buffer) >= self.BUFFERLINES):
+            self.flush()
+
+    def flush(self):
+        if (len(self.buffer) > 0):
+            self.fh.write('\n'.join(self.buffer) + '\n')
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+### EOF
@@ -0,0 +1,329 @@
+# workers.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Pool of long-lived annotation workers for annotator.py
+#
+# The workers are forked from a fork server, a single-threaded process
+# started by the pool with run.py, the AnnTools modules and boto3 already
+# imported; not from annotator.py, whose message handler threads could
+# hold locks a forked child would never see released. Each one loads the
+# reference data it needs once (interval indexes, snapshot tables,
+# database connections) and then runs the jobs the pool hands it on a queue
+# of its own, one at a time, so a job does not pay for a fresh interpreter
+# and the number of jobs running at once is the size of the pool. Jobs
+# submitted while no worker is free wait in the pool; as the pool knows
+# the job of every worker, a job is reported lost with its worker even if
+# the worker died before starting it.
+#
+# A worker is replaced after a number of jobs, to return the memory a
+# long-lived interpreter holds on to, and when it dies. A job running for
+# longer than the timeout is killed with its worker, and all processes
+# the worker started.
+#
+# Jobs are only admitted while the instance has memory and disk to spare
+# beyond set minimums, besides a free worker.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import time
+import queue
+import signal
+import threading
+import traceback
+import multiprocessing
+from configparser import ConfigParser
+
+import dbpool
+import driver
+import refdb
+import run
+import snapshot
+
+"""Default number of jobs a worker runs before it is replaced
+"""
+MAXJOBS = 100
+
+"""Seconds between two checks by a waiting worker that annotator.py is
+   still running
+"""
+ORPHANCHECK = 5
+
+
+"""Memory available to new processes, in MB, or None where unknown
+"""
+def getFreeMemory():
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+"""Disk space free to unprivileged users under path, in MB
+"""
+def getFreeDisk(path='.'):
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize // (1024 * 1024)
+
+
+"""Loads what the stages of a job use, so that the first job of the
+   worker does not: the interval indexes of the overlap tables or the
+   snapshot tables, and a connection to the reference database
+"""
+def warmUp():
+    config = ConfigParser()
+    config.read('ann_config.ini')
+    refdb.configure(config.get('ann', 'ReferenceDb', fallback=''))
+    snapshot_dir = config.get('ann', 'SnapshotDir', fallback='') or None
+
+    conn = None
+    try:
+        if snapshot_dir:
+            driver.getStages(None,
+                snapshot=snapshot.getSnapshot(snapshot_dir))
+        else:
+            conn = dbpool.acquire()
+            driver.getStages(conn.cursor(), sweep=False)
+    except Exception as e:
+        print(f"Worker {os.getpid()} not warmed up: {e}")
+    if (conn is not None):
+        dbpool.release(conn)
+
+
+"""Main loop of a worker: runs the jobs (input file name, S3 source or
+   None; see run.run_job()) taken from jobs, its own queue, until it has
+   run maxjobs or takes None. Tells the pool on events
+   when it starts and ends a job. Exits if annotator.py is gone
+"""
+def serve(jobs, events, maxjobs):
+    # a process group of its own, so that a job that times out is killed
+    # with the processes it started (see parallel.py)
+    os.setpgrp()
+    # annotator.py; the parent process of a worker is the fork server,
+    # which only exits once the workers have
+    parent = multiprocessing.parent_process()
+    # connections inherited from annotator.py must not be used here
+    dbpool.forget()
+    warmUp()
+    pid = os.getpid()
+    n = 0
+    while (n < maxjobs):
+        try:
+            job = jobs.get(timeout=ORPHANCHECK)
+        except queue.Empty:
+            if not parent.is_alive():
+                return
+            continue
+        if (job is None):
+            return
+        file_name, source = job
+        n = n + 1
+        events.put(('start', pid, file_name))
+        try:
+            run.run_job(file_name, source)
+        except Exception:
+            traceback.print_exc()
+        events.put(('end', pid, file_name))
+
+
+"""A pool of size workers, each running up to maxjobs jobs
+   A job is killed after timeout seconds (0 for no limit). Jobs are not
+   admitted while less than minmemory MB of memory or mindisk MB of disk
+   under workdir is free (0 for no minimum)
+"""
+class WorkerPool(object):
+
+    def __init__(self, size, maxjobs=MAXJOBS, timeout=0, minmemory=0,
+        mindisk=0, workdir='.'):
+        self.size = size
+        self.maxjobs = maxjobs
+        self.timeout = timeout
+        self.minmemory = minmemory
+        self.mindisk = mindisk
+        self.workdir = workdir
+        # why jobs are not admitted, None while they are
+        self.throttled = None
+        # forked from a fork server that has imported this module (and so
+        # run.py and the AnnTools modules), so that the workers start with
+        # them imported, but not with the threads of annotator.py
+        self.context = multiprocessing.get_context('forkserver')
+        self.context.set_forkserver_preload([__name__])
+        self.events = self.context.Queue()
+        # jobs are submitted by the threads of annotator.py handling
+        # messages (see consumer.py); what follows, but for running and
+        # killed, is used under lock
+        self.lock = threading.Lock()
+        self.workers = {}
+        # the job queue of every worker, and the number of jobs handed to
+        # it, by pid
+        self.queues = {}
+        self.handed = {}
+        # file name of the job every worker was handed and has not ended,
+        # by pid
+        self.assigned = {}
+        # jobs submitted while no worker was free to take them
+        self.pending = []
+        # (file name, start time) of the job every busy worker runs, by pid
+        self.running = {}
+        # pids of the workers killed for running too long
+        self.killed = set([])
+        for i in range(size):
+            self.startWorker()
+
+    def startWorker(self):
+        jobs = self.context.Queue()
+        # not a daemon: a job with Processes > 1 starts its own pool
+        worker = self.context.Process(target=serve,
+            args=(jobs, self.events, self.maxjobs))
+        worker.start()
+        with self.lock:
+            self.workers[worker.pid] = worker
+            self.queues[worker.pid] = jobs
+            self.handed[worker.pid] = 0
+            self.dispatch()
+
+    """Hands the pending jobs to the workers free to run them: those without
+       a job, that have not been handed maxjobs. Called under lock
+    """
+    def dispatch(self):
+        for pid in self.workers:
+            if (len(self.pending) == 0):
+                return
+            if (pid in self.assigned or self.handed[pid] >= self.maxjobs):
+                continue
+            file_name, source = self.pending.pop(0)
+            self.queues[pid].put((file_name, source))
+            self.assigned[pid] = file_name
+            self.handed[pid] = self.handed[pid] + 1
+
+    """Queues the job of an input file, or of an input streamed from
+       source = (bucket, key) (see run.run_job())
+    """
+    def submit(self, file_name, source=None):
+        with self.lock:
+            self.pending.append((file_name, source))
+            self.dispatch()
+
+    """Kills a worker and the processes it started
+    """
+    def kill(self, pid):
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # not yet the leader of its group
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    """Collects the events the workers sent: a worker that ends its job is
+       handed the next one pending
+    """
+    def collect(self):
+        while True:
+            try:
+                event, pid, file_name = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if (event == 'start'):
+                self.running[pid] = (file_name, time.time())
+            else:
+                self.running.pop(pid, None)
+                with self.lock:
+                    self.assigned.pop(pid, None)
+                    self.dispatch()
+
+    """Collects the events of the workers, kills the jobs that timed out,
+       and reaps and replaces the workers that exited: after maxjobs jobs,
+       or because they died or were killed. Returns the (file name, reason)
+       of the jobs lost with a worker: those it was handed and did not end
+    """
+    def poll(self):
+        self.collect()
+
+        if (self.timeout > 0):
+            now = time.time()
+            for pid, (file_name, started) in self.running.items():
+                if (pid not in self.killed and
+                    now - started > self.timeout):
+                    self.killed.add(pid)
+                    self.kill(pid)
+
+        lost = []
+        with self.lock:
+            workers = list(self.workers.items())
+        for pid, worker in workers:
+            if worker.is_alive():
+                continue
+            worker.join()
+            # a worker flushes its events before it exits; the end of its
+            # last job may have come in since they were collected
+            self.collect()
+            with self.lock:
+                del self.workers[pid]
+                del self.queues[pid]
+                del self.handed[pid]
+                file_name = self.assigned.pop(pid, None)
+            self.running.pop(pid, None)
+            if (file_name is not None):
+                if pid in self.killed:
+                    reason = f"timed out after {self.timeout} seconds"
+                else:
+                    # its children are orphans now
+                    self.kill(pid)
+                    reason = f"worker died (exit code {worker.exitcode})"
+                print(f"Job {file_name} lost: {reason}")
+                lost.append((file_name, reason))
+            self.killed.discard(pid)
+            self.startWorker()
+        return lost
+
+    """Reason why no job can be admitted for lack of memory or disk, or
+       None
+    """
+    def checkResources(self):
+        if (self.minmemory > 0):
+            memory = getFreeMemory()
+            if (memory is not None and memory < self.minmemory):
+                return f"{memory} MB of memory free"
+        if (self.mindisk > 0):
+            disk = getFreeDisk(self.workdir)
+            if (disk < self.mindisk):
+                return f"{disk} MB of disk free"
+        return None
+
+    """Number of jobs that can be admitted: the workers free to run them,
+       or 0 while memory or disk is short. Call poll() first
+    """
+    def available(self):
+        throttled = self.checkResources()
+        if (throttled != self.throttled):
+            if (throttled is not None):
+                print(f"Not admitting jobs: {throttled}")
+            else:
+                print("Admitting jobs again")
+            self.throttled = throttled
+        if (throttled is not None):
+            return 0
+        with self.lock:
+            return self.size - len(self.assigned) - len(self.pending)
+
+    """Kills the workers and their jobs
+    """
+    def close(self):
+        with self.lock:
+            workers = self.workers
+            self.workers = {}
+        for pid in workers:
+            self.kill(pid)
+        for worker in workers.values():
+            worker.join()
+
+### EOF
@@ -0,0 +1,360 @@
+# consumer.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# SQS consumer shared by the GAS daemons: annotator.py and the utilities
+# (archive, notify, restore, thaw)
+#
+# A daemon gives the handler of one message. The consumer receives up to
+# 10 messages per long poll, runs the handler on them in a bounded pool of
+# threads, and deletes the messages handled in batches of up to 10. While
+# a handler runs, the visibility timeout of its message is extended, so
+# the message is not delivered again before the handler is done with it.
+# The throughput of every queue is printed every few minutes.
+#
+# ann/consumer.py is a link to this file, so that the annotator bundle
+# carries it.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import time
+import threading
+import traceback
+import concurrent.futures
+
+import boto3
+import botocore
+
+"""Most messages SQS returns per receive, and takes per batch request
+"""
+BATCH = 10
+
+"""Seconds a receive waits for messages (long polling)
+"""
+WAIT = 20
+
+"""Default number of messages handled at a time
+"""
+THREADS = 10
+
+"""Visibility timeout of a queue whose attributes cannot be read, in
+   seconds; the SQS default
+"""
+VISIBILITY = 30
+
+"""Seconds between two rounds of deletes and visibility extensions
+"""
+TICK = 5
+
+"""Default seconds between two throughput reports
+"""
+REPORT = 300
+
+# seconds to wait before receiving again after a failed receive
+RETRY = 5
+
+"""Times the delete of a handled message is tried before it is given up,
+   and the message left to be delivered again
+"""
+DELETEATTEMPTS = 5
+
+_local = threading.local()
+
+
+"""The notification an SNS topic delivered in an SQS message: the JSON in
+   the Message of its body. Raises ValueError or KeyError if there is none
+"""
+def getNotification(message):
+    return json.loads(json.loads(message['Body'])['Message'])
+
+
+"""A boto3 resource for the calling thread. Clients can be shared by the
+   handler threads, resources (a DynamoDB Table, an S3 Bucket) cannot
+"""
+def getResource(service, region_name):
+    resources = _local.__dict__.setdefault('resources', {})
+    if (service, region_name) not in resources:
+        session = boto3.session.Session()
+        resources[(service, region_name)] = session.resource(service,
+            region_name=region_name)
+    return resources[(service, region_name)]
+
+
+"""Counts of what happened to the messages of a queue, reported over the
+   interval since the last report and since the consumer started
+"""
+class QueueMetrics(object):
+    COUNTS = ('received', 'handled', 'kept', 'failed', 'deleted')
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.totals = dict.fromkeys(self.COUNTS, 0)
+        self.last = dict(self.totals)
+        self.lastTime = self.started
+        # seconds spent in the handler, and since the last report
+        self.busy = 0.0
+        self.lastBusy = 0.0
+
+    def add(self, count, n=1, busy=0.0):
+        with self.lock:
+            self.totals[count] = self.totals[count] + n
+            self.busy = self.busy + busy
+
+    def report(self, inflight):
+        with self.lock:
+            now = time.time()
+            counts = dict((count, self.totals[count] - self.last[count])
+                for count in self.COUNTS)
+            busy = self.busy - self.lastBusy
+            elapsed = max(now - self.lastTime, 1e-6)
+            self.last = dict(self.totals)
+            self.lastBusy = self.busy
+            self.lastTime = now
+            total = self.totals['handled'] + self.totals['kept'] + \
+                self.totals['failed']
+            rate = total / max(now - self.started, 1e-6)
+        done = counts['handled'] + counts['kept'] + counts['failed']
+        average = (busy / done) if (done > 0) else 0.0
+        print(f"{self.name}: {counts['received']} received, "
+            f"{counts['handled']} handled, {counts['kept']} kept, "
+            f"{counts['failed']} failed, {counts['deleted']} deleted in "
+            f"{elapsed:.0f}s ({done / elapsed:.2f}/s, {average:.2f}s per "
+            f"message), {inflight} in flight; {rate:.2f}/s overall")
+
+
+"""Consumes the queue at queue_url with the sqs client. handler(message)
+   is called on every message received, in one of threads threads; the
+   message is deleted if it returns True, and otherwise left to be
+   delivered again once its visibility timeout expires, as it is if the
+   handler raises.
+
+   capacity(), if given, is the number of messages the daemon can take on
+   besides those being handled; no more are received. tick(), if given,
+   is called before every receive, in the thread of run(). visibility is
+   the visibility timeout messages are extended by, by default that of
+   the queue. Throughput is printed every report seconds
+"""
+class QueueConsumer(object):
+
+    def __init__(self, sqs, queue_url, handler, threads=THREADS, name=None,
+        capacity=None, tick=None, visibility=None, report=REPORT):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.handler = handler
+        self.threads = threads
+        self.name = name or queue_url.rstrip('/').rsplit('/', 1)[-1]
+        self.capacity = capacity
+        self.tick = tick
+        self.visibility = visibility or self.getVisibility()
+        self.report = report
+        self.metrics = QueueMetrics(self.name)
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.lock = threading.Lock()
+        # visibility deadline of the messages received and not yet
+        # deleted, by receipt handle
+        self.deadlines = {}
+        # receipt handles of the messages being handled
+        self.inflight = set([])
+        # (receipt handle, attempts) of the messages handled, to be deleted
+        self.done = []
+        # set when a handler returns, for run() waiting for a free thread
+        self.freed = threading.Event()
+        self.stopped = threading.Event()
+
+    def getVisibility(self):
+        try:
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.get_queue_attributes
+            response = self.sqs.get_queue_attributes(QueueUrl=self.queue_url,
+                AttributeNames=['VisibilityTimeout'])
+            return int(response['Attributes']['VisibilityTimeout'])
+        except (botocore.exceptions.ClientError, KeyError, ValueError) as e:
+            print(e)
+            return VISIBILITY
+
+    """Number of messages to receive now
+    """
+    def free(self):
+        with self.lock:
+            inflight = len(self.inflight)
+        n = min(BATCH, self.threads - inflight)
+        if (self.capacity is not None):
+            n = min(n, self.capacity() - inflight)
+        return n
+
+    def receive(self, n):
+        try:
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.receive_message
+            response = self.sqs.receive_message(
+                QueueUrl=self.queue_url,
+                AttributeNames=[
+                    'SentTimestamp'
+                ],
+                MaxNumberOfMessages=n,
+                WaitTimeSeconds=WAIT
+            )
+        except (botocore.exceptions.ClientError,
+            botocore.exceptions.BotoCoreError) as e:
+            print(e)
+            time.sleep(RETRY)
+            return []
+        return response.get('Messages', [])
+
+    def submit(self, message):
+        with self.lock:
+            self.inflight.add(message['ReceiptHandle'])
+            self.deadlines[message['ReceiptHandle']] = \
+                time.time() + self.visibility
+        self.metrics.add('received')
+        self.executor.submit(self.handle, message)
+
+    def handle(self, message):
+        receipt_handle = message['ReceiptHandle']
+        started = time.time()
+        try:
+            count = 'handled' if self.handler(message) else 'kept'
+        except Exception:
+            traceback.print_exc()
+            count = 'failed'
+        self.metrics.add(count, busy=time.time() - started)
+        with self.lock:
+            self.inflight.discard(receipt_handle)
+            if (count == 'handled'):
+                self.done.append((receipt_handle, 0))
+            else:
+                del self.deadlines[receipt_handle]
+            full = (len(self.done) >= BATCH)
+        self.freed.set()
+        if full:
+            self.flush()
+
+    """Deletes the messages handled, BATCH at a time. The deletes that fail
+       are tried again at the next flush, up to DELETEATTEMPTS times, but
+       for those SQS rejects (an invalid or expired receipt handle)
+    """
+    def flush(self):
+        retries = []
+        while True:
+            with self.lock:
+                batch = self.done[:BATCH]
+                del self.done[:BATCH]
+            if (len(batch) == 0):
+                break
+            entries = [{'Id': str(i), 'ReceiptHandle': receipt_handle}
+                for i, (receipt_handle, attempts) in enumerate(batch)]
+            try:
+                # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.delete_message_batch
+                response = self.sqs.delete_message_batch(
+                    QueueUrl=self.queue_url, Entries=entries)
+            except (botocore.exceptions.ClientError,
+                botocore.exceptions.BotoCoreError) as e:
+                print(e)
+                retries.extend(batch)
+                continue
+            deleted = [batch[int(success['Id'])][0]
+                for success in response.get('Successful', [])]
+            for failure in response.get('Failed', []):
+                print(f"{self.name}: message not deleted: "
+                    f"{failure.get('Message', failure.get('Code'))}")
+                if failure.get('SenderFault'):
+                    deleted.append(batch[int(failure['Id'])][0])
+                else:
+                    retries.append(batch[int(failure['Id'])])
+            with self.lock:
+                for receipt_handle in deleted:
+                    self.deadlines.pop(receipt_handle, None)
+            self.metrics.add('deleted', len(response.get('Successful', [])))
+
+        given_up = []
+        with self.lock:
+            for receipt_handle, attempts in retries:
+                if (attempts + 1 < DELETEATTEMPTS):
+                    self.done.append((receipt_handle, attempts + 1))
+                else:
+                    self.deadlines.pop(receipt_handle, None)
+                    given_up.append(receipt_handle)
+        if (len(given_up) > 0):
+            print(f"{self.name}: {len(given_up)} messages not deleted after "
+                f"{DELETEATTEMPTS} attempts")
+
+    """Extends the visibility timeout of the messages being handled, or
+       waiting to be deleted, that would otherwise become visible before
+       the next round
+    """
+    def extend(self):
+        now = time.time()
+        margin = max(2 * TICK, self.visibility // 3)
+        with self.lock:
+            due = [receipt_handle for receipt_handle, deadline
+                in self.deadlines.items() if (deadline - now < margin)]
+            for receipt_handle in due:
+                self.deadlines[receipt_handle] = now + self.visibility
+        for start in range(0, len(due), BATCH):
+            entries = [{'Id': str(i), 'ReceiptHandle': receipt_handle,
+                'VisibilityTimeout': self.visibility} for i, receipt_handle
+                in enumerate(due[start:start + BATCH])]
+            try:
+                # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.change_message_visibility_batch
+                response = self.sqs.change_message_visibility_batch(
+                    QueueUrl=self.queue_url, Entries=entries)
+            except botocore.exceptions.ClientError as e:
+                print(e)
+                continue
+            for failure in response.get('Failed', []):
+                receipt_handle = entries[int(failure['Id'])]['ReceiptHandle']
+                with self.lock:
+                    pending = receipt_handle in self.deadlines
+                # a message just deleted or given up needs no more time
+                if pending:
+                    print(f"{self.name}: visibility not extended: "
+                        f"{failure.get('Message', failure.get('Code'))}")
+
+    """Deletes and extends every TICK seconds, and reports every report
+       seconds, until the consumer stops
+    """
+    def housekeep(self):
+        reported = time.time()
+        while not self.stopped.wait(TICK):
+            try:
+                self.flush()
+                self.extend()
+                if (time.time() - reported >= self.report):
+                    with self.lock:
+                        inflight = len(self.inflight)
+                    self.metrics.report(inflight)
+                    reported = time.time()
+            except Exception:
+                traceback.print_exc()
+
+    """Consumes the queue until interrupted; waits for the messages being
+       handled before returning
+    """
+    def run(self):
+        housekeeper = threading.Thread(target=self.housekeep, daemon=True)
+        housekeeper.start()
+        try:
+            while True:
+                if (self.tick is not None):
+                    self.tick()
+                self.freed.clear()
+                n = self.free()
+                if (n <= 0):
+                    # capacity() may grow without a handler returning
+                    self.freed.wait(1)
+                    continue
+                for message in self.receive(n):
+                    self.submit(message)
+        finally:
+            self.executor.shutdown()
+            self.stopped.set()
+            housekeeper.join()
+            for attempt in range(DELETEATTEMPTS):
+                self.flush()
+                if (len(self.done) == 0):
+                    break
+
+### EOF
@@ -20,6 +20,7 @@ from boto3.dynamodb.conditions import Key, Attr
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 import helpers
+import consumer
 
 # Get configuration
 from configparser import SafeConfigParser
@@ -28,100 +29,79 @@ config.read('restore_config.ini')
 
 # Add utility code here
 def initiate_restore():
+    # clients are shared by the threads handling the messages
     try:
         sqs = boto3.client('sqs', region_name = config['aws']['AwsRegionName'])
         queue_url = config['aws']['SQS_RESTORE_URL']
+        glacier = boto3.client('glacier', region_name=config['aws']['AwsRegionName'])
     except boto3.exceptions.ResourceNotExistsError as e:
         print(e)
 
-    while True:
-        # long polling the messages with wait time seconds set to 20s
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.receive_message
-        try:
+    # receive, handle and delete the messages in batches (see consumer.py)
+    restores = consumer.QueueConsumer(sqs, queue_url,
+        lambda message: restore_archives(message, glacier),
+        threads=config.getint('aws', 'CONSUMER_THREADS',
+            fallback=consumer.THREADS))
+    restores.run()
 
-            restore_response = sqs.receive_message(
-                QueueUrl=queue_url,
-                AttributeNames=[
-                    'SentTimestamp'
-                ],
-                MaxNumberOfMessages=5,
-                WaitTimeSeconds=20
-            )
-        except botocore.errorfactory.QueueDoesNotExist as e:
-            print(e)
-            continue
 
-        try:
-            messages = restore_response['Messages']
-            if len(messages) ==0:
-                continue
-        except KeyError:
-            continue
-        for message in messages:
-            content = json.loads(message['Body'])
-            receipt_handle = message['ReceiptHandle']
-            data = json.loads(content['Message'])
-            user_id = data['user_id'] 
-            archives = get_user_archive(user_id)
-
-            # connect to glacier
-            glacier = boto3.client('glacier', region_name=config['aws']['AwsRegionName'])
-
-            # initiate restore job
-            for archive in archives:
-                description = json.dumps({'job_id':archive['job_id'],'s3_key':archive['s3_key_result_file']}) 
-                try:   
-                    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier.html#Glacier.Client.initiate_job
-                    response = glacier.initiate_job(
-                        vaultName = config['aws']['VAULT_NAME'],
-                        jobParameters = {
-                            'Type': "archive-retrieval",
-                            'ArchiveId': archive['archive_id'],
-                            'SNSTopic': config['aws']['SNS_THAW_TOPIC'],
-                            'Tier': 'Expedited',
-                            'Description': description
-                        }
-                    )
-                # botocore.errorfactory.InsufficientCapacityException 
-                except:
-                    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier.html#Glacier.Client.initiate_job
-                    try:
-                        response = glacier.initiate_job(
-                            vaultName = config['aws']['VAULT_NAME'],
-                            jobParameters = {
-                                'Type': "archive-retrieval",
-                                'ArchiveId': archive['archive_id'],
-                                'SNSTopic': config['aws']['SNS_THAW_TOPIC'],
-                                'Tier': 'Standard',
-                                'Description': description
-                            }
-                        )
-                    except ClientError as e:
-                        continue
-                # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier.html#Glacier.Client.describe_job
-                status = glacier.describe_job(vaultName=config['aws']['VAULT_NAME'],
-                    jobId=response['jobId'])
-
-            delete_message(sqs,queue_url,receipt_handle)
-            
-
-
-def delete_message(sqs,queue_url,receipt_handle):
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.delete_message
+def restore_archives(message, glacier):
+    '''Initiates the retrieval of all the archived results of a user who
+    upgraded; True once the message can be deleted'''
     try:
-        dele_rsp = sqs.delete_message(
-            QueueUrl = queue_url,
-            ReceiptHandle = receipt_handle
-        )
-    except (boto3.exceptions.ClientError,SQS.Client.exceptions.InvalidIdFormat, SQS.Client.exceptions.ReceiptHandleIsInvalid) as e:
-        print(e)
+        data = consumer.getNotification(message)
+        user_id = data['user_id']
+    except (KeyError, ValueError) as e:
+        print("Error: Input is not valid json format or doesn't have corresponding key")
+        return True
+    archives = get_user_archive(user_id)
+    if archives is None:
+        return False
+
+    # initiate restore job
+    for archive in archives:
+        description = json.dumps({'job_id':archive['job_id'],'s3_key':archive['s3_key_result_file']}) 
+        try:   
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier.html#Glacier.Client.initiate_job
+            response = glacier.initiate_job(
+                vaultName = config['aws']['VAULT_NAME'],
+                jobParameters = {
+                    'Type': "archive-retrieval",
+                    'ArchiveId': archive['archive_id'],
+                    'SNSTopic': config['aws']['SNS_THAW_TOPIC'],
+                    'Tier': 'Expedited',
+                    'Description': description
+                }
+            )
+        # botocore.errorfactory.InsufficientCapacityException 
+        except:
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier.html#Glacier.Client.initiate_job
+            try:
+                response = glacier.initiate_job(
+                    vaultName = config['aws']['VAULT_NAME'],
+                    jobParameters = {
+                        'Type': "archive-retrieval",
+                        'ArchiveId': archive['archive_id'],
+                        'SNSTopic': config['aws']['SNS_THAW_TOPIC'],
+                        'Tier': 'Standard',
+                        'Description': description
+                    }
+                )
+            except ClientError as e:
+                continue
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier.html#Glacier.Client.describe_job
+        status = glacier.describe_job(vaultName=config['aws']['VAULT_NAME'],
+            jobId=response['jobId'])
+
+    return True
+
 
 def get_user_archive(user_id):
     '''
     Get all the archive ids of the s3 result files of this user
     '''
     try:
-        dynamodb = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
+        dynamodb = consumer.getResource('dynamodb', config['aws']['AwsRegionName'])
         table_name = config['aws']['AWS_DYNAMODB_ANNOTATIONS_TABLE']
         ann_table = dynamodb.Table(table_name)
     except (ClientError, boto3.exceptions.ResourceNotExistsError) as e:
@@ -134,7 +114,7 @@ def get_user_archive(user_id):
             IndexName = 'user_id_index',
             KeyConditionExpression=Key('user_id').eq(user_id)
         )
-    except ClientError:
+    except ClientError as e:
         print(e)
         return None
 
@@ -11,6 +11,7 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import uuid
 import time
 import json
+import gzip
 from datetime import datetime
 
 import boto3
@@ -323,7 +324,12 @@ def annotation_log(id):
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Object.get
     try:
         object = s3.Object(bucket_name,s3_key)
-        content = object.get()['Body'].read().decode()
+        response = object.get()
+        content = response['Body'].read()
+        # logs are stored gzip-encoded
+        if response.get('ContentEncoding') == 'gzip':
+            content = gzip.decompress(content)
+        content = content.decode()
     except botocore.exceptions.ClientError as e:
         print(e)
 